@@ -0,0 +1,189 @@
+import argparse as arg
+import json
+import os
+import socket
+import sys
+
+# Agente de SecureBox: proceso de larga duración que escucha en un socket Unix y ejecuta las
+# órdenes de read.py con la clave privada ya importada, la caché de claves públicas y las
+# conexiones HTTP ya abiertas, de modo que cada orden no tenga que pagar el arranque de Python, la
+# importación de Crypto y requests ni la lectura de la clave. Este módulo solo importa librerías
+# estándar para que read.py pueda consultarlo sin coste cuando el agente no está en marcha.
+#
+# El socket se crea en la carpeta .files del directorio de trabajo, por lo que el agente solo
+# atiende a las órdenes lanzadas desde ese mismo directorio (y las rutas relativas coinciden).
+
+SOCKET = './.files/agent.sock'
+
+
+# Clase que envía por el socket todo lo que se escribe en ella, como un mensaje JSON por línea
+# ({"out": texto} o {"err": texto}), para que el cliente lo muestre a medida que se genera.
+#
+class SalidaSocket(object):
+    def __init__(self, wfile, tipo):
+        super(SalidaSocket, self).__init__()
+        self.wfile = wfile
+        self.tipo = tipo
+
+    def write(self, texto):
+        if texto:
+            enviar(self.wfile, {self.tipo: texto})
+        return len(texto)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+# Funcion que envía un mensaje JSON por una línea del socket.
+# Parámetros:
+#	wfile: socket (como fichero) por el que se envía.
+#	mensaje: diccionario con el mensaje.
+#
+def enviar(wfile, mensaje):
+    wfile.write((json.dumps(mensaje) + '\n').encode())
+    wfile.flush()
+
+
+# Funcion que pasa una orden de read.py al agente, si está en marcha, y muestra su salida.
+# Parámetros:
+#	argv: argumentos de la orden.
+# Return: código de salida de la orden, o None si el agente no está en marcha en este directorio
+# (o se ha desactivado con la variable de entorno SECUREBOX_NO_AGENT), en cuyo caso la orden se
+# debe ejecutar en el propio proceso.
+#
+def forward(argv):
+    # Las órdenes que leen de la entrada estándar o escriben datos en la salida estándar ('-') se
+    # ejecutan siempre en este proceso, ya que el agente solo le devuelve texto, y también la
+    # vigilancia de una carpeta, que no termina hasta que se interrumpe.
+    if os.environ.get('SECUREBOX_NO_AGENT') or not os.path.exists(SOCKET) or '-' in argv or '--watch' in argv:
+        return None
+
+    try:
+        conexion = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conexion.connect(SOCKET)
+    except OSError:
+        return None
+
+    with conexion, conexion.makefile('rwb') as canal:
+        enviar(canal, {'argv': argv, 'cwd': os.getcwd()})
+        for linea in canal:
+            mensaje = json.loads(linea)
+            if 'out' in mensaje:
+                sys.stdout.write(mensaje['out'])
+            elif 'err' in mensaje:
+                sys.stderr.write(mensaje['err'])
+            else:
+                sys.stdout.flush()
+                return mensaje.get('code')
+
+    print('Error: el agente ha cerrado la conexión sin terminar la orden.', file = sys.stderr)
+    return 1
+
+
+# Funcion que pide al agente que termine.
+# Return: True si el agente estaba en marcha.
+#
+def stop():
+    try:
+        conexion = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conexion.connect(SOCKET)
+    except OSError:
+        return False
+
+    with conexion, conexion.makefile('rwb') as canal:
+        enviar(canal, {'cmd': 'stop'})
+        canal.readline()
+    return True
+
+
+# Funcion que arranca el agente: importa los módulos de SecureBox, carga la clave privada y la
+# sesión HTTP, y atiende las órdenes que llegan por el socket, cada una en su propio hilo.
+#
+def serve():
+    import socketserver
+    import threading
+    import traceback
+    import batch
+    import crypt as cr
+    import read
+    import utils
+
+    if stop():
+        print('Se ha parado el agente que estaba en marcha en este directorio.')
+    if os.path.exists(SOCKET):
+        os.remove(SOCKET)
+
+    if os.path.exists('./.files/key.priv'):
+        cr.getPrivateKey()
+    utils.getSession()
+
+    salida = batch.instalar_salida('stdout')
+    errores = batch.instalar_salida('stderr')
+
+    class Manejador(socketserver.StreamRequestHandler):
+        def handle(self):
+            peticion = json.loads(self.rfile.readline())
+
+            if peticion.get('cmd') == 'stop':
+                enviar(self.wfile, {'code': 0})
+                threading.Thread(target = self.server.shutdown).start()
+                return
+
+            if peticion.get('cwd') != os.getcwd():
+                enviar(self.wfile, {'code': None})
+                return
+
+            salida.local.buffer = SalidaSocket(self.wfile, 'out')
+            errores.local.buffer = SalidaSocket(self.wfile, 'err')
+            try:
+                codigo = read.leer(peticion['argv'])
+            except SystemExit as e:
+                codigo = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                codigo = 1
+            finally:
+                salida.local.buffer = None
+                errores.local.buffer = None
+
+            enviar(self.wfile, {'code': codigo})
+
+    mascara = os.umask(0o177)
+    try:
+        servidor = socketserver.ThreadingUnixStreamServer(SOCKET, Manejador)
+    finally:
+        os.umask(mascara)
+    servidor.daemon_threads = True
+
+    print('Agente de SecureBox escuchando en ' + SOCKET)
+    sys.stdout.flush()
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        if os.path.exists(SOCKET):
+            os.remove(SOCKET)
+
+
+if __name__ == '__main__':
+    parser = arg.ArgumentParser(description = 'Agente de SecureBox:')
+    parser.add_argument("--start", action = 'store_true', help = 'Arrancar el agente en este directorio.')
+    parser.add_argument("--detach", action = 'store_true', help = 'Con --start, arrancar el agente en segundo plano.')
+    parser.add_argument("--stop", action = 'store_true', help = 'Parar el agente que está en marcha en este directorio.')
+    args = parser.parse_args()
+
+    if args.stop:
+        print('Agente parado.' if stop() else 'El agente no estaba en marcha.')
+
+    if args.start:
+        os.makedirs('./.files', exist_ok = True)
+        if args.detach and os.fork() != 0:
+            sys.exit(0)
+        if args.detach:
+            os.setsid()
+            nulo = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(nulo, fd)
+        serve()
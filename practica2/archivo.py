@@ -0,0 +1,274 @@
+from Crypto.Signature import PKCS1_v1_5
+import crypt as cr
+import contenedor
+import hashing
+import utils
+import contextlib
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+import threading
+
+# Archivos de directorios. Un directorio entero se guarda en un único fichero tar que se firma, se
+# cifra y se sube una sola vez, de modo que subir miles de ficheros pequeños cuesta una firma RSA,
+# un cifrado de la clave de sesión por destinatario y una petición a la API en lugar de una de cada
+# por fichero. El texto en claro del fichero cifrado es:
+#	tar | índice (JSON) | tamaño del índice (8) | MAGIC_ARCHIVO (4)
+# El índice tiene, por cada miembro del tar, su nombre, tipo ('file' o 'dir'), tamaño, fecha de
+# modificación, permisos y posición de sus datos en el texto en claro. Los lectores de tar se
+# detienen al final del tar, así que lo que le sigue no les afecta. Como los archivos se cifran
+# siempre por trozos (formato 'gcm'), con el índice se puede listar el archivo o extraer uno de
+# sus miembros descifrando solo los trozos que lo contienen (ver contenedor.descifrar_rango).
+MAGIC_ARCHIVO = b'SBXA'
+FORMATO_PIE = '>Q4s'
+
+# Tamaño de los bloques con los que se escribe el tar en la tubería que lo lleva al cifrado.
+BLOCK_SIZE = 1024 * 1024
+
+
+# Funcion que escribe un directorio como archivo (tar, índice y pie) en un fichero abierto, sin
+# necesidad de hacer seek. Solo se guardan los ficheros regulares y los directorios; los enlaces
+# y demás ficheros especiales se omiten.
+# Parámetros:
+#	directorio: dirección del directorio. Los miembros se guardan dentro de una carpeta con su
+#	nombre.
+#	outp: fichero (o flujo) abierto en modo binario.
+# Return: lista con las entradas del índice.
+#
+def escribir_archivo(directorio, outp):
+    directorio = os.path.normpath(directorio)
+    raiz = os.path.basename(os.path.abspath(directorio))
+    indice = []
+
+    with tarfile.open(fileobj = outp, mode = 'w|', format = tarfile.PAX_FORMAT, bufsize = BLOCK_SIZE) as tar:
+        for actual, carpetas, ficheros in os.walk(directorio):
+            carpetas.sort()
+            relativa = os.path.relpath(actual, directorio)
+            base = raiz if relativa == '.' else raiz + '/' + relativa.replace(os.sep, '/')
+
+            for nombre in [None] + sorted(ficheros):
+                path = actual if nombre is None else os.path.join(actual, nombre)
+                arcname = base if nombre is None else base + '/' + nombre
+                if os.path.islink(path) or not (os.path.isfile(path) or os.path.isdir(path)):
+                    print('Se omite ' + path + ': no es un fichero regular.')
+                    continue
+
+                info = tar.gettarinfo(path, arcname)
+                if info.isreg():
+                    with open(path, 'rb') as inp:
+                        tar.addfile(info, inp)
+                else:
+                    tar.addfile(info)
+
+                # La cabecera es lo que ocupa el miembro sin sus datos, redondeados a bloques.
+                datos = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                indice.append({'name': arcname, 'type': 'file' if info.isreg() else 'dir', 'size': info.size,
+                               'mtime': int(info.mtime), 'mode': info.mode, 'offset': tar.offset - datos})
+
+    datos = json.dumps(indice).encode()
+    outp.write(datos)
+    outp.write(struct.pack(FORMATO_PIE, len(datos), MAGIC_ARCHIVO))
+    return indice
+
+
+# Clase que lee de la tubería por la que llega un archivo generado en otro hilo. Un final de la
+# tubería solo es el final del archivo si el hilo ha terminado sin errores: si no, se lanza su
+# error en lugar de devolver el final, para que el cifrado se detenga antes de escribir el último
+# trozo, la firma y el índice, y no se suba un archivo truncado que parezca completo.
+#
+class LectorTuberia(io.RawIOBase):
+    def __init__(self, inp, hilo, errores):
+        super(LectorTuberia, self).__init__()
+        self.inp = inp
+        self.hilo = hilo
+        self.errores = errores
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = self.inp.readinto(buf)
+        if not n:
+            self.hilo.join()
+            if self.errores:
+                raise self.errores[0]
+        return n
+
+
+# Funcion que genera un directorio como archivo en un hilo y da un flujo del que leerlo a medida que
+# se escribe, para cifrarlo y subirlo sin guardarlo en disco.
+# Parámetros:
+#	directorio: dirección del directorio.
+# Return: gestor de contexto con el flujo (que no admite seek). Si el hilo falla, el flujo lanza
+# su error al llegar al final en lugar de terminar (ver LectorTuberia).
+#
+@contextlib.contextmanager
+def flujo_archivo(directorio):
+    if not os.path.isdir(directorio):
+        raise NotADirectoryError('No existe el directorio ' + directorio)
+
+    lectura, escritura = os.pipe()
+    errores = []
+
+    def escribir():
+        try:
+            with open(escritura, 'wb', BLOCK_SIZE) as outp:
+                escribir_archivo(directorio, outp)
+        except BaseException as e:
+            errores.append(e)
+
+    hilo = threading.Thread(target = escribir, daemon = True)
+    hilo.start()
+
+    try:
+        with open(lectura, 'rb', BLOCK_SIZE) as inp:
+            yield LectorTuberia(inp, hilo, errores)
+    finally:
+        # Al cerrar la lectura, el hilo termina aunque el cifrado se haya detenido antes del final.
+        hilo.join()
+
+
+# Funcion que comprueba que un miembro de un archivo se puede extraer sin riesgo: que es un fichero
+# regular o un directorio y que su nombre no sale del directorio de destino.
+# Parámetros:
+#	miembro: miembro del tar (TarInfo).
+#
+def comprobar_miembro(miembro):
+    partes = miembro.name.replace('\\', '/').split('/')
+    if miembro.name.startswith('/') or '..' in partes or not (miembro.isreg() or miembro.isdir()):
+        raise ValueError('Miembro no válido en el archivo: ' + miembro.name)
+
+
+# Funcion que extrae un archivo a medida que se descifra, calculando a la vez el hash de todo el
+# texto en claro para verificar la firma al terminar.
+# Parámetros:
+#	bloques: iterable con los fragmentos del texto en claro.
+#	firma: bytearray en el que está la firma al terminar de leer los fragmentos.
+#	key: clave pública del emisor (objeto RSA).
+#	destino: directorio en el que se extraen los miembros.
+# Return: True si la firma es correcta o False en caso contrario.
+#
+def extraer_verificado(bloques, firma, key, destino):
+    hash_code = hashing.HashSHA256()
+
+    def leidos():
+        for buf in bloques:
+            hash_code.update(buf)
+            yield buf
+
+    inp = utils.IteratorReader(leidos())
+    with tarfile.open(fileobj = inp, mode = 'r|', bufsize = BLOCK_SIZE) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extraction_filter = tarfile.data_filter
+        for miembro in tar:
+            comprobar_miembro(miembro)
+            tar.extract(miembro, destino)
+
+    # El índice y el pie también están firmados.
+    while inp.read(BLOCK_SIZE):
+        pass
+
+    return PKCS1_v1_5.new(key).verify(hash_code, bytes(firma))
+
+
+# Funcion que descifra, verifica y extrae un archivo a medida que se lee (por ejemplo de una
+# descarga). Los miembros se extraen en un directorio temporal dentro del destino y solo se llevan
+# al destino si la firma es correcta; si no, se borran.
+# Parámetros:
+#	inp: fichero (o flujo) cifrado abierto en modo binario.
+#	key: clave pública del emisor (objeto RSA).
+#	destino: directorio en el que se dejan los miembros.
+#	workers: número de procesos entre los que se reparten los trozos (contenedor.WORKERS si es
+#	None).
+# Return: lista con las direcciones de las carpetas y ficheros extraídos en el destino, o None si la
+# firma no es correcta.
+#
+def extraer_flujo(inp, key, destino, workers=None):
+    bloques, firma, tam_firma = cr.descifrar_stream(inp, workers = workers)
+    if firma is None or not tam_firma:
+        raise ValueError('El fichero no es un archivo firmado de SecureBox.')
+
+    temporal = os.path.join(destino, '.archivo-' + os.urandom(4).hex())
+    os.makedirs(temporal)
+    try:
+        if not extraer_verificado(bloques, firma, key, temporal):
+            return None
+
+        extraidos = []
+        for nombre in sorted(os.listdir(temporal)):
+            final = os.path.join(destino, nombre)
+            if os.path.exists(final):
+                raise FileExistsError('Ya existe ' + final + ', no se sobrescribe.')
+            os.replace(os.path.join(temporal, nombre), final)
+            extraidos.append(final)
+        return extraidos
+    finally:
+        shutil.rmtree(temporal, ignore_errors = True)
+
+
+# Clase que permite leer partes de un archivo cifrado local sin descifrarlo entero: lee la cabecera
+# una vez y después descifra rangos del texto en claro con el índice del fichero cifrado.
+# Parámetros del constructor:
+#	inp: fichero cifrado abierto en modo binario (debe admitir seek).
+#
+class LectorArchivo(object):
+    def __init__(self, inp):
+        super(LectorArchivo, self).__init__()
+        version, flags, extra, key, cabecera = cr.leer_cabecera(inp)
+        if version != contenedor.VERSION or not flags & contenedor.FLAG_INDICE:
+            raise ValueError('Solo se pueden leer por partes los archivos cifrados por trozos.')
+        self.inp = inp
+        self.key = key
+        self.cabecera = cabecera
+        self.tam_trozo, tam_firma, self.prefijo = struct.unpack(contenedor.FORMATO_EXTRA, extra)
+        self.compresion = contenedor.compresion_flags(flags)
+        self.tam = contenedor.leer_indice(inp, key, self.prefijo, cabecera)[0]
+
+    def rango(self, inicio, fin):
+        return contenedor.descifrar_rango(self.inp, self.key, self.prefijo, self.cabecera, self.tam_trozo,
+                                          inicio, fin, compresion = self.compresion)
+
+    def leer(self, inicio, fin):
+        return b''.join(self.rango(inicio, fin))
+
+    def indice(self):
+        tam_pie = struct.calcsize(FORMATO_PIE)
+        if self.tam < tam_pie:
+            raise ValueError('El fichero no es un archivo de SecureBox.')
+        tam_indice, magic = struct.unpack(FORMATO_PIE, self.leer(self.tam - tam_pie, self.tam))
+        if magic != MAGIC_ARCHIVO or tam_indice > self.tam - tam_pie:
+            raise ValueError('El fichero no es un archivo de SecureBox.')
+        return json.loads(self.leer(self.tam - tam_pie - tam_indice, self.tam - tam_pie).decode())
+
+
+# Funcion que obtiene el índice de un archivo cifrado local, descifrando solo el final del fichero.
+# Parámetros:
+#	file: dirección del archivo cifrado.
+# Return: lista con las entradas del índice.
+#
+def listar_archivo(file):
+    with open(file, 'rb') as inp:
+        return LectorArchivo(inp).indice()
+
+
+# Funcion que extrae un miembro de un archivo cifrado local descifrando solo los trozos que
+# contienen sus datos. Como no se descifra el archivo entero, la firma no se comprueba, aunque
+# cada trozo sigue autenticado por AES-GCM (como con --range).
+# Parámetros:
+#	file: dirección del archivo cifrado.
+#	nombre: nombre del miembro en el archivo.
+#	outp: fichero (o flujo) abierto en modo binario en el que se escriben sus datos.
+# Return: entrada del índice del miembro. Si no está se lanza FileNotFoundError.
+#
+def extraer_miembro(file, nombre, outp):
+    with open(file, 'rb') as inp:
+        lector = LectorArchivo(inp)
+        for entrada in lector.indice():
+            if entrada['name'] == nombre and entrada['type'] == 'file':
+                for buf in lector.rango(entrada['offset'], entrada['offset'] + entrada['size']):
+                    outp.write(buf)
+                return entrada
+    raise FileNotFoundError('No hay ningún fichero ' + nombre + ' en el archivo.')
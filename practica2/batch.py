@@ -0,0 +1,222 @@
+import concurrent.futures as cf
+import contenedor
+import contextlib
+import io
+import json
+import sys
+import threading
+import time
+
+
+# Clase que sustituye a sys.stdout para que cada hilo pueda redirigir lo que imprime a su propio
+# buffer sin mezclarse con lo que imprimen los demás. Los hilos que no tienen buffer escriben en
+# la salida original.
+#
+class SalidaPorHilo(object):
+    def __init__(self, original):
+        super(SalidaPorHilo, self).__init__()
+        self.original = original
+        self.local = threading.local()
+
+    def destino(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return self.original if buffer is None else buffer
+
+    def write(self, texto):
+        return self.destino().write(texto)
+
+    def flush(self):
+        return self.destino().flush()
+
+    def __getattr__(self, nombre):
+        return getattr(self.original, nombre)
+
+
+# Funcion que instala SalidaPorHilo como sys.stdout (o sys.stderr) si no lo está ya.
+# Parámetros:
+#	nombre: 'stdout' o 'stderr'.
+# Return: la salida instalada.
+#
+def instalar_salida(nombre='stdout'):
+    if not isinstance(getattr(sys, nombre), SalidaPorHilo):
+        setattr(sys, nombre, SalidaPorHilo(getattr(sys, nombre)))
+    return getattr(sys, nombre)
+
+
+# Gestor de contexto que hace que lo que imprime el hilo actual por sys.stdout vaya a su salida de
+# errores, sin cambiar la salida de los demás hilos (por ejemplo, las otras órdenes del agente).
+#
+@contextlib.contextmanager
+def salida_a_errores():
+    salida = instalar_salida('stdout')
+    anterior = getattr(salida.local, 'buffer', None)
+    salida.local.buffer = sys.stderr
+    try:
+        yield
+    finally:
+        salida.local.buffer = anterior
+
+
+# Funcion que ejecuta una tarea del lote sin dejar que sus errores detengan el resto del lote.
+# Se considera que la tarea ha fallado si lanza una excepción, si llama a sys.exit o si
+# devuelve False.
+# Parámetros:
+#	funcion: tarea que se quiere ejecutar.
+#	args: tupla con los argumentos de la tarea.
+# Return: tupla con True si la tarea ha terminado correctamente y el mensaje de error, si lo hay.
+#
+def ejecutar(funcion, args):
+    try:
+        return funcion(*args) is not False, None
+    except SystemExit as e:
+        return False, 'la tarea ha terminado con código ' + str(e.code)
+    except Exception as e:
+        return False, type(e).__name__ + ': ' + str(e)
+
+
+# Funcion que ejecuta una tarea del lote guardando todo lo que imprime, para poder mostrarlo
+# después en orden aunque las tareas se ejecuten en paralelo.
+# Parámetros:
+#	funcion: tarea que se quiere ejecutar.
+#	args: tupla con los argumentos de la tarea.
+# Return: tupla con True si la tarea ha terminado correctamente, lo que ha impreso y el mensaje de
+# error, si lo hay.
+#
+def ejecutar_capturando(funcion, args):
+    salida = instalar_salida()
+    buffer = io.StringIO()
+    salida.local.buffer = buffer
+    try:
+        correcto, error = ejecutar(funcion, args)
+    finally:
+        salida.local.buffer = None
+    return correcto, buffer.getvalue(), error
+
+
+# Funcion que ejecuta una misma tarea sobre una lista de ficheros. Con más de un trabajo, las
+# tareas se reparten entre un conjunto de procesos (para las tareas que son sobre todo cifrado) o
+# de hilos (para las que son sobre todo esperas de red), y lo que imprime cada una se muestra
+# completo y en el mismo orden en el que se pasaron los ficheros.
+# Parámetros:
+#	funcion: tarea que se quiere ejecutar. Debe ser una función de nivel de módulo.
+#	lista_args: lista con la tupla de argumentos de cada tarea.
+#	jobs: número de tareas que se ejecutan a la vez.
+#	procesos: True para usar procesos en lugar de hilos.
+# Return: número de tareas que han fallado.
+#
+def ejecutar_lote(funcion, lista_args, jobs=1, procesos=False):
+    resultados = []
+
+    if jobs <= 1:
+        for args in lista_args:
+            correcto, error = ejecutar(funcion, args)
+            if error:
+                print('Error: ' + error)
+            resultados.append(correcto)
+    else:
+        # Los procesos se arrancan como los de contenedor.mapear_en_orden, sin hacer fork si hay
+        # otros hilos en marcha (por ejemplo en el agente).
+        if procesos:
+            pool = cf.ProcessPoolExecutor(max_workers = jobs, mp_context = contenedor.contexto_procesos())
+        else:
+            pool = cf.ThreadPoolExecutor(max_workers = jobs)
+        with pool:
+            futuros = [pool.submit(ejecutar_capturando, funcion, args) for args in lista_args]
+            for futuro in futuros:
+                correcto, salida, error = futuro.result()
+                sys.stdout.write(salida)
+                if error:
+                    print('Error: ' + error)
+                resultados.append(correcto)
+
+    fallos = resultados.count(False)
+    print(str(len(resultados)) + ' ficheros procesados, ' + str(fallos) + ' con errores.')
+    return fallos
+
+
+# Funcion que ejecuta un trabajo de un manifiesto y genera su resultado. Lo que imprime la tarea se
+# guarda y solo se incluye en el resultado si falla, para que sirva para ver la causa.
+# Parámetros:
+#	funcion: tarea que se quiere ejecutar, que recibe el trabajo y los argumentos extra.
+#	numero: número de la línea del trabajo en el manifiesto.
+#	linea: línea del manifiesto con el trabajo en JSON.
+#	args: tupla con los argumentos extra de la tarea.
+# Return: diccionario con el resultado del trabajo.
+#
+def ejecutar_trabajo(funcion, numero, linea, args):
+    inicio = time.perf_counter()
+    resultado = {'line': numero}
+    salida = instalar_salida()
+    anterior = getattr(salida.local, 'buffer', None)
+    buffer = io.StringIO()
+    salida.local.buffer = buffer
+    try:
+        trabajo = json.loads(linea)
+        if not isinstance(trabajo, dict):
+            raise ValueError('el trabajo debe ser un objeto JSON')
+        if 'id' in trabajo:
+            resultado['id'] = trabajo['id']
+        resultado['action'] = trabajo.get('action')
+        valor = funcion(trabajo, *args)
+        resultado['ok'] = valor is not False
+        if valor is not None and not isinstance(valor, bool):
+            resultado['result'] = valor
+    except SystemExit as e:
+        resultado['ok'] = False
+        resultado['error'] = 'la tarea ha terminado con código ' + str(e.code)
+    except Exception as e:
+        resultado['ok'] = False
+        resultado['error'] = type(e).__name__ + ': ' + str(e)
+    finally:
+        salida.local.buffer = anterior
+
+    resultado['seconds'] = round(time.perf_counter() - inicio, 6)
+    if not resultado['ok'] and buffer.getvalue():
+        resultado['output'] = buffer.getvalue()
+    return resultado
+
+
+# Funcion que ejecuta los trabajos de un manifiesto: un fichero JSONL con un trabajo (una acción y
+# sus parámetros) por línea. Los trabajos se leen a medida que se ejecutan, con como mucho
+# 2 * jobs pendientes a la vez, de modo que la memoria usada no depende del tamaño del manifiesto,
+# y se ejecutan en hilos del mismo proceso, que comparten la clave privada, la sesión HTTP y la
+# caché de claves públicas. El resultado de cada trabajo se escribe en cuanto termina, como una
+# línea JSON con el número de línea del trabajo, si ha ido bien y el tiempo que ha tardado.
+# Parámetros:
+#	funcion: tarea que ejecuta cada trabajo. Recibe el trabajo (diccionario) y los argumentos
+#	extra, y devuelve False si ha fallado o el valor que se quiere incluir en el resultado.
+#	lineas: iterador con las líneas del manifiesto.
+#	salida: fichero en el que se escriben los resultados.
+#	jobs: número de trabajos que se ejecutan a la vez.
+#	args: tupla con los argumentos extra de la tarea.
+# Return: tupla con el número de trabajos y el número de trabajos que han fallado.
+#
+def ejecutar_manifiesto(funcion, lineas, salida, jobs=1, args=()):
+    total = [0, 0]
+
+    def escribir(resultado):
+        salida.write(json.dumps(resultado) + '\n')
+        salida.flush()
+        total[0] += 1
+        if not resultado['ok']:
+            total[1] += 1
+
+    trabajos = ((numero, linea) for numero, linea in enumerate(lineas, 1) if linea.strip())
+
+    if jobs <= 1:
+        for numero, linea in trabajos:
+            escribir(ejecutar_trabajo(funcion, numero, linea, args))
+        return tuple(total)
+
+    with cf.ThreadPoolExecutor(max_workers = jobs) as pool:
+        pendientes = set()
+        for numero, linea in trabajos:
+            pendientes.add(pool.submit(ejecutar_trabajo, funcion, numero, linea, args))
+            if len(pendientes) >= 2 * jobs:
+                hechos, pendientes = cf.wait(pendientes, return_when = cf.FIRST_COMPLETED)
+                for futuro in hechos:
+                    escribir(futuro.result())
+        for futuro in cf.as_completed(pendientes):
+            escribir(futuro.result())
+
+    return tuple(total)
@@ -0,0 +1,371 @@
+from Crypto import Random
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util.Padding import pad
+import contenedor
+import crypt as cr
+import hashing
+import localApi
+import requests
+import utils
+import argparse as arg
+import os
+import tempfile
+import time
+import tuberia
+
+MB = 1024 * 1024
+
+
+# Funcion que cifra un fichero con el bucle original de encriptar, que lee y cifra 16 bytes en
+# cada iteración. Se mantiene únicamente como referencia para las comparaciones.
+# Parámetros:
+#	inp: fichero abierto en modo binario con el texto en claro.
+#	outp: fichero abierto en modo binario donde se escribe el texto cifrado.
+#	aes: cifrador AES ya inicializado.
+#
+def cifrar_bucle_original(inp, outp, aes):
+    read_s = 16
+    buf = inp.read(read_s)
+    while len(buf) != 0:
+        if(len(buf) < 16):
+            buf = pad(buf, 16)
+        outp.write(aes.encrypt(buf))
+        buf = inp.read(read_s)
+
+
+# Funcion que crea un fichero temporal con datos aleatorios.
+# Parámetros:
+#	size: tamaño del fichero en bytes.
+# Return: dirección del fichero creado.
+#
+def crear_fichero_prueba(size):
+    fd, path = tempfile.mkstemp(prefix='securebox_bench_')
+    with os.fdopen(fd, 'wb') as outp:
+        restante = size
+        while restante > 0:
+            n = min(restante, 16 * MB)
+            outp.write(os.urandom(n))
+            restante -= n
+    return path
+
+
+# Funcion que calcula el throughput en MB/s de una operación sobre un número de bytes.
+# Parámetros:
+#	size: bytes procesados.
+#	segundos: tiempo empleado.
+# Return: MB/s.
+#
+def throughput(size, segundos):
+    return (size / MB) / max(segundos, 1e-9)
+
+
+# Funcion que compara el cifrado AES-CBC del bucle original con el de cifrar_bloques para distintos
+# tamaños de buffer, comprobando que los ficheros generados son idénticos.
+# Parámetros:
+#	size_mb: tamaño en MB del fichero de prueba.
+#	chunk_sizes: tamaños de buffer que se quieren medir.
+#
+def benchmark_cifrado(size_mb, chunk_sizes):
+    # Se añaden 5 bytes para que el último bloque necesite padding, como en el bucle original.
+    size = int(size_mb * MB) + 5
+    key = Random.new().read(32)
+    iv = Random.new().read(AES.block_size)
+    entrada = crear_fichero_prueba(size)
+    referencia = entrada + '.orig'
+    salida = entrada + '.enc'
+    descifrado = entrada + '.dec'
+
+    print('Fichero de prueba: ' + str(size) + ' bytes')
+
+    try:
+        inicio = time.perf_counter()
+        with open(entrada, 'rb') as inp, open(referencia, 'wb') as outp:
+            cifrar_bucle_original(inp, outp, AES.new(key, AES.MODE_CBC, iv))
+        base = throughput(size, time.perf_counter() - inicio)
+        print('%-24s %10.1f MB/s' % ('bucle original (16 B)', base))
+
+        for chunk in chunk_sizes:
+            inicio = time.perf_counter()
+            with open(entrada, 'rb') as inp, open(salida, 'wb') as outp:
+                for buf in cr.cifrar_bloques(inp, AES.new(key, AES.MODE_CBC, iv), chunk):
+                    outp.write(buf)
+            cifrado = throughput(size, time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            with open(salida, 'rb') as inp, open(descifrado, 'wb') as outp:
+                for buf in cr.descifrar_bloques(inp, AES.new(key, AES.MODE_CBC, iv), chunk):
+                    outp.write(buf)
+            descifra = throughput(size, time.perf_counter() - inicio)
+
+            with open(referencia, 'rb') as a, open(salida, 'rb') as b:
+                identico = a.read() == b.read()
+            with open(entrada, 'rb') as a, open(descifrado, 'rb') as b:
+                identico = identico and a.read() == b.read()
+
+            print('%-24s %10.1f MB/s cifrado, %10.1f MB/s descifrado (x%.1f) %s' % (
+                'buffer de ' + str(chunk // 1024) + ' KiB', cifrado, descifra,
+                cifrado / base, 'OK' if identico else 'DISTINTO'))
+    finally:
+        for f in (entrada, referencia, salida, descifrado):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+# Funcion que mide cómo escala con el número de procesos el cifrado por trozos con AES-GCM
+# (formato 'gcm'), comparado con el cifrado AES-CBC del formato original, que no se puede repartir.
+# Comprueba además que el fichero descifrado es idéntico al original.
+# Parámetros:
+#	size_mb: tamaño en MB del fichero de prueba.
+#	chunk_size: tamaño de los trozos.
+#	max_workers: número máximo de procesos (por defecto, el número de núcleos).
+#
+def benchmark_paralelo(size_mb, chunk_size, max_workers=None):
+    size = int(size_mb * MB)
+    max_workers = max_workers or os.cpu_count() or 1
+    key = Random.new().read(32)
+    prefijo = Random.new().read(8)
+    cabecera = b'benchmark'
+    entrada = crear_fichero_prueba(size)
+    salida = entrada + '.enc'
+    descifrado = entrada + '.dec'
+
+    print('Fichero de prueba: ' + str(size) + ' bytes, trozos de ' + str(chunk_size // 1024) + ' KiB, ' + str(os.cpu_count()) + ' núcleos')
+
+    try:
+        inicio = time.perf_counter()
+        with open(entrada, 'rb') as inp:
+            for buf in cr.cifrar_bloques(inp, AES.new(key, AES.MODE_CBC, key[:16]), chunk_size):
+                pass
+        base = throughput(size, time.perf_counter() - inicio)
+        print('%-24s %10.1f MB/s cifrado' % ('cbc (secuencial)', base))
+
+        workers = 1
+        while True:
+            inicio = time.perf_counter()
+            with open(entrada, 'rb') as inp, open(salida, 'wb') as outp:
+                for buf in contenedor.cifrar_registros(inp, key, prefijo, cabecera, chunk_size, workers = workers):
+                    outp.write(buf)
+            cifrado = throughput(size, time.perf_counter() - inicio)
+
+            inicio = time.perf_counter()
+            with open(salida, 'rb') as inp, open(descifrado, 'wb') as outp:
+                for tipo, buf in contenedor.descifrar_registros(inp, key, prefijo, cabecera, chunk_size, workers = workers):
+                    outp.write(buf)
+            descifra = throughput(size, time.perf_counter() - inicio)
+
+            with open(entrada, 'rb') as a, open(descifrado, 'rb') as b:
+                identico = a.read() == b.read()
+
+            print('%-24s %10.1f MB/s cifrado, %10.1f MB/s descifrado (x%.1f sobre cbc) %s' % (
+                'gcm, ' + str(workers) + ' proceso(s)', cifrado, descifra, cifrado / base,
+                'OK' if identico else 'DISTINTO'))
+
+            if workers >= max_workers:
+                break
+            workers = min(workers * 2, max_workers)
+    finally:
+        for f in (entrada, salida, descifrado):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+# Funcion que saca un fichero de la caché del sistema, para medir lecturas desde el disco.
+# Parámetros:
+#	file: dirección del fichero.
+#
+def vaciar_cache(file):
+    with open(file, 'rb+') as f:
+        os.fsync(f.fileno())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+# Funcion que mide, con la caché vacía, el tiempo de copiar un fichero (solo entrada/salida), el de
+# cifrarlo en memoria (solo CPU), el del cifrado secuencial con cifrar_bloques y el de la tubería de
+# tuberia.py, que solapa la lectura, el cifrado y la escritura. Con la tubería el tiempo debería
+# acercarse al mayor de los dos primeros en lugar de a su suma. Comprueba además que los dos
+# cifrados producen el mismo fichero.
+# Parámetros:
+#	size_mb: tamaño en MB del fichero de prueba.
+#	chunk_size: tamaño de los bloques.
+#
+def benchmark_tuberia(size_mb, chunk_size):
+    size = int(size_mb * MB) + 5
+    key = Random.new().read(32)
+    iv = Random.new().read(AES.block_size)
+    entrada = crear_fichero_prueba(size)
+    secuencial = entrada + '.sec'
+    salida = entrada + '.enc'
+
+    print('Fichero de prueba: ' + str(size) + ' bytes, bloques de ' + str(chunk_size // 1024) + ' KiB')
+
+    def medir(operacion, file):
+        vaciar_cache(entrada)
+        inicio = time.perf_counter()
+        with open(entrada, 'rb') as inp, open(file, 'wb') as outp:
+            operacion(inp, outp)
+            outp.flush()
+            os.fsync(outp.fileno())
+        return time.perf_counter() - inicio
+
+    def copiar(inp, outp):
+        buf = bytearray(chunk_size)
+        n = inp.readinto(buf)
+        while n:
+            outp.write(memoryview(buf)[:n])
+            n = inp.readinto(buf)
+
+    def cifrar_secuencial(inp, outp):
+        for buf in cr.cifrar_bloques(inp, AES.new(key, AES.MODE_CBC, iv), chunk_size):
+            outp.write(buf)
+
+    def cifrar_tuberia(inp, outp):
+        tuberia.procesar(inp, outp, cr.cifrador_cbc(AES.new(key, AES.MODE_CBC, iv), chunk_size), chunk_size)
+
+    try:
+        copia = medir(copiar, salida)
+
+        buf = bytearray(chunk_size)
+        aes = AES.new(key, AES.MODE_CBC, iv)
+        inicio = time.perf_counter()
+        for i in range(size // chunk_size):
+            aes.encrypt(buf, output = buf)
+        cpu = time.perf_counter() - inicio
+
+        serie = medir(cifrar_secuencial, secuencial)
+        solapado = medir(cifrar_tuberia, salida)
+
+        with open(secuencial, 'rb') as a, open(salida, 'rb') as b:
+            identico = a.read() == b.read()
+
+        print('%-28s %8.2f s' % ('copia (entrada/salida)', copia))
+        print('%-28s %8.2f s' % ('cifrado en memoria (CPU)', cpu))
+        print('%-28s %8.2f s (max %.2f s, suma %.2f s)' % ('cifrar_bloques (secuencial)', serie, max(copia, cpu), copia + cpu))
+        print('%-28s %8.2f s (x%.2f) %s' % ('tuberia.procesar', solapado, serie / solapado, 'OK' if identico else 'DISTINTO'))
+    finally:
+        for f in (entrada, secuencial, salida):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+# Funcion que calcula el hash de un fichero con el bucle original de create_hash, que lee 1 KiB en
+# cada iteración. Se mantiene únicamente como referencia para las comparaciones.
+# Parámetros:
+#	file: dirección del fichero.
+# Return: resumen hash del fichero.
+#
+def hash_bucle_original(file):
+    read_s = 1024
+    hash_code = SHA256.new()
+    with open(file, 'rb') as inp:
+        buf = inp.read(read_s)
+        while len(buf) != 0:
+            hash_code.update(buf)
+            buf = inp.read(read_s)
+    return hash_code
+
+
+# Funcion que mide el throughput en GB/s de cada implementación de SHA256 disponible, mapeando el
+# fichero en memoria y leyéndolo por bloques, sobre ficheros locales (que se leen antes una vez
+# para que estén en la caché del sistema).
+# Parámetros:
+#	files: ficheros sobre los que medir. Si está vacío se crea uno aleatorio de size_mb MB.
+#	size_mb: tamaño en MB del fichero de prueba.
+#
+def benchmark_hash(files, size_mb):
+    temporal = None
+    if not files:
+        temporal = crear_fichero_prueba(int(size_mb * MB))
+        files = [temporal]
+
+    try:
+        for file in files:
+            size = os.path.getsize(file)
+            referencia = hashing.hash_file(file).hexdigest()
+            print(file + ': ' + str(size) + ' bytes')
+
+            inicio = time.perf_counter()
+            identico = hash_bucle_original(file).hexdigest() == referencia
+            segundos = time.perf_counter() - inicio
+            print('  %-28s %8.3f GB/s %s' % ('bucle original (1 KiB)', throughput(size, segundos) / 1024, 'OK' if identico else 'DISTINTO'))
+
+            for backend in sorted(hashing.BACKENDS):
+                for usar_mmap in (True, False):
+                    inicio = time.perf_counter()
+                    identico = hashing.hash_file(file, backend, usar_mmap).hexdigest() == referencia
+                    segundos = time.perf_counter() - inicio
+                    nombre = backend + (' (mmap)' if usar_mmap else ' (bloques)')
+                    if backend == hashing.BACKEND:
+                        nombre += ' *'
+                    print('  %-28s %8.3f GB/s %s' % (nombre, throughput(size, segundos) / 1024, 'OK' if identico else 'DISTINTO'))
+    finally:
+        if temporal:
+            os.remove(temporal)
+
+
+# Funcion que mide cuántas peticiones por segundo se pueden hacer a la API local (localApi.py)
+# abriendo una conexión nueva en cada petición, como hacía genericRequest, y con la sesión
+# compartida de utils, que reutiliza las conexiones.
+# Parámetros:
+#	llamadas: número de peticiones de cada tipo.
+#
+def benchmark_http(llamadas):
+    servidor = localApi.arrancar()
+    url_original = utils.URL
+    utils.URL = servidor.url
+
+    try:
+        cabeceras = {'Authorization': 'Bearer ' + utils.getToken()}
+        clave = cr.getPrivateKey().publickey().exportKey().decode() if os.path.exists('./.files/key.priv') else 'clave'
+        userID = utils.genericRequest('/users/register', {'nombre': 'bench', 'email': 'bench@example.com', 'publicKey': clave}).json()['userID']
+        datos = {'userID': userID}
+
+        inicio = time.perf_counter()
+        for i in range(llamadas):
+            requests.post(servidor.url + '/users/getPublicKey', json=datos, headers=cabeceras).json()
+        base = llamadas / (time.perf_counter() - inicio)
+        print('%-32s %10.1f peticiones/s' % ('requests.post (sin sesión)', base))
+
+        inicio = time.perf_counter()
+        for i in range(llamadas):
+            utils.genericRequest('/users/getPublicKey', datos).json()
+        sesion = llamadas / (time.perf_counter() - inicio)
+        print('%-32s %10.1f peticiones/s (x%.1f)' % ('utils.genericRequest (sesión)', sesion, sesion / base))
+    finally:
+        utils.URL = url_original
+        localApi.parar(servidor)
+
+
+# Funcion que lee los argumentos del terminal y lanza los benchmarks pedidos.
+#
+def main():
+    parser = arg.ArgumentParser(description = 'Benchmarks de SecureBox:')
+    parser.add_argument("--cipher", action = 'store_true', help = 'Comparar el throughput del cifrado por bloques con el bucle original.')
+    parser.add_argument("--hash", nargs = '*', metavar = ('fichero'), help = 'Medir en GB/s cada implementación de SHA256 sobre los ficheros indicados (o sobre uno aleatorio).')
+    parser.add_argument("--http", nargs = '?', type = int, const = 500, metavar = ('llamadas'), help = 'Medir las peticiones por segundo a una API local con y sin la sesión compartida.')
+    parser.add_argument("--parallel", nargs = '?', type = int, const = 0, metavar = ('procesos'), help = 'Medir cómo escala el cifrado por trozos (gcm) con el número de procesos (hasta el número de núcleos, o el indicado).')
+    parser.add_argument("--pipeline", action = 'store_true', help = 'Medir con la cache vacia el cifrado secuencial frente a la tuberia que solapa lectura, cifrado y escritura.')
+    parser.add_argument("--size", nargs = 1, type = float, default = [64], metavar = ('MB'), help = 'Tamaño en MB del fichero de prueba.')
+    parser.add_argument("--chunk_sizes", nargs = '*', type = int, default = [64 * 1024, cr.CHUNK_SIZE, 4 * MB], help = 'Tamaños de buffer (en bytes) que se quieren medir.')
+
+    args = parser.parse_args()
+
+    if args.cipher:
+        benchmark_cifrado(args.size[0], args.chunk_sizes)
+
+    if args.parallel is not None:
+        benchmark_paralelo(args.size[0], cr.CHUNK_SIZE, args.parallel)
+
+    if args.pipeline:
+        benchmark_tuberia(args.size[0], cr.CHUNK_SIZE)
+
+    if args.hash is not None:
+        benchmark_hash(args.hash, args.size[0])
+
+    if args.http:
+        benchmark_http(args.http)
+
+
+if __name__ == '__main__':
+    main()
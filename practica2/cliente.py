@@ -0,0 +1,456 @@
+from errores import SecureBoxError, APIError, NetworkError, PrivateKeyError, SignatureError, FormatError
+import archivo
+import batch
+import crypt as cr
+import filesGestion as fg
+import identityGestion as ig
+import requests
+import utils
+import vigilancia
+import contextlib
+import copy
+import io
+import os
+import shutil
+import tempfile
+import time
+
+# Cliente de SecureBox para usar desde otros programas de Python sin lanzar read.py: cada operación
+# es un método que acepta rutas o ficheros abiertos (flujos binarios), devuelve un diccionario con
+# el resultado y lanza las excepciones de errores.py en lugar de imprimir el error. La clave
+# privada, la caché de claves públicas y la sesión HTTP son del proceso (crypt.py,
+# identityGestion.py y utils.py), por lo que un servicio que mantiene un cliente las reutiliza en
+# todas sus operaciones. read.py usa este mismo cliente.
+#
+# Como el resto de SecureBox, el cliente trabaja en el directorio actual: la clave y las bases de
+# datos están en ./.files y los ficheros se guardan por defecto en ./encriptado y ./downloads.
+
+DIRECTORIOS = ('./.files/', './encriptado/', './downloads/')
+
+
+# Funcion que crea, si no existen, los directorios de trabajo de SecureBox.
+#
+def crear_directorios():
+    for directorio in DIRECTORIOS:
+        os.makedirs(directorio, exist_ok = True)
+
+
+# Funcion que indica si un origen o destino de una operación es una ruta o un fichero abierto.
+# Parámetros:
+#	fichero: ruta o fichero abierto.
+# Return: True si es una ruta.
+#
+def es_ruta(fichero):
+    return isinstance(fichero, (str, os.PathLike))
+
+
+# Funcion que abre una ruta o, si ya es un fichero abierto, lo usa tal cual (sin cerrarlo al
+# terminar).
+# Parámetros:
+#	fichero: ruta o fichero abierto en modo binario.
+#	modo: modo en el que se abre la ruta.
+# Return: gestor de contexto con el fichero abierto.
+#
+@contextlib.contextmanager
+def abrir(fichero, modo):
+    if es_ruta(fichero):
+        with open(fichero, modo) as f:
+            yield f
+    else:
+        yield fichero
+
+
+# Funcion que da la ruta de un origen, guardando antes en un fichero temporal los flujos, para las
+# operaciones que necesitan leer el fichero por su nombre (o más de una vez).
+# Parámetros:
+#	origen: ruta o fichero abierto en modo binario.
+# Return: gestor de contexto con la ruta, que borra el fichero temporal al terminar.
+#
+@contextlib.contextmanager
+def como_ruta(origen):
+    if es_ruta(origen):
+        yield os.fspath(origen)
+        return
+
+    fd, temp = tempfile.mkstemp(dir = './.files/', prefix = '.stream')
+    try:
+        with os.fdopen(fd, 'wb') as outp:
+            shutil.copyfileobj(origen, outp, cr.CHUNK_SIZE)
+        yield temp
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# Funcion que copia un fichero ya verificado en su destino: lo mueve si el destino es una ruta o lo
+# copia y lo borra si es un fichero abierto.
+# Parámetros:
+#	fichero: dirección del fichero verificado.
+#	destino: ruta o fichero abierto en modo binario.
+# Return: dirección final del fichero, o None si se ha copiado en un fichero abierto.
+#
+def entregar(fichero, destino):
+    if es_ruta(destino):
+        if os.path.abspath(fichero) != os.path.abspath(destino):
+            shutil.move(fichero, destino)
+        return os.fspath(destino)
+
+    try:
+        with open(fichero, 'rb') as inp:
+            shutil.copyfileobj(inp, destino, cr.CHUNK_SIZE)
+    finally:
+        os.remove(fichero)
+    return None
+
+
+# Funcion que guarda el resultado de una operación que verifica una firma. Si el destino es una
+# ruta, crypt.verificar_stream escribe en un fichero temporal que solo se renombra si la firma es
+# correcta; si es un flujo, los datos se escriben en él a medida que se verifican, por lo que
+# quien lo use debe descartarlos si se lanza SignatureError.
+# Parámetros:
+#	verificar: función que recibe el destino (dirección o fichero abierto), escribe en él el
+#	resultado y devuelve True si la firma es correcta.
+#	destino: ruta o fichero abierto en modo binario.
+#	source_id: id en SecureBox del emisor, para el mensaje de error.
+#	modificados: lista en la que la verificación añade los trozos modificados, o None.
+# Return: dirección final del fichero, o None si el destino es un fichero abierto. Si la firma no
+# es correcta se lanza SignatureError.
+#
+def guardar_verificado(verificar, destino, source_id, modificados=None):
+    if not verificar(os.fspath(destino) if es_ruta(destino) else destino):
+        if modificados:
+            lista = ', '.join(str(i) for i in modificados[:20]) + (', ...' if len(modificados) > 20 else '')
+            raise SignatureError('se han modificado ' + str(len(modificados)) + ' trozos del fichero: ' + lista + '.', modificados)
+        raise SignatureError('el fichero ha sido modificado o no lo ha enviado ' + source_id + '.')
+    return os.fspath(destino) if es_ruta(destino) else None
+
+
+# Clase que permite usar SecureBox desde otros programas.
+# Parámetros del constructor:
+#	url: URL de la API (por defecto la de utils.URL). Se cambia para todo el proceso.
+#	formato: formato de cifrado, 'cbc' o 'gcm' (el de crypt.FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (el de crypt.COMPRESION si es None).
+#	workers: número de procesos entre los que se reparten los trozos de cada fichero en el
+#	formato 'gcm' (el de contenedor.WORKERS si es None).
+#	verbose: True para dejar que las operaciones muestren su progreso por la salida estándar,
+#	como en read.py. Si es False se descarta (solo en el hilo de la operación).
+#
+class SecureBoxClient(object):
+    def __init__(self, url=None, formato=None, compresion=None, verbose=False, workers=None):
+        super(SecureBoxClient, self).__init__()
+        if url:
+            utils.URL = url
+        self.formato = formato
+        self.compresion = compresion
+        self.workers = workers
+        self.verbose = verbose
+        crear_directorios()
+
+    # Devuelve un cliente como este pero con otro formato, compresión o número de procesos (los que
+    # no son None), sin volver a preparar los directorios de trabajo. Sirve para cambiarlos en una
+    # operación sin afectar a las que se hacen a la vez con este cliente.
+    # Return: el nuevo cliente.
+    def with_options(self, formato=None, compresion=None, workers=None):
+        otro = copy.copy(self)
+        if formato is not None:
+            otro.formato = formato
+        if compresion is not None:
+            otro.compresion = compresion
+        if workers is not None:
+            otro.workers = workers
+        return otro
+
+    # Gestor de contexto que rodea cada operación: descarta lo que imprime (salvo con verbose) y
+    # convierte los errores de conexión y de formato en las excepciones de errores.py.
+    @contextlib.contextmanager
+    def _operacion(self):
+        if not self.verbose:
+            salidas = [batch.instalar_salida('stdout'), batch.instalar_salida('stderr')]
+            anteriores = [getattr(salida.local, 'buffer', None) for salida in salidas]
+            for salida in salidas:
+                salida.local.buffer = io.StringIO()
+
+        try:
+            yield
+        except SecureBoxError:
+            raise
+        except requests.RequestException as e:
+            raise NetworkError(str(e)) from e
+        except ValueError as e:
+            raise FormatError(str(e)) from e
+        finally:
+            if not self.verbose:
+                for salida, anterior in zip(salidas, anteriores):
+                    salida.local.buffer = anterior
+
+    # Registra un usuario nuevo en SecureBox, generando su par de claves.
+    # Return: diccionario con el id del usuario ('userID').
+    def register(self, name, email):
+        with self._operacion():
+            r = cr.userRegister(name, email)
+            if r.status_code != 200:
+                raise APIError(r)
+            return {'userID': r.json()['userID']}
+
+    # Firma, cifra y sube un fichero, salvo que ya se haya subido con el mismo contenido para los
+    # mismos destinatarios (ver filesGestion.uploadFileOnce).
+    # Parámetros: origen (ruta o flujo), id o lista de ids de los destinatarios, nombre con el que
+    # se sube (obligatorio con flujos), force y chunked (como --force y --chunked).
+    # Return: diccionario con el id ('file_id') y el nombre ('name') del fichero en SecureBox.
+    def upload(self, source, dest_id, name=None, force=False, chunked=False):
+        if not es_ruta(source) and not name:
+            raise TypeError('Hace falta el nombre (name) para subir un flujo.')
+
+        with self._operacion(), como_ruta(source) as file:
+            name = name or file.split('/')[-1]
+            file_id = fg.uploadFileOnce(file, dest_id, force, chunked = chunked, formato = self.formato,
+                                        compresion = self.compresion, nombre = name, workers = self.workers)
+            return {'file_id': file_id, 'name': name}
+
+    # Vigila una carpeta y sube (como upload) los ficheros que aparecen o se modifican en ella en
+    # cuanto llevan unos segundos sin cambios, hasta que se interrumpe o se activa stop (ver
+    # vigilancia.py). Las subidas pendientes se continúan al volver a vigilar la misma carpeta.
+    # Parámetros: carpeta, id o lista de ids de los destinatarios, jobs (subidas a la vez), poll
+    # (recorrer la carpeta periódicamente en lugar de usar inotify), stop (threading.Event), force
+    # y chunked (como en upload).
+    # Return: diccionario con el número de ficheros subidos ('uploaded') y el de ficheros que han
+    # fallado todos los intentos ('failed').
+    def watch(self, directory, dest_id, jobs=1, poll=False, stop=None, force=False, chunked=False):
+        def subir(file):
+            return self.upload(file, dest_id, force = force, chunked = chunked)['file_id']
+
+        with self._operacion():
+            subidos, fallidos = vigilancia.vigilar(os.fspath(directory), dest_id, subir, jobs, poll, stop)
+            return {'uploaded': subidos, 'failed': fallidos}
+
+    # Descarga un fichero, lo descifra y verifica su firma. Si la firma no es correcta se lanza
+    # SignatureError y no se guarda nada.
+    # Parámetros: id del fichero, id del emisor, destino (ruta o flujo; por defecto
+    # ./downloads/<nombre>) y resume (como --resume).
+    # Return: diccionario con el id ('file_id') y la ruta del fichero ('path', None si el destino
+    # es un flujo).
+    def download(self, file_id, source_id, dest=None, resume=False):
+        with self._operacion():
+            if resume:
+                filename = fg.fileDownloadResumable(file_id, source_id, self.workers)
+            else:
+                filename = fg.fileDownloadVerified(file_id, source_id, self.workers)
+            if not filename:
+                raise SignatureError('el fichero ha sido modificado o no lo ha enviado ' + source_id + '.')
+            return {'file_id': file_id, 'path': entregar(filename, dest or filename)}
+
+    # Sube un directorio entero como un único archivo firmado y cifrado por trozos (ver
+    # archivo.py), con una sola firma y una sola petición a la API.
+    # Parámetros: directorio, id o lista de ids de los destinatarios y nombre con el que se sube
+    # (por defecto, el del directorio con la extensión .tar).
+    # Return: diccionario con el id ('file_id') y el nombre ('name') del archivo en SecureBox.
+    def upload_dir(self, directory, dest_id, name=None):
+        name = name or os.path.basename(os.path.abspath(directory)) + '.tar'
+        with self._operacion():
+            return {'file_id': fg.uploadDir(directory, dest_id, self.compresion, name, self.workers), 'name': name}
+
+    # Descarga un archivo subido con upload_dir y lo extrae a medida que se descifra. Si la firma no
+    # es correcta se lanza SignatureError y no se extrae nada.
+    # Parámetros: id del archivo, id del emisor y directorio de destino (por defecto ./downloads).
+    # Return: diccionario con el id ('file_id') y la lista de carpetas y ficheros extraídos
+    # ('paths').
+    def download_dir(self, file_id, source_id, dest=None):
+        with self._operacion():
+            extraidos = fg.downloadDir(file_id, source_id, os.fspath(dest or './downloads/'), self.workers)
+            if not extraidos:
+                raise SignatureError('el archivo ha sido modificado o no lo ha enviado ' + source_id + '.')
+            return {'file_id': file_id, 'paths': extraidos}
+
+    # Firma y cifra un directorio entero como un archivo local (el mismo que sube upload_dir), que
+    # se puede listar con list_archive y del que se pueden extraer ficheros con extract_member.
+    # Parámetros: directorio, id o lista de ids de los destinatarios y destino (ruta o flujo; por
+    # defecto ./encriptado/<nombre del directorio>.tar).
+    # Return: diccionario con la ruta del archivo cifrado ('path', None si es un flujo) y el
+    # tiempo empleado ('seconds').
+    def encrypt_dir(self, directory, dest_id, dest=None):
+        dest = dest or './encriptado/' + os.path.basename(os.path.abspath(directory)) + '.tar'
+        inicio = time.perf_counter()
+        with self._operacion():
+            try:
+                with archivo.flujo_archivo(os.fspath(directory)) as inp, abrir(dest, 'wb') as outp:
+                    tam, bloques = cr.cifrar_firmar_bloques(inp, dest_id, formato = 'gcm', compresion = self.compresion, workers = self.workers)
+                    print('Cifrando archivo')
+                    for buf in bloques:
+                        outp.write(buf)
+            except BaseException:
+                if es_ruta(dest) and os.path.exists(dest):
+                    os.remove(dest)
+                raise
+            print('OK')
+            return {'path': os.fspath(dest) if es_ruta(dest) else None, 'seconds': time.perf_counter() - inicio}
+
+    # Obtiene el índice de un archivo cifrado local descifrando solo su final (ver archivo.py).
+    # Return: lista con un diccionario por miembro (name, type, size, mtime, mode y offset).
+    def list_archive(self, source):
+        with self._operacion():
+            return archivo.listar_archivo(os.fspath(source))
+
+    # Extrae un fichero de un archivo cifrado local descifrando solo los trozos que lo contienen.
+    # La firma del archivo no se comprueba (cada trozo sigue autenticado por AES-GCM).
+    # Parámetros: archivo cifrado (ruta), nombre del miembro y destino (ruta o flujo; por defecto
+    # ./downloads/<nombre del miembro sin carpetas>).
+    # Return: diccionario con la ruta del fichero extraído ('path', None si es un flujo) y su
+    # entrada del índice ('member').
+    def extract_member(self, source, member, dest=None):
+        dest = dest or './downloads/' + member.split('/')[-1]
+        with self._operacion():
+            try:
+                with abrir(dest, 'wb') as outp:
+                    entrada = archivo.extraer_miembro(os.fspath(source), member, outp)
+            except BaseException:
+                if es_ruta(dest) and os.path.exists(dest):
+                    os.remove(dest)
+                raise
+            return {'path': os.fspath(dest) if es_ruta(dest) else None, 'member': entrada}
+
+    # Elimina un fichero subido a SecureBox.
+    # Return: diccionario con el id del fichero ('file_id').
+    def delete(self, file_id):
+        with self._operacion():
+            r = fg.fileDelete(file_id)
+            if r.status_code != 200:
+                raise APIError(r)
+            return {'file_id': file_id}
+
+    # Cifra un fichero para uno o varios destinatarios, firmándolo antes si se pide. Los flujos se
+    # cifran a medida que se leen, aunque no admitan seek (como una tubería): con firma, en ese
+    # caso la firma se cifra al final (ver crypt.cifrar_firmar_final).
+    # Parámetros: origen (ruta o flujo), id o lista de ids de los destinatarios, destino (ruta o
+    # flujo; por defecto ./encriptado/<nombre>, obligatorio con flujos), sign (como --enc_sign) y
+    # resume (como --resume, solo de una ruta a su destino por defecto y sin firma).
+    # Return: diccionario con la ruta del fichero cifrado ('path', None si es un flujo) y el
+    # tiempo empleado ('seconds').
+    def encrypt(self, source, dest_id, dest=None, sign=False, resume=False):
+        if dest is None and not es_ruta(source):
+            raise TypeError('Hace falta el destino (dest) para cifrar un flujo.')
+        if resume and (sign or dest is not None):
+            raise TypeError('Solo se puede reanudar el cifrado sin firma de una ruta a su destino por defecto.')
+
+        inicio = time.perf_counter()
+        with self._operacion():
+            if dest is None:
+                if sign:
+                    dest = cr.cifrar_firmar(os.fspath(source), dest_id, formato = self.formato, compresion = self.compresion, workers = self.workers)
+                else:
+                    dest = cr.encriptar(os.fspath(source), dest_id, formato = self.formato, compresion = self.compresion, reanudar = resume, workers = self.workers)
+                return {'path': dest, 'seconds': time.perf_counter() - inicio}
+
+            with abrir(dest, 'wb') as outp:
+                if sign:
+                    source = os.fspath(source) if es_ruta(source) else source
+                    tam, bloques = cr.cifrar_firmar_bloques(source, dest_id, formato = self.formato, compresion = self.compresion, workers = self.workers)
+                    print('Cifrando fichero')
+                    for buf in bloques:
+                        outp.write(buf)
+                else:
+                    print('Cifrando fichero')
+                    with abrir(source, 'rb') as inp:
+                        cr.encriptar_stream(inp, outp, dest_id, formato = self.formato, compresion = self.compresion, workers = self.workers)
+            print('OK')
+
+            return {'path': dest if es_ruta(dest) else None, 'seconds': time.perf_counter() - inicio}
+
+    # Descifra un fichero. Con source_id se verifica además su firma (como --decrypt_check): si no
+    # es correcta se lanza SignatureError y no se guarda nada en un destino que sea una ruta (con
+    # un flujo los datos ya se han escrito; ver guardar_verificado). Sin él, el resultado es el
+    # fichero firmado (como --decrypt), o solo un rango de bytes del fichero con byte_range.
+    # El fichero cifrado no se borra.
+    # Parámetros: origen (ruta o flujo; con byte_range debe admitir seek), destino (ruta o flujo;
+    # por defecto en ./downloads, obligatorio con flujos), id del emisor y rango (inicio, fin).
+    # Return: diccionario con la ruta del fichero descifrado ('path', None si es un flujo) y el
+    # tiempo empleado ('seconds').
+    def decrypt(self, source, dest=None, source_id=None, byte_range=None):
+        if dest is None and not es_ruta(source):
+            raise TypeError('Hace falta el destino (dest) para descifrar un flujo.')
+
+        inicio = time.perf_counter()
+        with self._operacion():
+            if source_id is not None:
+                print('Descifrando y verificando fichero')
+                nombre = os.fspath(source).split('/')[-1] if es_ruta(source) else 'stream'
+                modificados = []
+                with abrir(source, 'rb') as inp:
+                    path = guardar_verificado(lambda temp: cr.descifrar_verificar_stream(inp, temp, source_id, modificados = modificados, workers = self.workers),
+                                              dest or './downloads/' + nombre, source_id, modificados)
+
+            elif byte_range is not None:
+                desde, hasta = byte_range
+                if dest is None:
+                    path = cr.desencriptar_rango(os.fspath(source), desde, hasta, self.workers)
+                else:
+                    print('Descifrando rango del fichero')
+                    with abrir(source, 'rb') as inp, abrir(dest, 'wb') as outp:
+                        cr.desencriptar_rango_stream(inp, outp, desde, hasta, self.workers)
+                    print('OK')
+                    path = dest if es_ruta(dest) else None
+
+            else:
+                print('Descifrando fichero')
+                dest = dest or './downloads/' + os.fspath(source).split('/')[-1] + '.unchecked'
+                with abrir(source, 'rb') as inp, abrir(dest, 'wb') as outp:
+                    cr.desencriptar_stream(inp, outp, workers = self.workers)
+                print('OK')
+                path = dest if es_ruta(dest) else None
+
+            return {'path': path, 'seconds': time.perf_counter() - inicio}
+
+    # Firma un fichero con la clave privada del usuario: el resultado es la firma seguida del
+    # fichero o, si el destino no admite seek, el fichero seguido de la firma (ver
+    # crypt.MAGIC_FIRMA_FINAL). Con merkle se firma la raíz del árbol de Merkle de sus trozos (ver
+    # crypt.MAGIC_FIRMA_MERKLE), y entonces el origen debe admitir seek.
+    # Parámetros: origen (ruta o flujo), destino (ruta o flujo; por defecto <origen>.unchecked,
+    # obligatorio con flujos) y merkle (como --merkle).
+    # Return: diccionario con la ruta del fichero firmado ('path', None si es un flujo).
+    def sign(self, source, dest=None, merkle=False):
+        if dest is None and not es_ruta(source):
+            raise TypeError('Hace falta el destino (dest) para firmar un flujo.')
+
+        with self._operacion():
+            if dest is None:
+                return {'path': cr.firmar(os.fspath(source), merkle)}
+
+            print('Firmando fichero')
+            with abrir(source, 'rb') as inp, abrir(dest, 'wb') as outp:
+                cr.firmar_stream(inp, outp, merkle = merkle)
+            print('OK')
+            return {'path': dest if es_ruta(dest) else None}
+
+    # Verifica la firma de un fichero firmado (con la firma delante o al final, o con un árbol de
+    # Merkle) y guarda el fichero sin la firma. Si la firma no es correcta se lanza SignatureError
+    # (con los trozos modificados, si se conocen) y no se guarda nada en un destino que sea una
+    # ruta (ver guardar_verificado). El fichero firmado no se borra.
+    # Parámetros: origen (ruta o flujo), id del emisor y destino (ruta o flujo; por defecto
+    # ./downloads/<nombre>, obligatorio con flujos).
+    # Return: diccionario con la ruta del fichero verificado ('path', None si es un flujo).
+    def verify(self, source, source_id, dest=None):
+        if dest is None and not es_ruta(source):
+            raise TypeError('Hace falta el destino (dest) para verificar un flujo.')
+
+        with self._operacion():
+            key = ig.userGetRSAKey(source_id)
+            print('Verificando firma')
+            dest = dest or './downloads/' + os.fspath(source).split('/')[-1].split('.unchecked')[0]
+            modificados = []
+            with abrir(source, 'rb') as inp:
+                return {'path': guardar_verificado(lambda temp: cr.verificar_stream(cr.leer_bloques(inp), temp, key, modificados = modificados),
+                                                   dest, source_id, modificados)}
+
+    # Obtiene los ficheros propios subidos a SecureBox (ver filesGestion.fileList), con los mismos
+    # filtros que --list_files.
+    # Return: lista con un diccionario por fichero (fileID, fileName, size y date).
+    def list(self, refresh=False, prefix=None, min_size=None, max_size=None):
+        with self._operacion():
+            return list(fg.fileList(refresh, prefix, min_size, max_size))
+
+    # Busca usuarios de SecureBox por su nombre o email, en la copia local del directorio si se
+    # pide o si no se puede acceder a la API (ver identityGestion.userSearch).
+    # Return: lista con un diccionario por usuario (userID, name, email y fingerprint).
+    def search(self, query, offline=False):
+        with self._operacion():
+            return [{'userID': user.ID, 'name': user.name, 'email': user.email, 'fingerprint': user.fingerprint}
+                    for user in ig.userSearch(query, offline)]
@@ -0,0 +1,535 @@
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from collections import deque
+import concurrent.futures as cf
+import hashing
+import itertools
+import lzma
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+
+# Formato de fichero cifrado por trozos (versión 3). La cabecera es la del sobre de crypt.py
+# (número mágico, versión, flags y claves de sesión de cada destinatario) con estos datos propios:
+#	tamaño de trozo (4) | tamaño de la firma (2) | prefijo de los nonces (8)
+# y a continuación una serie de registros, cada uno formado por:
+#	tipo (1) | longitud del texto cifrado (4) | texto cifrado | tag de GCM (16)
+# Cada trozo del fichero se cifra con AES-GCM por separado, con el nonce formado por el prefijo y
+# el número de registro, y con el tipo de registro y el hash de la cabecera como datos
+# autenticados. Así los trozos se pueden cifrar y descifrar en paralelo, y cualquier cambio,
+# reordenación o truncado del fichero se detecta. El último trozo de datos lleva el tipo ULTIMO
+# (aunque esté vacío), y si el fichero está firmado le sigue un registro con la firma, que se
+# calcula mientras se cifra para no tener que leer el fichero dos veces.
+#
+# Al final del fichero se añade un índice, cifrado en un registro de tipo INDICE (con el número
+# de registro NONCE_INDICE), con el tamaño del fichero en claro y la posición de cada registro de
+# datos, seguido del pie:
+#	posición del registro del índice (8) | MAGIC_INDICE (4)
+# Como cada registro de datos contiene exactamente chunk_size bytes del fichero en claro (salvo el
+# último), con el índice se puede descifrar cualquier rango del fichero leyendo solo los registros
+# que lo cubren.
+#
+# Si el fichero se comprime (flags FLAG_ZLIB o FLAG_LZMA), cada trozo se comprime por separado
+# justo antes de cifrarlo, de modo que se siguen pudiendo cifrar en paralelo y descifrar por
+# rangos. La firma se calcula sobre el fichero sin comprimir.
+VERSION = 3
+FLAG_FIRMA = 0x01
+FLAG_INDICE = 0x02
+FLAG_ZLIB = 0x04
+FLAG_LZMA = 0x08
+COMPRESIONES = {'zlib': FLAG_ZLIB, 'lzma': FLAG_LZMA}
+FORMATO_EXTRA = '>IH8s'
+FORMATO_REGISTRO = '>BI'
+FORMATO_PIE = '>Q4s'
+MAGIC_INDICE = b'SBXI'
+TAM_TAG = 16
+
+DATOS = 0
+ULTIMO = 1
+FIRMA = 2
+INDICE = 3
+NONCE_INDICE = 0xFFFFFFFF
+
+# Tamaño máximo de los trozos (el de la cabecera) y de la firma de un fichero que se acepta al
+# descifrarlo, y margen sobre el tamaño de trozo que pueden ocupar de más los trozos que no se
+# reducen al comprimirlos. Las longitudes de los registros se leen antes de poder autenticarlos,
+# así que se comprueban con estos límites para no intentar leer gigabytes de un fichero dañado.
+TAM_MAX_TROZO = 64 * 1024 * 1024
+TAM_MAX_FIRMA = 4096
+MARGEN_COMPRESION = 1024
+
+# Número de procesos entre los que se reparten los trozos de cada fichero. Con menos de
+# MIN_TROZOS_PARALELO trozos no compensa arrancarlos y se cifra en el propio proceso.
+WORKERS = os.cpu_count() or 1
+MIN_TROZOS_PARALELO = 4
+
+# Tamaño de la muestra del principio del fichero con la que se decide si se comprime, y tamaño
+# relativo máximo de la muestra comprimida para que compense comprimir el fichero.
+TAM_MUESTRA = 256 * 1024
+UMBRAL_COMPRESION = 0.9
+
+
+# Funcion que comprime un trozo de datos.
+# Parámetros:
+#	compresion: 'zlib', 'lzma' o None.
+#	datos: datos que se quieren comprimir.
+# Return: datos comprimidos.
+#
+def comprimir(compresion, datos):
+    if compresion == 'zlib':
+        return zlib.compress(datos, 6)
+    if compresion == 'lzma':
+        return lzma.compress(datos, check = lzma.CHECK_NONE)
+    return datos
+
+
+# Funcion que descomprime un trozo de datos sin generar más de maximo bytes, para que un registro
+# pequeño (pero correctamente cifrado por cualquiera que tenga nuestra clave pública) no pueda
+# agotar la memoria al descomprimirse.
+# Parámetros:
+#	compresion: 'zlib', 'lzma' o None.
+#	datos: datos comprimidos.
+#	maximo: tamaño máximo de los datos descomprimidos (el tamaño de trozo del fichero).
+# Return: datos descomprimidos. Lanza ValueError si no son válidos, si ocupan más de maximo bytes
+# o si sobran datos comprimidos.
+#
+def descomprimir(compresion, datos, maximo):
+    if compresion not in COMPRESIONES:
+        return datos
+
+    try:
+        if compresion == 'zlib':
+            d = zlib.decompressobj()
+            resultado = d.decompress(datos, maximo + 1)
+            completo = d.eof and not d.unconsumed_tail and not d.unused_data
+        else:
+            d = lzma.LZMADecompressor()
+            resultado = d.decompress(datos, max_length = maximo + 1)
+            completo = d.eof and not d.unused_data
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError('Trozo comprimido no válido en el fichero cifrado: ' + str(e))
+
+    if len(resultado) > maximo or not completo:
+        raise ValueError('Trozo comprimido no válido en el fichero cifrado.')
+    return resultado
+
+
+# Funcion que obtiene la compresión de un fichero a partir de los flags de su cabecera.
+# Parámetros:
+#	flags: flags del fichero.
+# Return: 'zlib', 'lzma' o None.
+#
+def compresion_flags(flags):
+    for compresion, flag in COMPRESIONES.items():
+        if flags & flag:
+            return compresion
+    return None
+
+
+# Funcion que decide la compresión de un fichero. Con 'auto' se comprime con zlib una muestra del
+# principio del fichero, y solo se comprime si la muestra se reduce al menos hasta
+# UMBRAL_COMPRESION (los ficheros ya comprimidos o cifrados no se reducen).
+# Parámetros:
+#	inp: fichero abierto en modo binario, situado al principio, que se deja en la misma posición.
+#	compresion: 'auto', 'zlib', 'lzma' o None.
+# Return: 'zlib', 'lzma' o None.
+#
+def elegir_compresion(inp, compresion):
+    if compresion != 'auto':
+        return compresion if compresion in COMPRESIONES else None
+
+    if inp.seekable():
+        muestra = leer_exacto(inp, TAM_MUESTRA)
+        inp.seek(-len(muestra), os.SEEK_CUR)
+    else:
+        muestra = inp.peek(TAM_MUESTRA)[:TAM_MUESTRA]
+
+    if muestra and len(zlib.compress(muestra, 6)) <= UMBRAL_COMPRESION * len(muestra):
+        return 'zlib'
+    return None
+
+
+# Funcion que calcula los datos autenticados de un registro, que lo ligan a su tipo y a la
+# cabecera del fichero.
+# Parámetros:
+#	tipo: tipo del registro.
+#	resumen: hash SHA256 de la cabecera del fichero.
+# Return: datos autenticados.
+#
+def aad(tipo, resumen):
+    return bytes([tipo]) + resumen
+
+
+# Funcion que cifra un trozo de datos y genera su registro.
+# Parámetros:
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	resumen: hash SHA256 de la cabecera del fichero.
+#	i: número de registro.
+#	tipo: tipo del registro.
+#	datos: texto en claro.
+#	compresion: compresión de los trozos de datos ('zlib', 'lzma' o None).
+# Return: registro cifrado.
+#
+def cifrar_trozo(key, prefijo, resumen, i, tipo, datos, compresion=None):
+    if tipo in (DATOS, ULTIMO):
+        datos = comprimir(compresion, datos)
+    aes = AES.new(key, AES.MODE_GCM, nonce = prefijo + struct.pack('>I', i))
+    aes.update(aad(tipo, resumen))
+    cifrado, tag = aes.encrypt_and_digest(datos)
+    return struct.pack(FORMATO_REGISTRO, tipo, len(cifrado)) + cifrado + tag
+
+
+# Funcion que descifra un registro y comprueba su tag.
+# Parámetros:
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	resumen: hash SHA256 de la cabecera del fichero.
+#	i: número de registro.
+#	tipo: tipo del registro.
+#	cifrado: texto cifrado seguido del tag.
+#	compresion: compresión de los trozos de datos ('zlib', 'lzma' o None).
+#	chunk_size: tamaño de los trozos del fichero (el de la cabecera), que es lo máximo que puede
+#	ocupar un trozo de datos descomprimido.
+# Return: texto en claro. Lanza ValueError si el registro ha sido modificado.
+#
+def descifrar_trozo(key, prefijo, resumen, i, tipo, cifrado, compresion=None, chunk_size=None):
+    aes = AES.new(key, AES.MODE_GCM, nonce = prefijo + struct.pack('>I', i))
+    aes.update(aad(tipo, resumen))
+    datos = aes.decrypt_and_verify(cifrado[:-TAM_TAG], cifrado[-TAM_TAG:])
+    if tipo in (DATOS, ULTIMO):
+        datos = descomprimir(compresion, datos, chunk_size)
+    return datos
+
+
+# Funcion que obtiene el contexto con el que se arrancan los procesos de mapear_en_orden y los de
+# los lotes de batch.ejecutar_lote. Hacer fork de un proceso con otros hilos en marcha (el agente
+# atiende cada orden en un hilo, y los lotes y la vigilancia suben en hilos) puede copiar cerrojos
+# tomados por esos hilos y bloquear los procesos hijos, así que en ese caso se arrancan desde el
+# servidor de forkserver (o desde cero con spawn si no está disponible).
+# Return: contexto de multiprocessing, o None para usar el de por defecto.
+#
+def contexto_procesos():
+    if threading.current_thread() is threading.main_thread() and threading.active_count() == 1:
+        return None
+    metodos = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in metodos else 'spawn')
+
+
+# Funcion que aplica una función a una serie de tareas repartiéndolas entre varios procesos, y
+# devuelve los resultados en el mismo orden. Solo se mantienen en curso unas pocas tareas por
+# proceso, de modo que la memoria usada no depende del número de tareas.
+# Parámetros:
+#	funcion: función de nivel de módulo que se aplica a cada tarea.
+#	tareas: iterable con las tuplas de argumentos de cada tarea.
+#	workers: número de procesos (WORKERS si es None).
+# Return: generador de los resultados.
+#
+def mapear_en_orden(funcion, tareas, workers=None):
+    workers = WORKERS if workers is None else workers
+    tareas = iter(tareas)
+    primeras = list(itertools.islice(tareas, MIN_TROZOS_PARALELO))
+
+    if workers <= 1 or len(primeras) < MIN_TROZOS_PARALELO:
+        for args in itertools.chain(primeras, tareas):
+            yield funcion(*args)
+        return
+
+    with cf.ProcessPoolExecutor(max_workers = workers, mp_context = contexto_procesos()) as pool:
+        pendientes = deque()
+        for args in itertools.chain(primeras, tareas):
+            pendientes.append(pool.submit(funcion, *args))
+            if len(pendientes) >= 2 * workers:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
+
+
+# Funcion que lee exactamente n bytes de un fichero, salvo al llegar al final, de modo que las
+# lecturas cortas (por ejemplo de tuberías) no cambien el tamaño de los trozos.
+# Parámetros:
+#	inp: fichero abierto en modo binario.
+#	n: número de bytes que se quieren leer.
+# Return: bytes leídos.
+#
+def leer_exacto(inp, n):
+    datos = inp.read(n)
+    if datos is None:
+        datos = b''
+    while len(datos) < n:
+        resto = inp.read(n - len(datos))
+        if not resto:
+            break
+        datos += resto
+    return datos
+
+
+# Funcion que divide un fichero abierto en trozos, marcando el último (que puede estar vacío).
+# Parámetros:
+#	inp: fichero abierto en modo binario.
+#	chunk_size: tamaño de los trozos.
+#	hash_code: hash que se actualiza con cada trozo leído, o None.
+# Return: generador de tuplas (tipo, trozo).
+#
+def trozos(inp, chunk_size, hash_code=None):
+    actual = leer_exacto(inp, chunk_size)
+    while True:
+        if hash_code is not None:
+            hash_code.update(actual)
+        siguiente = leer_exacto(inp, chunk_size) if len(actual) == chunk_size else b''
+        if not siguiente:
+            yield ULTIMO, actual
+            return
+        yield DATOS, actual
+        actual = siguiente
+
+
+# Funcion que calcula la longitud máxima del texto cifrado de un registro.
+# Parámetros:
+#	tipo: tipo del registro (DATOS, ULTIMO o FIRMA).
+#	chunk_size: tamaño de los trozos del fichero (el de la cabecera).
+# Return: longitud máxima en bytes. Lanza ValueError si el tamaño de trozo no es válido.
+#
+def tam_max_registro(tipo, chunk_size):
+    if not 0 < chunk_size <= TAM_MAX_TROZO:
+        raise ValueError('El tamaño de trozo del fichero cifrado no es válido.')
+    if tipo == FIRMA:
+        return TAM_MAX_FIRMA
+    # Con zlib y lzma los datos que no se reducen crecen menos de 5 bytes por cada 16 KiB.
+    return chunk_size + chunk_size // 256 + MARGEN_COMPRESION
+
+
+# Funcion que calcula el número de registros de datos de un fichero.
+# Parámetros:
+#	tam: tamaño del fichero en claro.
+#	chunk_size: tamaño de los trozos.
+# Return: número de registros (al menos uno, aunque el fichero esté vacío).
+#
+def num_trozos(tam, chunk_size):
+    return max(1, -(-tam // chunk_size))
+
+
+# Funcion que calcula el tamaño exacto del cuerpo cifrado (sin la cabecera) de un fichero.
+# Parámetros:
+#	tam: tamaño del fichero en claro.
+#	chunk_size: tamaño de los trozos.
+#	tam_firma: tamaño de la firma, o 0 si el fichero no se firma.
+# Return: tamaño en bytes del cuerpo cifrado, incluyendo el índice. Solo es exacto si el fichero no
+# se comprime.
+#
+def tam_cifrado(tam, chunk_size, tam_firma=0):
+    por_registro = struct.calcsize(FORMATO_REGISTRO) + TAM_TAG
+    n = num_trozos(tam, chunk_size)
+    total = tam + n * por_registro
+    if tam_firma:
+        total += tam_firma + por_registro
+    total += por_registro + 8 * (n + 1) + struct.calcsize(FORMATO_PIE)
+    return total
+
+
+# Funcion que cifra un fichero abierto en registros, repartiendo los trozos entre varios procesos.
+# Parámetros:
+#	inp: fichero abierto en modo binario con el texto en claro.
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	cabecera: cabecera del fichero cifrado.
+#	chunk_size: tamaño de los trozos.
+#	firmar: función que recibe el hash del fichero y devuelve su firma, o None para no firmarlo.
+#	workers: número de procesos (WORKERS si es None).
+#	compresion: compresión de los trozos ('zlib', 'lzma' o None).
+#	reanudar: para continuar un cifrado interrumpido, tupla con las posiciones de los registros
+#	de datos ya escritos y la posición siguiente al último; inp debe estar situado en el trozo
+#	siguiente. No se puede usar si se firma, ya que el hash de los trozos anteriores se ha perdido.
+# Return: generador de los registros cifrados, seguidos del índice y el pie.
+#
+def cifrar_registros(inp, key, prefijo, cabecera, chunk_size, firmar=None, workers=None, compresion=None, reanudar=None):
+    if reanudar and firmar:
+        raise ValueError('No se puede reanudar el cifrado de un fichero firmado.')
+
+    resumen = SHA256.new(cabecera).digest()
+    hash_code = hashing.HashSHA256() if firmar else None
+    posiciones, posicion = reanudar if reanudar else ([], len(cabecera))
+    posiciones = list(posiciones)
+    primero = len(posiciones)
+    tam = [primero * chunk_size]
+
+    def tareas():
+        for i, (tipo, datos) in enumerate(trozos(inp, chunk_size, hash_code), primero):
+            tam[0] += len(datos)
+            yield key, prefijo, resumen, i, tipo, datos, compresion
+
+    for registro in mapear_en_orden(cifrar_trozo, tareas(), workers):
+        posiciones.append(posicion)
+        posicion += len(registro)
+        yield registro
+
+    if firmar:
+        registro = cifrar_trozo(key, prefijo, resumen, len(posiciones), FIRMA, firmar(hash_code))
+        posicion += len(registro)
+        yield registro
+
+    indice = struct.pack('>%dQ' % (len(posiciones) + 1), tam[0], *posiciones)
+    yield cifrar_trozo(key, prefijo, resumen, NONCE_INDICE, INDICE, indice)
+    yield struct.pack(FORMATO_PIE, posicion, MAGIC_INDICE)
+
+
+# Funcion que lee los registros de un fichero cifrado por trozos y comprueba su estructura: que
+# los registros de datos terminan en uno de tipo ULTIMO, que solo le sigue la firma y que el
+# fichero no está truncado. La lectura termina al llegar al índice, que solo se usa para descifrar
+# rangos.
+# Parámetros:
+#	inp: fichero (o flujo) abierto en modo binario, situado tras la cabecera.
+#	chunk_size: tamaño de los trozos del fichero (el de la cabecera).
+# Return: generador de tuplas (número de registro, tipo, texto cifrado con su tag).
+#
+def leer_registros(inp, chunk_size):
+    tam_registro = struct.calcsize(FORMATO_REGISTRO)
+    ultimo = False
+    i = 0
+
+    while True:
+        inicio = leer_exacto(inp, tam_registro)
+        if not inicio:
+            break
+        if len(inicio) < tam_registro:
+            raise ValueError('El fichero cifrado está incompleto.')
+
+        tipo, tam = struct.unpack(FORMATO_REGISTRO, inicio)
+        if ultimo and tipo == INDICE:
+            return
+        if ultimo == (tipo in (DATOS, ULTIMO)) or tipo not in (DATOS, ULTIMO, FIRMA):
+            raise ValueError('Registro inesperado en el fichero cifrado.')
+        if tam > tam_max_registro(tipo, chunk_size):
+            raise ValueError('El fichero cifrado ha sido modificado: registro demasiado largo.')
+
+        cifrado = leer_exacto(inp, tam + TAM_TAG)
+        if len(cifrado) < tam + TAM_TAG:
+            raise ValueError('El fichero cifrado está incompleto.')
+
+        ultimo = ultimo or tipo == ULTIMO
+        yield i, tipo, cifrado
+        i += 1
+
+    if not ultimo:
+        raise ValueError('El fichero cifrado está incompleto.')
+
+
+# Funcion que descifra los registros de un fichero cifrado por trozos, repartiéndolos entre varios
+# procesos.
+# Parámetros:
+#	inp: fichero (o flujo) abierto en modo binario, situado tras la cabecera.
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	cabecera: cabecera del fichero cifrado.
+#	chunk_size: tamaño de los trozos del fichero (el de la cabecera).
+#	workers: número de procesos (WORKERS si es None).
+#	compresion: compresión de los trozos ('zlib', 'lzma' o None).
+# Return: generador de tuplas (tipo, texto en claro). Lanza ValueError si el fichero ha sido
+# modificado.
+#
+def descifrar_registros(inp, key, prefijo, cabecera, chunk_size, workers=None, compresion=None):
+    resumen = SHA256.new(cabecera).digest()
+    registros = deque()
+
+    def tareas():
+        for i, tipo, cifrado in leer_registros(inp, chunk_size):
+            registros.append(tipo)
+            yield key, prefijo, resumen, i, tipo, cifrado, compresion, chunk_size
+
+    for datos in mapear_en_orden(descifrar_trozo, tareas(), workers):
+        yield registros.popleft(), datos
+
+
+# Funcion que lee y descifra el índice de un fichero cifrado por trozos.
+# Parámetros:
+#	inp: fichero abierto en modo binario (debe permitir seek).
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	cabecera: cabecera del fichero cifrado.
+# Return: tupla con el tamaño del fichero en claro y la lista de posiciones de los registros de
+# datos. Lanza ValueError si el fichero no tiene índice o ha sido modificado.
+#
+def leer_indice(inp, key, prefijo, cabecera):
+    tam_pie = struct.calcsize(FORMATO_PIE)
+    tam_registro = struct.calcsize(FORMATO_REGISTRO)
+    fin = inp.seek(0, os.SEEK_END) - tam_pie
+    if fin < tam_registro + TAM_TAG:
+        raise ValueError('El fichero cifrado no tiene índice.')
+    inp.seek(fin)
+    posicion, magic = struct.unpack(FORMATO_PIE, leer_exacto(inp, tam_pie))
+    if magic != MAGIC_INDICE:
+        raise ValueError('El fichero cifrado no tiene índice.')
+    if posicion > fin - tam_registro - TAM_TAG:
+        raise ValueError('El índice del fichero cifrado no es válido.')
+
+    # El registro del índice ocupa exactamente hasta el pie, así que su longitud no puede ser mayor
+    # que lo que queda del fichero.
+    inp.seek(posicion)
+    tipo, tam = struct.unpack(FORMATO_REGISTRO, leer_exacto(inp, tam_registro))
+    if tipo != INDICE or posicion + tam_registro + tam + TAM_TAG != fin:
+        raise ValueError('El índice del fichero cifrado no es válido.')
+
+    resumen = SHA256.new(cabecera).digest()
+    indice = descifrar_trozo(key, prefijo, resumen, NONCE_INDICE, INDICE, leer_exacto(inp, tam + TAM_TAG))
+    valores = struct.unpack('>%dQ' % (len(indice) // 8), indice)
+    return valores[0], list(valores[1:])
+
+
+# Funcion que descifra un rango del fichero en claro leyendo y comprobando solo los registros que
+# lo cubren, a partir del índice del fichero cifrado.
+# Parámetros:
+#	inp: fichero abierto en modo binario (debe permitir seek).
+#	key: clave de sesión.
+#	prefijo: prefijo de los nonces del fichero.
+#	cabecera: cabecera del fichero cifrado.
+#	chunk_size: tamaño de los trozos del fichero (el de la cabecera).
+#	inicio: posición del primer byte del rango.
+#	fin: posición siguiente al último byte del rango, o None para llegar al final del fichero.
+#	workers: número de procesos (WORKERS si es None).
+#	compresion: compresión de los trozos ('zlib', 'lzma' o None).
+# Return: generador de los fragmentos en claro del rango. Lanza ValueError si alguno de los
+# registros leídos ha sido modificado.
+#
+def descifrar_rango(inp, key, prefijo, cabecera, chunk_size, inicio, fin=None, workers=None, compresion=None):
+    tam, posiciones = leer_indice(inp, key, prefijo, cabecera)
+    fin = tam if fin is None else min(fin, tam)
+    if inicio >= fin:
+        return
+
+    tam_max_registro(DATOS, chunk_size)
+    resumen = SHA256.new(cabecera).digest()
+    primero = inicio // chunk_size
+    ultimo = (fin - 1) // chunk_size
+    if ultimo >= len(posiciones):
+        raise ValueError('El índice del fichero cifrado no es válido.')
+
+    def tareas():
+        for k in range(primero, ultimo + 1):
+            inp.seek(posiciones[k])
+            tipo, tam_registro = struct.unpack(FORMATO_REGISTRO, leer_exacto(inp, struct.calcsize(FORMATO_REGISTRO)))
+            if tipo != (ULTIMO if k == len(posiciones) - 1 else DATOS):
+                raise ValueError('Registro inesperado en el fichero cifrado.')
+            if tam_registro > tam_max_registro(tipo, chunk_size):
+                raise ValueError('El fichero cifrado ha sido modificado: registro demasiado largo.')
+            yield key, prefijo, resumen, k, tipo, leer_exacto(inp, tam_registro + TAM_TAG), compresion, chunk_size
+
+    for k, datos in zip(range(primero, ultimo + 1), mapear_en_orden(descifrar_trozo, tareas(), workers)):
+        desde = inicio - k * chunk_size if k == primero else 0
+        hasta = fin - k * chunk_size if k == ultimo else len(datos)
+        yield datos[desde:hasta]
+
+
+# Funcion que separa los datos de la firma en los registros descifrados.
+# Parámetros:
+#	registros: iterable de tuplas (tipo, texto en claro).
+#	firma: bytearray en el que se guarda la firma al llegar a su registro.
+# Return: generador de los trozos de datos.
+#
+def separar_firma(registros, firma):
+    for tipo, datos in registros:
+        if tipo == FIRMA:
+            firma += datos
+        else:
+            yield datos
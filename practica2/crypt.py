@@ -7,18 +7,38 @@ from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Util.Padding import pad, unpad
 import identityGestion as ig
+import contenedor
+import errores
+import hashing
+import io
+import itertools
 import os
+import reanudacion
+import struct
+import tempfile
 import utils
 import time
-import sys
+import tuberia
+
+# Clave privada ya importada y fecha de modificación del fichero del que se leyó, para no volver
+# a leerla e importarla en cada operación mientras el fichero no cambie.
+_priv_key_cache = {'mtime': None, 'key': None}
+
 
 # Funcion que lee e importa la clave privada del usuario a partir del fichero que la contiene.
-# Return: clave privada importada.
+# Return: clave privada importada. Si el usuario aún no tiene clave se lanza PrivateKeyError.
 #
 def getPrivateKey():
 	priv_key = "./.files/key.priv"
-	key = RSA.importKey(open(priv_key).read())
-	return key
+	try:
+		mtime = os.stat(priv_key).st_mtime_ns
+	except FileNotFoundError:
+		raise errores.PrivateKeyError('se debe crear un usuario primero para recibir una clave privada.')
+	if _priv_key_cache['mtime'] != mtime:
+		with open(priv_key) as inp:
+			_priv_key_cache['key'] = RSA.importKey(inp.read())
+		_priv_key_cache['mtime'] = mtime
+	return _priv_key_cache['key']
 
 
 # Funcion que genera un par de claves pública y privada llamando a create_RSA_keys y solicita
@@ -34,109 +54,695 @@ def userRegister(name, email):
     return ig.generateUser(name, email, publicKey)
 
 
+# Tamaño (en bytes) de los bloques que se leen, cifran y escriben de una vez. Debe ser múltiplo
+# del tamaño de bloque de AES. Se puede cambiar en cada llamada con el parámetro chunk_size.
+CHUNK_SIZE = 1024 * 1024
+
+
+# Funcion que lee de un fichero hasta llenar el buffer dado o llegar al final del fichero, de modo
+# que las lecturas cortas (por ejemplo de tuberías) no rompan el alineamiento de los bloques AES.
+# Parámetros:
+#	inp: fichero abierto en modo binario.
+#	buf: memoryview sobre el buffer en el que se leen los datos.
+# Return: número de bytes leídos, que solo es menor que el tamaño del buffer al final del fichero.
+#
+def leer_bloque(inp, buf):
+	total = 0
+	while total < len(buf):
+		n = inp.readinto(buf[total:])
+		if not n:
+			break
+		total += n
+	return total
+
+
+# Funcion que lee un fichero abierto por bloques sobre un único buffer reutilizable.
+# Parámetros:
+#	inp: fichero abierto en modo binario.
+#	chunk_size: tamaño del buffer de lectura.
+# Return: generador de los fragmentos leídos. Cada fragmento es una vista sobre el buffer
+# interno, por lo que debe consumirse antes de pedir el siguiente.
+#
+def leer_bloques(inp, chunk_size=CHUNK_SIZE):
+	buf = memoryview(bytearray(chunk_size))
+	n = leer_bloque(inp, buf)
+	while n != 0:
+		yield buf[:n]
+		n = leer_bloque(inp, buf)
+
+
+# Funcion que cifra con AES un fichero abierto leyendo sobre un único buffer reutilizable, que se
+# cifra en el propio buffer. Solo se aplica padding al último bloque leído.
+# Parámetros:
+#	inp: fichero abierto en modo binario con el texto en claro.
+#	aes: cifrador AES ya inicializado.
+#	chunk_size: tamaño del buffer de lectura.
+# Return: generador de los fragmentos cifrados. Cada fragmento es una vista sobre el buffer
+# interno, por lo que debe consumirse antes de pedir el siguiente.
+#
+def cifrar_bloques(inp, aes, chunk_size=CHUNK_SIZE):
+	if chunk_size <= 0 or chunk_size % AES.block_size != 0:
+		raise ValueError('El tamaño de bloque debe ser múltiplo de ' + str(AES.block_size))
+
+	buf = memoryview(bytearray(chunk_size))
+	n = leer_bloque(inp, buf)
+
+	while n == chunk_size:
+		aes.encrypt(buf, output=buf)
+		yield buf
+		n = leer_bloque(inp, buf)
+
+	yield aes.encrypt(pad(bytes(buf[:n]), AES.block_size))
+
+
+# Funcion que descifra con AES un fichero abierto leyendo sobre un único buffer reutilizable. El
+# último bloque descifrado se retiene hasta llegar al final del fichero para quitarle el padding.
+# Parámetros:
+#	inp: fichero abierto en modo binario con el texto cifrado.
+#	aes: descifrador AES ya inicializado.
+#	chunk_size: tamaño del buffer de lectura.
+# Return: generador de los fragmentos descifrados. Cada fragmento es una vista sobre el buffer
+# interno, por lo que debe consumirse antes de pedir el siguiente.
+#
+def descifrar_bloques(inp, aes, chunk_size=CHUNK_SIZE):
+	if chunk_size <= 0 or chunk_size % AES.block_size != 0:
+		raise ValueError('El tamaño de bloque debe ser múltiplo de ' + str(AES.block_size))
+
+	buf = memoryview(bytearray(chunk_size))
+	ultimo = None
+	n = leer_bloque(inp, buf)
+
+	while n != 0:
+		if n % AES.block_size != 0:
+			raise ValueError('El fichero cifrado está incompleto.')
+		aes.decrypt(buf[:n], output=buf[:n])
+		if ultimo is not None:
+			yield ultimo
+		yield buf[:n - AES.block_size]
+		ultimo = bytes(buf[n - AES.block_size:n])
+		n = leer_bloque(inp, buf)
+
+	if ultimo is None:
+		raise ValueError('El fichero cifrado está vacío.')
+	yield unpad(ultimo, AES.block_size)
+
+
+# Funcion que genera la transformación de tuberia.procesar que cifra con AES-CBC cada bloque en su
+# propio buffer, aplicando padding solo al último (el mismo resultado que cifrar_bloques).
+# Parámetros:
+#	aes: cifrador AES ya inicializado.
+#	chunk_size: tamaño de los bloques, que debe ser múltiplo del tamaño de bloque de AES.
+# Return: función de transformación.
+#
+def cifrador_cbc(aes, chunk_size=CHUNK_SIZE):
+	if chunk_size <= 0 or chunk_size % AES.block_size != 0:
+		raise ValueError('El tamaño de bloque debe ser múltiplo de ' + str(AES.block_size))
+
+	def transformar(buf, ultimo):
+		if ultimo:
+			return aes.encrypt(pad(bytes(buf), AES.block_size))
+		aes.encrypt(buf, output=buf)
+		return buf
+	return transformar
+
+
+# Funcion que genera la transformación de tuberia.procesar que descifra con AES-CBC cada bloque en
+# su propio buffer, quitando el padding del último (el mismo resultado que descifrar_bloques).
+# Parámetros:
+#	aes: descifrador AES ya inicializado.
+#	chunk_size: tamaño de los bloques, que debe ser múltiplo del tamaño de bloque de AES.
+# Return: función de transformación.
+#
+def descifrador_cbc(aes, chunk_size=CHUNK_SIZE):
+	if chunk_size <= 0 or chunk_size % AES.block_size != 0:
+		raise ValueError('El tamaño de bloque debe ser múltiplo de ' + str(AES.block_size))
+
+	def transformar(buf, ultimo):
+		if len(buf) % AES.block_size != 0:
+			raise ValueError('El fichero cifrado está incompleto.')
+		if ultimo and len(buf) == 0:
+			raise ValueError('El fichero cifrado está vacío.')
+		aes.decrypt(buf, output=buf)
+		if ultimo:
+			return unpad(bytes(buf), AES.block_size)
+		return buf
+	return transformar
+
+
+# Formatos de los ficheros cifrados. Los ficheros del formato original (versión 1, un único
+# destinatario) empiezan directamente por el vector de inicialización, por lo que no tienen
+# número mágico; los de versiones posteriores empiezan por la cabecera:
+#	MAGIC (4) | versión (1) | flags (1) | número de destinatarios (2) | datos de la versión |
+#	por cada destinatario: huella de su clave pública (8) | longitud (2) | clave AES cifrada
+# En la versión 2 (sobre para varios destinatarios) los datos de la versión son el IV, y le sigue
+# el mismo cuerpo AES-CBC (firma + fichero) que en el formato original. La versión 3 (cifrado
+# por trozos con AES-GCM) se describe en contenedor.py.
+MAGIC = b'SBOX'
+VERSION_ORIGINAL = 1
+VERSION_SOBRE = 2
+FORMATO_CABECERA = '>4sBBH'
+FORMATO_RANURA = '>8sH'
+TAM_EXTRA = {VERSION_SOBRE: AES.block_size, contenedor.VERSION: struct.calcsize(contenedor.FORMATO_EXTRA)}
+
+# Formato con el que se cifran los ficheros si no se indica otro: 'cbc' (el formato original, o el
+# sobre de la versión 2 si hay varios destinatarios) o 'gcm' (cifrado por trozos, versión 3).
+FORMATO = 'cbc'
+
+# Compresión de los ficheros si no se indica otra: 'none', 'zlib', 'lzma' o 'auto' (zlib si una
+# muestra del fichero se comprime lo suficiente). Solo es posible en el cifrado por trozos.
+COMPRESION = 'none'
+
+# Formatos de los ficheros firmados. En el formato original la firma va delante del fichero
+# (firma | fichero), por lo que hay que leer el fichero entero antes de escribir nada. Cuando la
+# salida no permite seek (por ejemplo una tubería) se usa en su lugar la firma al final:
+#	MAGIC_FIRMA_FINAL (8) | fichero | firma
+# La verificación distingue los formatos por el número mágico.
+MAGIC_FIRMA_FINAL = b'SBOXSIGF'
+
+# Formato de los ficheros firmados con un árbol de Merkle (ver hashing.py). En lugar del hash de
+# todo el fichero se firma la raíz del árbol de los hashes de sus trozos de TAM_HOJA_MERKLE bytes,
+# que se calculan en paralelo, y al verificar se indica qué trozos se han modificado:
+#	MAGIC_FIRMA_MERKLE (8) | versión (1) | tamaño de hoja (4) | tamaño del fichero (8) | firma |
+#	hash de cada trozo (32 por trozo) | fichero
+# Lo que se firma es el hash de la cabecera (del número mágico al tamaño del fichero) seguida de la
+# raíz, de modo que la firma cubre también el tamaño de hoja y del fichero.
+MAGIC_FIRMA_MERKLE = b'SBOXSIGM'
+VERSION_MERKLE = 1
+FORMATO_MERKLE = '>BIQ'
+TAM_HOJA_MERKLE = 1024 * 1024
+
+
+# Funcion que decide el formato y la compresión con los que se cifra un fichero. Como la
+# compresión solo es posible en el cifrado por trozos, pedirla implica el formato 'gcm'.
+# Parámetros:
+#	formato: 'cbc', 'gcm' o None (FORMATO).
+#	compresion: 'none', 'zlib', 'lzma', 'auto' o None (COMPRESION).
+# Return: tupla con el formato y la compresión.
+#
+def elegir_formato(formato=None, compresion=None):
+	formato = formato or FORMATO
+	compresion = compresion or COMPRESION
+	if compresion != 'none':
+		formato = 'gcm'
+	return formato, compresion
+
+
+# Funcion que muestra el tamaño del fichero original y el del cifrado (o el de los datos enviados),
+# con el porcentaje que supone, y el tiempo empleado desde el inicio de la operación.
+# Parámetros:
+#	tam: tamaño del fichero original.
+#	tam_cifrado: tamaño del fichero cifrado.
+#	inicio: instante de inicio de la operación (time.perf_counter()).
+#
+def mostrar_tamanos(tam, tam_cifrado, inicio):
+	porcentaje = ' (%.1f%%)' % (100.0 * tam_cifrado / tam) if tam else ''
+	print('%d -> %d bytes%s en %.2f s' % (tam, tam_cifrado, porcentaje, time.perf_counter() - inicio))
+
+
+# Funcion que calcula la huella de una clave RSA, que identifica en la cabecera de los sobres a
+# qué destinatario corresponde cada clave de sesión cifrada.
+# Parámetros:
+#	key: clave RSA (pública o privada).
+# Return: huella de 8 bytes (los primeros bytes del SHA256 de la clave pública en DER).
+#
+def huella(key):
+	return SHA256.new(key.publickey().exportKey('DER')).digest()[:8]
+
+
+# Funcion que genera la cabecera de un fichero cifrado en las versiones con número mágico,
+# cifrando la clave de sesión con la clave pública de cada destinatario.
+# Parámetros:
+#	version: versión del formato.
+#	flags: flags del fichero.
+#	key: clave de sesión.
+#	dest_ids: lista de ids en SecureBox de los destinatarios.
+#	extra: datos propios de la versión.
+# Return: cabecera.
+#
+def cabecera_sobre(version, flags, key, dest_ids, extra):
+
+	cabecera = [struct.pack(FORMATO_CABECERA, MAGIC, version, flags, len(dest_ids)), extra]
+
+	for dest in dest_ids:
+		dest_key = ig.userGetRSAKey(dest)
+		encrypted_key = PKCS1_OAEP.new(dest_key).encrypt(key)
+		cabecera.append(struct.pack(FORMATO_RANURA, huella(dest_key), len(encrypted_key)))
+		cabecera.append(encrypted_key)
+
+	return b''.join(cabecera)
+
+
+# Funcion que genera una clave simétrica de sesión y la cabecera de los ficheros cifrados. Con un
+# único destinatario la cabecera es la del formato original (el vector de inicialización y la
+# clave cifrada con RSA), para que cualquier cliente de SecureBox pueda descifrarlo; con varios,
+# la clave se cifra con la clave pública de cada uno en el sobre de la versión 2.
+# Parámetros:
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+# Return: tupla con el cifrador AES inicializado y la cabecera.
+#
+def nueva_clave_sesion(dest_id):
+
+	key, iv, cabecera = clave_sesion_cbc(dest_id)
+	return AES.new(key, AES.MODE_CBC, iv), cabecera
+
+
+# Funcion que genera la clave de sesión, el vector de inicialización y la cabecera de los
+# ficheros cifrados con AES-CBC (ver nueva_clave_sesion).
+# Parámetros:
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+# Return: tupla con la clave de sesión, el vector de inicialización y la cabecera.
+#
+def clave_sesion_cbc(dest_id):
+
+	dest_ids = [dest_id] if isinstance(dest_id, str) else list(dest_id)
+
+	tam_iv = AES.block_size
+	iv = Random.new().read(tam_iv)
+
+	if len(dest_ids) == 1:
+		key = str(time.time()) + dest_ids[0]
+		key = key.encode(encoding = 'UTF-8')
+		dest_key = ig.userGetRSAKey(dest_ids[0])
+		key = SHA256.new(key).digest()
+
+		cipher = PKCS1_OAEP.new(dest_key)
+		encrypted_key = cipher.encrypt(key)
+
+		return key, iv, iv + encrypted_key
+
+	key = Random.new().read(32)
+	return key, iv, cabecera_sobre(VERSION_SOBRE, 0, key, dest_ids, iv)
+
+
+# Funcion que genera una clave simétrica de sesión y la cabecera de los ficheros cifrados por
+# trozos (versión 3).
+# Parámetros:
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+#	chunk_size: tamaño de los trozos.
+#	tam_firma: tamaño de la firma, o 0 si el fichero no se firma.
+#	compresion: compresión de los trozos ('zlib', 'lzma' o None).
+# Return: tupla con la clave de sesión, el prefijo de los nonces y la cabecera.
+#
+def nueva_clave_trozos(dest_id, chunk_size, tam_firma=0, compresion=None):
+
+	dest_ids = [dest_id] if isinstance(dest_id, str) else list(dest_id)
+
+	key = Random.new().read(32)
+	prefijo = Random.new().read(8)
+	flags = contenedor.FLAG_INDICE | (contenedor.FLAG_FIRMA if tam_firma else 0)
+	flags |= contenedor.COMPRESIONES.get(compresion, 0)
+	extra = struct.pack(contenedor.FORMATO_EXTRA, chunk_size, tam_firma, prefijo)
+
+	return key, prefijo, cabecera_sobre(contenedor.VERSION, flags, key, dest_ids, extra)
+
+
+# Funcion que lee la cabecera de un fichero cifrado en cualquiera de los formatos y recupera la
+# clave de sesión con la clave privada del usuario. En las versiones con número mágico se busca la
+# clave cifrada cuya huella coincide con la de la clave del usuario.
+# Parámetros:
+#	inp: fichero (o flujo) abierto en modo binario, situado al principio.
+# Return: tupla con la versión, los flags, los datos propios de la versión (el IV en las versiones
+# 1 y 2), la clave de sesión y la cabecera completa, con el flujo situado tras la cabecera.
+#
+def leer_cabecera(inp):
+
+	priv_key = getPrivateKey()
+	cipher = PKCS1_OAEP.new(priv_key)
+
+	def leer(n):
+		datos = contenedor.leer_exacto(inp, n)
+		if len(datos) < n:
+			raise ValueError('La cabecera del fichero cifrado está incompleta.')
+		return datos
+
+	inicio = leer(struct.calcsize(FORMATO_CABECERA))
+
+	if inicio[:len(MAGIC)] != MAGIC:
+		# Formato original: lo leído es el principio del vector de inicialización.
+		iv = inicio + leer(AES.block_size - len(inicio))
+		encrypted_key = leer(priv_key.size_in_bytes())
+		return VERSION_ORIGINAL, 0, iv, cipher.decrypt(encrypted_key), iv + encrypted_key
+
+	magic, version, flags, nslots = struct.unpack(FORMATO_CABECERA, inicio)
+	if version not in TAM_EXTRA:
+		raise ValueError('Versión de formato desconocida: ' + str(version))
+
+	extra = leer(TAM_EXTRA[version])
+	cabecera = [inicio, extra]
+	propia = huella(priv_key)
+	key = None
+
+	for i in range(nslots):
+		ranura = leer(struct.calcsize(FORMATO_RANURA))
+		fp, tam = struct.unpack(FORMATO_RANURA, ranura)
+		encrypted_key = leer(tam)
+		cabecera += [ranura, encrypted_key]
+		if fp == propia:
+			key = cipher.decrypt(encrypted_key)
+
+	if key is None:
+		raise ValueError('El fichero no está cifrado para este usuario.')
+
+	return version, flags, extra, key, b''.join(cabecera)
+
+
 # Funcion que encripta un fichero destinado a un usuario determinado.
 # Parámetros:
 #	file: dirección del fichero que se quiere encriptar.
-#	dest_id: id en SecureBox del detinatario del fichero.
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+#	formato: 'cbc' o 'gcm' (FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (COMPRESION si es None).
+#	reanudar: True para guardar puntos de control y continuar desde el último si se interrumpe
+#	(ver encriptar_reanudable).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
 # Return: dirección del fichero encriptado.
 #
-def encriptar (file, dest_id):
+def encriptar (file, dest_id, chunk_size=CHUNK_SIZE, formato=None, compresion=None, reanudar=False, workers=None):
 
-	outputF = './encriptado/' + file.split('/')[-1].split('.unchecked')[0]
-	read_s = 16
+	if reanudar:
+		return encriptar_reanudable(file, dest_id, chunk_size, formato, compresion, workers)
 
-	key = str(time.time()) + dest_id
-	key = key.encode(encoding = 'UTF-8')
-	dest_key = RSA.importKey(ig.userGetPublickey(dest_id))
-	key = SHA256.new(key).digest()
+	outputF = './encriptado/' + file.split('/')[-1].split('.unchecked')[0]
+	inicio = time.perf_counter()
 
 	print('Cifrando fichero')
 
-	tam_iv = AES.block_size
-	iv = Random.new().read(tam_iv)
-	cipher = PKCS1_OAEP.new(dest_key)
-	encrypted_key = cipher.encrypt(key)
+	with open(file, 'rb') as inp:
+		with open(outputF, 'wb') as outp:
+			encriptar_stream(inp, outp, dest_id, chunk_size, formato, compresion, workers)
+	print('OK')
+	mostrar_tamanos(os.path.getsize(file), os.path.getsize(outputF), inicio)
+	return outputF
 
-	
 
-	aes = AES.new(key, AES.MODE_CBC, iv)
+# Funcion que encripta los datos de un flujo y escribe el resultado (cabecera y datos cifrados) en
+# otro. Es el núcleo de encriptar, para quien ya tiene los ficheros abiertos.
+# Parámetros:
+#	inp: fichero (o flujo) de entrada abierto en modo binario.
+#	outp: fichero (o flujo) de salida abierto en modo binario.
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+#	formato: 'cbc' o 'gcm' (FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (COMPRESION si es None).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+#
+def encriptar_stream(inp, outp, dest_id, chunk_size=CHUNK_SIZE, formato=None, compresion=None, workers=None):
+
+	formato, compresion = elegir_formato(formato, compresion)
+
+	if formato == 'gcm':
+		compresion = contenedor.elegir_compresion(inp, compresion)
+		if compresion:
+			print('Comprimiendo con ' + compresion)
+		key, prefijo, cabecera = nueva_clave_trozos(dest_id, chunk_size, 0, compresion)
+		outp.write(cabecera)
+		for buf in contenedor.cifrar_registros(inp, key, prefijo, cabecera, chunk_size, workers = workers, compresion = compresion):
+			outp.write(buf)
+	else:
+		aes, cabecera = nueva_clave_sesion(dest_id)
+		transformar = cifrador_cbc(aes, chunk_size)
+		outp.write(cabecera)
+		# En CBC la lectura, el cifrado y la escritura se solapan (ver tuberia.py).
+		tuberia.procesar(inp, outp, transformar, chunk_size)
+
+
+# Funcion que encripta un fichero como encriptar, pero guardando un punto de control (ver
+# reanudacion.py) cada reanudacion.INTERVALO bytes: la posición en el fichero en claro y en el
+# cifrado, la clave de sesión y el estado del cifrador (el último bloque cifrado en CBC, y el número
+# y las posiciones de los registros ya escritos en GCM). Si se interrumpe, al volver a ejecutarlo
+# sobre el mismo fichero continúa desde el último punto de control, siempre que ni el fichero, ni
+# los destinatarios ni el formato hayan cambiado; si no, empieza de cero.
+# Parámetros:
+#	file: dirección del fichero que se quiere encriptar.
+#	dest_id: id en SecureBox del detinatario del fichero, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+#	formato: 'cbc' o 'gcm' (FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (COMPRESION si es None).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: dirección del fichero encriptado.
+#
+def encriptar_reanudable(file, dest_id, chunk_size=CHUNK_SIZE, formato=None, compresion=None, workers=None):
+
+	outputF = './encriptado/' + file.split('/')[-1].split('.unchecked')[0]
+	formato, compresion = elegir_formato(formato, compresion)
+	inicio = time.perf_counter()
+
+	st = os.stat(file)
+	ruta = reanudacion.ruta_estado('cifrado', os.path.realpath(outputF))
+	origen = {'file': os.path.realpath(file), 'tam': st.st_size, 'mtime': st.st_mtime_ns,
+			  'destinos': sorted([dest_id] if isinstance(dest_id, str) else dest_id),
+			  'formato': formato, 'chunk_size': chunk_size}
+
+	estado = reanudacion.leer_estado(ruta)
+	if estado is not None and (estado['origen'] != origen or not os.path.exists(outputF) or os.path.getsize(outputF) < estado['salida']):
+		estado = None
+
+	print('Cifrando fichero')
 
 	with open(file, 'rb') as inp:
-		with open(outputF, 'wb') as outp:
+		with open(outputF, 'r+b' if estado else 'wb') as outp:
+
+			if estado:
+				print('Reanudando el cifrado desde el byte ' + str(estado['entrada']))
+				key = bytes.fromhex(estado['key'])
+				compresion = estado['compresion']
+				inp.seek(estado['entrada'])
+				outp.truncate(estado['salida'])
+				outp.seek(estado['salida'])
+			else:
+				estado = {'origen': origen, 'entrada': 0}
+
+			if formato == 'gcm':
+				if 'key' in estado:
+					prefijo = bytes.fromhex(estado['prefijo'])
+					cabecera = bytes.fromhex(estado['cabecera'])
+					previo = (estado['posiciones'], estado['salida'])
+				else:
+					compresion = contenedor.elegir_compresion(inp, compresion)
+					key, prefijo, cabecera = nueva_clave_trozos(dest_id, chunk_size, 0, compresion)
+					estado.update(prefijo = prefijo.hex(), cabecera = cabecera.hex(), posiciones = [])
+					previo = None
+				if compresion:
+					print('Comprimiendo con ' + compresion)
+				bloques = contenedor.cifrar_registros(inp, key, prefijo, cabecera, chunk_size, workers = workers, compresion = compresion, reanudar = previo)
+				total = contenedor.num_trozos(st.st_size, chunk_size)
+			else:
+				if 'key' in estado:
+					aes = AES.new(key, AES.MODE_CBC, bytes.fromhex(estado['iv']))
+					cabecera = None
+				else:
+					key, iv, cabecera = clave_sesion_cbc(dest_id)
+					aes = AES.new(key, AES.MODE_CBC, iv)
+				bloques = cifrar_bloques(inp, aes, chunk_size)
 
-			outp.write(iv)
+			if 'key' not in estado:
+				estado.update(key = key.hex(), compresion = compresion)
+				outp.write(cabecera)
 
-			outp.write(encrypted_key)
+			pendiente = 0
+			for buf in bloques:
+				if formato == 'gcm' and len(estado['posiciones']) < total:
+					estado['posiciones'].append(outp.tell())
+				outp.write(buf)
+				pendiente += len(buf)
 
-			buf = inp.read(read_s)
+				# Solo se guarda el punto de control entre dos trozos completos, nunca tras el
+				# último (en CBC lleva el padding, en GCM es de tipo ULTIMO).
+				if formato == 'gcm':
+					completo = len(estado['posiciones']) < total
+					entrada = len(estado['posiciones']) * chunk_size
+				else:
+					completo = inp.tell() < st.st_size and len(buf) == chunk_size
+					entrada = inp.tell()
+				if completo and pendiente >= reanudacion.INTERVALO:
+					reanudacion.sincronizar(outp)
+					estado.update(entrada = entrada, salida = outp.tell())
+					if formato != 'gcm':
+						estado['iv'] = bytes(buf[-AES.block_size:]).hex()
+					reanudacion.guardar_estado(ruta, estado)
+					pendiente = 0
 
-			while len(buf) != 0:
-				if(len(buf) < 16):
-					buf = pad(buf, 16)
-				outp.write(aes.encrypt(buf))
-				buf = inp.read(read_s)
+	reanudacion.borrar_estado(ruta)
 	print('OK')
+	mostrar_tamanos(os.path.getsize(file), os.path.getsize(outputF), inicio)
 	return outputF
 
 
+# Funcion que lee la cabecera de un fichero cifrado en cualquiera de los formatos y prepara su
+# descifrado. En los formatos CBC la firma, si la hay, va al principio de los datos descifrados;
+# en el cifrado por trozos va en un registro al final, y se guarda aparte al llegar a él.
+# Parámetros:
+#	inp: fichero (o flujo) abierto en modo binario, situado al principio.
+#	chunk_size: tamaño de los bloques que se leen y descifran de una vez.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: tupla con el generador de los fragmentos descifrados, el bytearray en el que se guarda
+# la firma (None en los formatos CBC) y el tamaño de la firma que indica la cabecera.
+#
+def descifrar_stream(inp, chunk_size=CHUNK_SIZE, workers=None):
+
+	version, flags, extra, key, cabecera = leer_cabecera(inp)
+
+	if version != contenedor.VERSION:
+		aes = AES.new(key, AES.MODE_CBC, extra)
+		return descifrar_bloques(inp, aes, chunk_size), None, 0
+
+	return descifrar_trozos_stream(inp, flags, extra, key, cabecera, workers)
+
+
+# Funcion que prepara el descifrado de un fichero cifrado por trozos (versión 3) cuya cabecera ya
+# se ha leído.
+# Parámetros:
+#	inp: fichero (o flujo) abierto en modo binario, situado tras la cabecera.
+#	flags, extra, key, cabecera: datos de la cabecera devueltos por leer_cabecera.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: tupla con el generador de los fragmentos descifrados, el bytearray en el que se guarda
+# la firma y el tamaño de la firma que indica la cabecera.
+#
+def descifrar_trozos_stream(inp, flags, extra, key, cabecera, workers=None):
+
+	tam_trozo, tam_firma, prefijo = struct.unpack(contenedor.FORMATO_EXTRA, extra)
+	firma = bytearray()
+	compresion = contenedor.compresion_flags(flags)
+	registros = contenedor.descifrar_registros(inp, key, prefijo, cabecera, tam_trozo, workers, compresion)
+	return contenedor.separar_firma(registros, firma), firma, tam_firma
+
+
 # Función que descifra un fichero encriptado.
 # Parámetros:
 #	file: dirección del fichero encriptado.
+#	chunk_size: tamaño de los bloques que se leen y descifran de una vez.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
 # Return: dirección del fichero descifrado.
 #
-def desencriptar(file):
+def desencriptar(file, chunk_size=CHUNK_SIZE, workers=None):
 
 	print('Descifrando fichero')
 
 	outputF = './downloads/' + file.split('/')[-1] + '.unchecked'
-	read_s = 16
 
 	with open(file, 'rb') as inp:
+		with open(outputF, 'wb') as outp:
+			desencriptar_stream(inp, outp, chunk_size, workers)
 
-		iv = inp.read(AES.block_size)
+	os.remove(file)
+	print('OK')
+	return outputF
 
-		priv_key = getPrivateKey()
-		cipher = PKCS1_OAEP.new(priv_key)
-		key = inp.read(256)
-		key = cipher.decrypt(key)
 
-		aes = AES.new(key, AES.MODE_CBC, iv)
+# Función que descifra los datos de un flujo cifrado y escribe el resultado (el fichero firmado,
+# si tiene firma) en otro. En los formatos CBC la lectura, el descifrado y la escritura se solapan
+# (ver tuberia.py).
+# Parámetros:
+#	inp: fichero (o flujo) cifrado abierto en modo binario, situado al principio.
+#	outp: fichero (o flujo) de salida abierto en modo binario. En el cifrado por trozos la firma
+#	llega al final, por lo que si la salida no admite seek el fichero firmado resultante tiene la
+#	firma al final (ver MAGIC_FIRMA_FINAL).
+#	chunk_size: tamaño de los bloques que se leen y descifran de una vez.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+#
+def desencriptar_stream(inp, outp, chunk_size=CHUNK_SIZE, workers=None):
 
-		with open(outputF, 'wb') as outp:
+	version, flags, extra, key, cabecera = leer_cabecera(inp)
 
-			buf = inp.read(read_s)
+	if version != contenedor.VERSION:
+		aes = AES.new(key, AES.MODE_CBC, extra)
+		tuberia.procesar(inp, outp, descifrador_cbc(aes, chunk_size), chunk_size)
+		return
 
-			while len(buf) != 0:
-				aux = inp.read(read_s)
-				if len(aux) == 0:
-					outp.write(unpad(aes.decrypt(buf), 16))
-				else:
-					outp.write(aes.decrypt(buf))
-				buf = aux
+	bloques, firma, tam_firma = descifrar_trozos_stream(inp, flags, extra, key, cabecera, workers)
+
+	# Si la salida no admite seek (por ejemplo una tubería) la firma se escribe al final.
+	if not outp.seekable():
+		if tam_firma:
+			outp.write(MAGIC_FIRMA_FINAL)
+		for buf in bloques:
+			outp.write(buf)
+		if len(firma) != tam_firma:
+			raise ValueError('La firma del fichero cifrado está incompleta.')
+		outp.write(firma)
+		return
+
+	# En el cifrado por trozos la firma llega al final: se deja su hueco al principio para que el
+	# resultado sea, como en el formato original, la firma y el fichero.
+	inicio = outp.tell()
+	outp.seek(inicio + tam_firma)
+
+	for buf in bloques:
+		outp.write(buf)
+
+	if len(firma) != tam_firma:
+		raise ValueError('La firma del fichero cifrado está incompleta.')
+	fin = outp.tell()
+	outp.seek(inicio)
+	outp.write(firma)
+	outp.seek(fin)
+
+
+# Funcion que descifra solo un rango de un fichero cifrado por trozos (formato 'gcm'), leyendo y
+# comprobando el tag únicamente de los trozos que lo cubren, de modo que el coste es proporcional
+# al tamaño del rango y no al del fichero. La firma no se puede comprobar sin descifrar el fichero
+# completo. El fichero cifrado no se borra.
+# Parámetros:
+#	file: dirección del fichero encriptado.
+#	inicio: posición del primer byte del rango en el fichero original.
+#	fin: posición siguiente al último byte del rango, o None para llegar al final.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: dirección del fichero con el rango descifrado.
+#
+def desencriptar_rango(file, inicio, fin=None, workers=None):
+
+	print('Descifrando rango del fichero')
+
+	outputF = './downloads/' + file.split('/')[-1] + '.' + str(inicio) + '-' + ('' if fin is None else str(fin))
+
+	with open(file, 'rb') as inp:
+		with open(outputF, 'wb') as outp:
+			desencriptar_rango_stream(inp, outp, inicio, fin, workers)
 
-	os.remove(file)
 	print('OK')
 	return outputF
 
 
-# Funcion que genera el resumen hash de un fichero con SHA256.
+# Funcion que descifra un rango de un flujo cifrado por trozos y lo escribe en otro. Es el núcleo de
+# desencriptar_rango, para quien ya tiene los ficheros abiertos.
 # Parámetros:
-#	file: fichero del que se quiere hacer el hash.
-# Return: resumen hash del fichero.
+#	inp: fichero cifrado abierto en modo binario, situado al principio. Debe admitir seek.
+#	outp: fichero (o flujo) de salida abierto en modo binario.
+#	inicio: posición del primer byte del rango en el fichero original.
+#	fin: posición siguiente al último byte del rango, o None para llegar al final.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
 #
-def create_hash(file):
+def desencriptar_rango_stream(inp, outp, inicio, fin=None, workers=None):
 
-	read_s = 1024
-	hash_code = SHA256.new()
+	version, flags, extra, key, cabecera = leer_cabecera(inp)
+	if version != contenedor.VERSION or not flags & contenedor.FLAG_INDICE:
+		raise ValueError('Solo se pueden descifrar rangos de los ficheros cifrados con --format gcm.')
 
-	with open(file, 'rb') as inp:
-		buf = inp.read(read_s)
+	tam_trozo, tam_firma, prefijo = struct.unpack(contenedor.FORMATO_EXTRA, extra)
 
-		while len(buf) != 0:
-			hash_code.update(buf)
-			buf = inp.read(read_s)
+	compresion = contenedor.compresion_flags(flags)
+	for buf in contenedor.descifrar_rango(inp, key, prefijo, cabecera, tam_trozo, inicio, fin, workers, compresion):
+		outp.write(buf)
 
-	return hash_code
+
+# Funcion que genera el resumen hash de un fichero con SHA256, usando la implementación más rápida
+# disponible y mapeando el fichero en memoria (ver hashing.py).
+# Parámetros:
+#	file: fichero del que se quiere hacer el hash.
+# Return: resumen hash del fichero.
+#
+def create_hash(file):
+	return hashing.hash_file(file)
 
 
 # Funcion que genera un par de claves pública y privada y guarda la prvada en la dirección dada.
@@ -162,39 +768,293 @@ def create_RSA_keys(file):
 	return public_key.decode()
 
 
+# Funcion que firma un resumen hash con la clave privada del usuario.
+# Parámetros:
+#	hash_code: resumen hash SHA256 que se quiere firmar.
+# Return: firma digital.
+#
+def firmar_hash(hash_code):
+	return PKCS1_v1_5.new(getPrivateKey()).sign(hash_code)
+
+
 # Funcion que firma un fichero con la clave privada del usuario.
 # Parámetros:
 #	file: dirección del fichero que se quiere firmar.
+#	merkle: True para firmar la raíz del árbol de Merkle de sus trozos (ver MAGIC_FIRMA_MERKLE).
 # Return: dirección del fichero firmado.
 #
-def firmar(file):
-	read_s = 1024
-	key = getPrivateKey()
-	hash_code = create_hash(file)
+def firmar(file, merkle=False):
 	outputF = file + '.unchecked'
 
 	print('Firmando fichero')
 
-	try:
-		signature = PKCS1_v1_5.new(key).sign(hash_code)
+	with open(file, 'rb') as inp:
+		with open(outputF, 'wb') as outp:
+			firmar_stream(inp, outp, merkle = merkle)
 
-	except:
-		print('Error: se debe crear un usuario primero para recibir una clave privada.')
-		os.remove(outputF)
-		sys.exit(0)
+	print('OK')
 
-	with open(outputF, 'wb') as outp:
-		outp.write(signature)
+	return outputF
 
-		with open(file, 'rb') as inp:
-			buf = inp.read(read_s)
-			while len(buf) != 0:
-				outp.write(buf)
-				buf = inp.read(read_s)
 
-	print('OK')
+# Funcion que firma los datos de un flujo y escribe en otro la firma seguida de los datos. Los
+# datos se leen una sola vez: la tubería (ver tuberia.py) calcula el hash de cada bloque mientras
+# lo copia tras el hueco de la firma, que se escribe al terminar. Si la salida no admite seek se
+# usa el formato con la firma al final (ver MAGIC_FIRMA_FINAL).
+# Parámetros:
+#	inp: fichero (o flujo) de entrada abierto en modo binario.
+#	outp: fichero (o flujo) de salida abierto en modo binario.
+#	al_final: True para poner la firma al final aunque la salida admita seek.
+#	merkle: True para firmar la raíz del árbol de Merkle de los trozos (ver firmar_merkle_stream).
+#
+def firmar_stream(inp, outp, al_final=False, merkle=False):
+	if merkle:
+		return firmar_merkle_stream(inp, outp)
 
-	return outputF
+	tam_firma = getPrivateKey().size_in_bytes()
+	hash_code = hashing.HashSHA256()
+	al_final = al_final or not outp.seekable()
+
+	def transformar(buf, ultimo):
+		hash_code.update(buf)
+		return buf
+
+	if al_final:
+		outp.write(MAGIC_FIRMA_FINAL)
+		tuberia.procesar(inp, outp, transformar, CHUNK_SIZE)
+		outp.write(firmar_hash(hash_code))
+		return
+
+	inicio = outp.tell()
+	outp.seek(inicio + tam_firma)
+	tuberia.procesar(inp, outp, transformar, CHUNK_SIZE)
+
+	fin = outp.tell()
+	outp.seek(inicio)
+	outp.write(firmar_hash(hash_code))
+	outp.seek(fin)
+
+
+# Funcion que calcula el número de trozos (hojas) de un fichero firmado con un árbol de Merkle.
+# Parámetros:
+#	tam: tamaño del fichero.
+#	tam_hoja: tamaño de los trozos.
+# Return: número de trozos (ninguno si el fichero está vacío).
+#
+def num_hojas(tam, tam_hoja):
+	return -(-tam // tam_hoja)
+
+
+# Funcion que calcula el hash que se firma en los ficheros firmados con un árbol de Merkle.
+# Parámetros:
+#	cabecera: cabecera del fichero firmado (ver MAGIC_FIRMA_MERKLE).
+#	hojas: lista con los hashes de los trozos.
+# Return: resumen hash (HashSHA256) de la cabecera y la raíz del árbol.
+#
+def hash_merkle(cabecera, hojas):
+	return hashing.HashSHA256(cabecera + hashing.raiz_merkle(hojas))
+
+
+# Funcion que firma los datos de un flujo con un árbol de Merkle (ver MAGIC_FIRMA_MERKLE). Los
+# hashes de los trozos se calculan en paralelo (ver hashing.hojas_merkle) en una primera lectura, y
+# como se escriben delante de los datos junto con la firma, la salida no necesita admitir seek.
+# Parámetros:
+#	inp: fichero de entrada abierto en modo binario, que debe admitir seek para leerlo dos veces.
+#	outp: fichero (o flujo) de salida abierto en modo binario.
+#	tam_hoja: tamaño de los trozos.
+#
+def firmar_merkle_stream(inp, outp, tam_hoja=TAM_HOJA_MERKLE):
+	getPrivateKey()
+	if not inp.seekable():
+		raise ValueError('La firma Merkle lee el fichero dos veces y la entrada no admite seek.')
+
+	inicio = inp.tell()
+	tam = inp.seek(0, os.SEEK_END) - inicio
+	inp.seek(inicio)
+
+	trozos = iter(lambda: contenedor.leer_exacto(inp, tam_hoja), b'')
+	hojas = list(hashing.hojas_merkle(trozos))
+	if len(hojas) != num_hojas(tam, tam_hoja):
+		raise ValueError('El fichero ha cambiado mientras se firmaba.')
+
+	cabecera = MAGIC_FIRMA_MERKLE + struct.pack(FORMATO_MERKLE, VERSION_MERKLE, tam_hoja, tam)
+	outp.write(cabecera)
+	outp.write(firmar_hash(hash_merkle(cabecera, hojas)))
+	outp.write(b''.join(hojas))
+
+	inp.seek(inicio)
+	tuberia.procesar(inp, outp, lambda buf, ultimo: buf, CHUNK_SIZE)
+
+
+# Funcion que separa la firma de los datos de un fichero firmado, en cualquiera de sus formatos
+# (ver MAGIC_FIRMA_FINAL y MAGIC_FIRMA_MERKLE). Con la firma al final se retienen siempre los
+# últimos tam_firma bytes leídos, que al terminar el flujo son la firma.
+# Parámetros:
+#	bloques: iterable con los fragmentos del fichero firmado.
+#	tam_firma: tamaño de la firma.
+#	firma: bytearray en el que se guarda la firma.
+#	merkle: diccionario en el que se guardan, si el fichero está firmado con un árbol de Merkle,
+#	su cabecera ('cabecera'), el tamaño de hoja ('tam_hoja'), el del fichero ('tam') y los hashes
+#	de los trozos ('hojas'), antes de devolver el primer fragmento.
+# Return: generador de los fragmentos de datos.
+#
+def separar_firma_fichero(bloques, tam_firma, firma, merkle=None):
+	bloques = iter(bloques)
+	pendiente = bytearray()
+
+	for buf in bloques:
+		pendiente += buf
+		if len(pendiente) >= max(tam_firma, len(MAGIC_FIRMA_FINAL)):
+			break
+
+	if merkle is not None and pendiente[:len(MAGIC_FIRMA_MERKLE)] == MAGIC_FIRMA_MERKLE:
+		tam_cabecera = len(MAGIC_FIRMA_MERKLE) + struct.calcsize(FORMATO_MERKLE)
+		if len(pendiente) < tam_cabecera:
+			raise ValueError('El fichero firmado está incompleto.')
+		version, tam_hoja, tam = struct.unpack(FORMATO_MERKLE, pendiente[len(MAGIC_FIRMA_MERKLE):tam_cabecera])
+		if version != VERSION_MERKLE or not tam_hoja:
+			raise ValueError('Cabecera de firma Merkle no válida.')
+
+		total = tam_cabecera + tam_firma + hashing.HashSHA256.digest_size * num_hojas(tam, tam_hoja)
+		for buf in bloques:
+			pendiente += buf
+			if len(pendiente) >= total:
+				break
+		if len(pendiente) < total:
+			raise ValueError('El fichero firmado está incompleto.')
+
+		hojas = pendiente[tam_cabecera + tam_firma:total]
+		firma += pendiente[tam_cabecera:tam_cabecera + tam_firma]
+		merkle.update(cabecera = bytes(pendiente[:tam_cabecera]), tam_hoja = tam_hoja, tam = tam,
+					  hojas = [bytes(hojas[i:i + hashing.HashSHA256.digest_size]) for i in range(0, len(hojas), hashing.HashSHA256.digest_size)])
+		yield bytes(pendiente[total:])
+		for buf in bloques:
+			yield buf
+		return
+
+	if pendiente[:len(MAGIC_FIRMA_FINAL)] != MAGIC_FIRMA_FINAL:
+		firma += pendiente[:tam_firma]
+		if len(pendiente) > tam_firma:
+			yield bytes(pendiente[tam_firma:])
+		for buf in bloques:
+			yield buf
+		return
+
+	del pendiente[:len(MAGIC_FIRMA_FINAL)]
+	for buf in bloques:
+		pendiente += buf
+		if len(pendiente) > tam_firma:
+			yield bytes(pendiente[:-tam_firma])
+			del pendiente[:-tam_firma]
+
+	firma += pendiente[-tam_firma:]
+	if len(pendiente) > tam_firma:
+		yield bytes(pendiente[:-tam_firma])
+
+
+# Funcion que verifica la firma digital de un flujo de datos firmado (ver MAGIC_FIRMA_FINAL y
+# MAGIC_FIRMA_MERKLE) mientras escribe los datos, sin la firma, en un fichero abierto. Como los
+# datos se escriben antes de terminar la verificación, quien lo use debe descartarlos si la firma
+# no es correcta.
+# Parámetros:
+#	bloques: iterable con los fragmentos del flujo.
+#	outp: fichero (o flujo) abierto en modo binario en el que se escriben los datos.
+#	key: clave pública del emisor (objeto RSA).
+#	firma: si la firma no va en el flujo, bytearray en el que está al terminarlo.
+#	modificados: lista en la que se añaden, si el fichero está firmado con un árbol de Merkle, los
+#	números de los trozos modificados.
+# Return: True si la firma es correcta o False en caso contrario.
+#
+def verificar_flujo(bloques, outp, key, firma=None, modificados=None):
+
+	if firma is None:
+		firma = bytearray()
+		merkle = {}
+		bloques = separar_firma_fichero(bloques, key.size_in_bytes(), firma, merkle)
+		# El primer fragmento se pide ya para saber, por la cabecera, cómo se verifica.
+		bloques = itertools.chain([next(bloques, b'')], bloques)
+		if merkle:
+			return verificar_merkle(bloques, outp, key, firma, merkle, modificados)
+
+	hash_code = hashing.HashSHA256()
+	for buf in bloques:
+		hash_code.update(buf)
+		outp.write(buf)
+
+	return PKCS1_v1_5.new(key).verify(hash_code, bytes(firma))
+
+
+# Funcion que verifica un fichero firmado con un árbol de Merkle mientras escribe sus datos: primero
+# comprueba la firma de la raíz, que autentica los hashes de los trozos, y después compara cada uno
+# con el hash del trozo leído, de modo que se sabe exactamente qué trozos se han modificado.
+# Parámetros:
+#	bloques: iterable con los fragmentos de datos.
+#	outp: fichero (o flujo) abierto en modo binario en el que se escriben los datos.
+#	key: clave pública del emisor (objeto RSA).
+#	firma: firma del fichero.
+#	merkle: datos de la cabecera obtenidos con separar_firma_fichero.
+#	modificados: lista en la que se añaden los números de los trozos modificados, o None.
+# Return: True si la firma es correcta y ningún trozo se ha modificado, o False en caso contrario.
+#
+def verificar_merkle(bloques, outp, key, firma, merkle, modificados=None):
+
+	hojas = merkle['hojas']
+	if not PKCS1_v1_5.new(key).verify(hash_merkle(merkle['cabecera'], hojas), bytes(firma)):
+		return False
+
+	leidos = [0]
+
+	def escribir():
+		for buf in bloques:
+			outp.write(buf)
+			leidos[0] += len(buf)
+			yield buf
+
+	malos = []
+	n = 0
+	for n, hoja in enumerate(hashing.hojas_merkle(hashing.trozos_fijos(escribir(), merkle['tam_hoja'])), 1):
+		if n > len(hojas) or hoja != hojas[n - 1]:
+			malos.append(n - 1)
+	malos += range(n, len(hojas))
+
+	if modificados is not None:
+		modificados += malos
+	return not malos and leidos[0] == merkle['tam']
+
+
+# Funcion que verifica la firma digital de un flujo de datos firmado y guarda los datos. Si el
+# destino es una dirección, los datos se escriben en un fichero temporal en el mismo directorio
+# mientras se calcula su hash, y solo se renombran al destino si la firma es correcta, de modo que
+# la memoria usada no depende del tamaño del fichero. Si es un fichero abierto (por ejemplo la
+# salida estándar) se escriben directamente (ver verificar_flujo).
+# Parámetros:
+#	bloques: iterable con los fragmentos del flujo.
+#	dest: dirección final del fichero verificado, o fichero abierto en modo binario.
+#	key: clave pública del emisor (objeto RSA).
+#	firma: si la firma no va en el flujo, bytearray en el que está al terminarlo.
+#	modificados: lista en la que se añaden los trozos modificados (ver verificar_flujo), o None.
+# Return: True si la firma es correcta o False en caso contrario.
+#
+def verificar_stream(bloques, dest, key, firma=None, modificados=None):
+
+	if not isinstance(dest, str):
+		return verificar_flujo(bloques, dest, key, firma, modificados)
+
+	fd, temp = tempfile.mkstemp(dir = os.path.dirname(dest) or '.', prefix = '.', suffix = '.unchecked')
+
+	try:
+		with os.fdopen(fd, 'wb') as outp:
+			correcta = verificar_flujo(bloques, outp, key, firma, modificados)
+
+		if correcta:
+			os.replace(temp, dest)
+			return True
+
+	finally:
+		if os.path.exists(temp):
+			os.remove(temp)
+
+	return False
 
 
 # Funcion que verifica la firma digital de un fichero determinado.
@@ -205,37 +1065,314 @@ def firmar(file):
 #
 def check_signature(file, source_id):
 
-	public_key = ig.userGetPublickey(source_id)
+	public_key = ig.userGetRSAKey(source_id)
 	print('Verificando firma')
 
+	dest = './downloads/' + file.split('/')[-1].split('.unchecked')[0]
+
 	with open(file, 'rb') as inp:
-		signature = inp.read(256)
-		filetext = inp.read()
+		correcta = verificar_stream(leer_bloques(inp), dest, public_key)
 
-	dest = './downloads/' + file.split('/')[-1].split('.unchecked')[0]
 	os.remove(file)
-	with open(dest, 'w') as outp:
-		outp.write(filetext.decode())
+	return correcta
 
-	hash_code = create_hash(dest)
 
-	key = RSA.importKey(public_key)
+# Funcion que descifra un fichero encriptado y verifica su firma en un único flujo: el texto en
+# claro se va descifrando, se calcula su hash y se escribe en un fichero temporal a la vez, y
+# solo se guarda en el destino si la firma es correcta (ver verificar_stream).
+# Parámetros:
+#	inp: fichero (o flujo, como la respuesta de una descarga) abierto en modo binario.
+#	dest: dirección final del fichero descifrado y verificado, o fichero abierto en modo binario.
+#	source_id: id en SecureBox del usuario emisor del fichero.
+#	chunk_size: tamaño de los bloques que se leen y descifran de una vez.
+#	modificados: lista en la que se añaden los trozos modificados (ver verificar_flujo), o None.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: True si la firma es correcta o False en caso contrario, también si la cabecera está
+# dañada o el fichero no está cifrado para el usuario, ya que tampoco se puede comprobar.
+#
+def descifrar_verificar_stream(inp, dest, source_id, chunk_size=CHUNK_SIZE, modificados=None, workers=None):
 
-	if PKCS1_v1_5.new(key).verify(hash_code, signature):
-		return True
-	else:
-		os.remove(dest)
+	public_key = ig.userGetRSAKey(source_id)
+
+	try:
+		bloques, firma, tam_firma = descifrar_stream(inp, chunk_size, workers)
+		return verificar_stream(bloques, dest, public_key, firma, modificados)
+	except ValueError:
+		# Cabecera no válida, padding o tag incorrecto o fichero truncado: el fichero ha sido
+		# modificado.
 		return False
 
-# Funcion que firma y encripta un fichero llamando a las funciones "firmar" y "encriptar".
+
+# Funcion que descifra un fichero encriptado y verifica su firma en un único flujo, guardando el
+# resultado en la carpeta downloads solo si la firma es correcta.
+# Parámetros:
+#	file: dirección del fichero encriptado.
+#	source_id: id en SecureBox del usuario emisor del fichero.
+#	chunk_size: tamaño de los bloques que se leen y descifran de una vez.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: True si la firma es correcta o False en caso contrario.
+#
+def desencriptar_verificar(file, source_id, chunk_size=CHUNK_SIZE, workers=None):
+
+	dest = './downloads/' + file.split('/')[-1]
+
+	print('Descifrando y verificando fichero')
+
+	with open(file, 'rb') as inp:
+		correcta = descifrar_verificar_stream(inp, dest, source_id, chunk_size, workers = workers)
+
+	os.remove(file)
+	return correcta
+
+
+# Tamaño máximo (en bytes) de los ficheros que cifrar_firmar lee una sola vez en memoria para
+# calcular el hash y cifrarlos. Los ficheros mayores se leen dos veces del origen.
+SPILL_MAX = 64 * 1024 * 1024
+
+
+# Funcion que abre el fichero que se va a firmar y encriptar y calcula su resumen hash sin crear
+# ninguna copia en disco. Si el fichero cabe en SPILL_MAX se lee una única vez en memoria; si no,
+# se hace una primera pasada solo para el hash y se vuelve al principio del fichero.
+# Parámetros:
+#	file: dirección del fichero, o fichero ya abierto en modo binario que admita seek (en ese caso
+#	se calcula el hash desde la posición actual y se vuelve a ella, sin cerrarlo).
+# Return: tupla con el resumen hash y un fichero abierto, situado al principio de los datos.
+#
+def abrir_con_hash(file):
+	if not isinstance(file, str):
+		inicio = file.tell()
+		hash_code = hashing.hash_stream(file)
+		file.seek(inicio)
+		return hash_code, file
+
+	inp = open(file, 'rb')
+
+	try:
+		grande = os.fstat(inp.fileno()).st_size > SPILL_MAX and inp.seekable()
+
+		if not grande:
+			data = inp.read(SPILL_MAX + 1)
+			if len(data) > SPILL_MAX:
+				raise ValueError('El fichero ' + file + ' no se puede releer y supera ' + str(SPILL_MAX) + ' bytes.')
+			inp.close()
+			return hashing.HashSHA256(data), io.BytesIO(data)
+
+		hash_code = hashing.hash_stream(inp)
+		inp.seek(0)
+		return hash_code, inp
+
+	except:
+		inp.close()
+		raise
+
+
+# Funcion que calcula el tamaño exacto del texto cifrado con AES-CBC a partir del tamaño del texto
+# en claro, teniendo en cuenta el padding (siempre se añade al menos un byte).
+# Parámetros:
+#	tam: tamaño en bytes del texto en claro.
+# Return: tamaño en bytes del texto cifrado.
+#
+def tam_cifrado(tam):
+	return (tam // AES.block_size + 1) * AES.block_size
+
+
+# Funcion que prepara el firmado y encriptado de un fichero en un solo flujo: lee el fichero para
+# calcular el hash, lo firma y genera la clave de sesión, pero deja el cifrado para cuando se
+# consuma el generador devuelto, de modo que el resultado se puede escribir en un fichero o enviar
+# directamente por la red sin guardar ninguna copia en disco.
+# Parámetros:
+#	file: dirección del fichero que se quiere encriptar y firmar, o fichero abierto en modo binario
+#	(que no se cierra). Si no admite seek, como una tubería, no se puede leer dos veces y la firma
+#	se cifra al final de los datos (ver cifrar_firmar_final).
+#	dest_id: id en SecureBox del destinatario del mensaje, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+#	formato: 'cbc' o 'gcm' (FORMATO si es None). En el cifrado por trozos el hash se calcula a la
+#	vez que se cifra y la firma se añade al final, por lo que el fichero se lee una sola vez.
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (COMPRESION si es None).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+#	resumen: hash SHA256 (en hexadecimal) del fichero ya calculado, que se firma en lugar de leer
+#	el fichero para calcularlo (None para calcularlo).
+# Return: tupla con el tamaño exacto del fichero cifrado (None si no se conoce de antemano, porque
+# se comprime o se lee de una tubería) y el generador de sus fragmentos (que pueden ser vistas
+# sobre un buffer reutilizado, por lo que deben consumirse antes del siguiente).
+#
+def cifrar_firmar_bloques(file, dest_id, chunk_size=CHUNK_SIZE, formato=None, compresion=None, workers=None, resumen=None):
+
+	formato, compresion = elegir_formato(formato, compresion)
+	if formato == 'gcm':
+		return cifrar_firmar_trozos(file, dest_id, chunk_size, compresion, workers, resumen)
+
+	propio = isinstance(file, str)
+	if not propio and not file.seekable():
+		return cifrar_firmar_final(file, dest_id, chunk_size)
+
+	if resumen is not None:
+		hash_code, inp = hashing.ResumenSHA256(resumen), open(file, 'rb') if propio else file
+	else:
+		hash_code, inp = abrir_con_hash(file)
+
+	try:
+		print('Firmando fichero')
+		signature = firmar_hash(hash_code)
+		print('OK')
+
+		aes, cabecera = nueva_clave_sesion(dest_id)
+
+		inicio = inp.tell()
+		tam = inp.seek(0, os.SEEK_END) - inicio
+		inp.seek(inicio)
+	except:
+		if propio:
+			inp.close()
+		raise
+
+	def bloques():
+		try:
+			yield cabecera
+			yield aes.encrypt(signature)
+			for buf in cifrar_bloques(inp, aes, chunk_size):
+				yield buf
+		finally:
+			if propio:
+				inp.close()
+
+	return len(cabecera) + tam_cifrado(len(signature) + tam), bloques()
+
+
+# Funcion que cifra con AES-CBC una secuencia de fragmentos de cualquier tamaño, guardando el resto
+# que no completa un bloque AES para el fragmento siguiente y aplicando padding al final.
+# Parámetros:
+#	trozos: iterable con los fragmentos del texto en claro.
+#	aes: cifrador AES ya inicializado.
+# Return: generador de los fragmentos cifrados.
+#
+def cifrar_trozos_cbc(trozos, aes):
+	pendiente = bytearray()
+
+	for trozo in trozos:
+		pendiente += trozo
+		n = len(pendiente) - len(pendiente) % AES.block_size
+		if n:
+			yield aes.encrypt(bytes(pendiente[:n]))
+			del pendiente[:n]
+
+	yield aes.encrypt(pad(bytes(pendiente), AES.block_size))
+
+
+# Funcion que prepara el firmado y encriptado con AES-CBC de un flujo que no se puede leer dos
+# veces (por ejemplo la entrada estándar). El hash se calcula a la vez que se cifra, por lo que se
+# cifra el fichero firmado con la firma al final (ver MAGIC_FIRMA_FINAL), que al descifrarlo se
+# verifica igual que el formato original.
+# Parámetros:
+#	inp: flujo abierto en modo binario, que no se cierra.
+#	dest_id: id en SecureBox del destinatario del mensaje, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+# Return: tupla con None (el tamaño no se conoce de antemano) y el generador de los fragmentos.
+#
+def cifrar_firmar_final(inp, dest_id, chunk_size=CHUNK_SIZE):
+
+	getPrivateKey()
+	aes, cabecera = nueva_clave_sesion(dest_id)
+	hash_code = hashing.HashSHA256()
+
+	def firmado():
+		yield MAGIC_FIRMA_FINAL
+		for buf in leer_bloques(inp, chunk_size):
+			hash_code.update(buf)
+			yield buf
+		print('Firmando fichero')
+		yield firmar_hash(hash_code)
+		print('OK')
+
+	def bloques():
+		yield cabecera
+		for buf in cifrar_trozos_cbc(firmado(), aes):
+			yield buf
+
+	return None, bloques()
+
+
+# Funcion que prepara el firmado y encriptado de un fichero en el formato de cifrado por trozos,
+# en el que el hash se calcula a medida que se leen los trozos y la firma se cifra en el último
+# registro. Es la variante de cifrar_firmar_bloques para el formato 'gcm'.
+# Parámetros:
+#	file: dirección del fichero que se quiere encriptar y firmar, o fichero abierto en modo binario
+#	(que no se cierra y no necesita admitir seek).
+#	dest_id: id en SecureBox del destinatario del mensaje, o lista de ids.
+#	chunk_size: tamaño de los trozos.
+#	compresion: 'none', 'zlib', 'lzma' o 'auto'.
+#	workers: número de procesos entre los que se reparten los trozos (contenedor.WORKERS si es
+#	None).
+#	resumen: hash SHA256 (en hexadecimal) del fichero ya calculado, que se firma en lugar del
+#	calculado mientras se cifra (None para usar este).
+# Return: tupla con el tamaño exacto del fichero cifrado (None si se comprime o si el fichero no
+# admite seek) y el generador de sus fragmentos.
+#
+def cifrar_firmar_trozos(file, dest_id, chunk_size=CHUNK_SIZE, compresion='none', workers=None, resumen=None):
+
+	propio = isinstance(file, str)
+	inp = open(file, 'rb') if propio else file
+
+	try:
+		tam = None
+		if inp.seekable():
+			inicio = inp.tell()
+			tam = inp.seek(0, os.SEEK_END) - inicio
+			inp.seek(inicio)
+		tam_firma = getPrivateKey().size_in_bytes()
+		compresion = contenedor.elegir_compresion(inp, compresion)
+		if compresion:
+			print('Comprimiendo con ' + compresion)
+		key, prefijo, cabecera = nueva_clave_trozos(dest_id, chunk_size, tam_firma, compresion)
+	except:
+		if propio:
+			inp.close()
+		raise
+
+	def bloques():
+		try:
+			yield cabecera
+			firmar = firmar_hash if resumen is None else lambda hash_code: firmar_hash(hashing.ResumenSHA256(resumen))
+			for buf in contenedor.cifrar_registros(inp, key, prefijo, cabecera, chunk_size, firmar, workers, compresion):
+				yield buf
+		finally:
+			if propio:
+				inp.close()
+
+	if compresion or tam is None:
+		return None, bloques()
+	return len(cabecera) + contenedor.tam_cifrado(tam, chunk_size, tam_firma), bloques()
+
+
+# Funcion que firma y encripta un fichero en un solo flujo: el fichero original se lee solo para
+# calcular el hash y para cifrarlo, y la firma se cifra por delante de los datos, sin generar el
+# fichero firmado intermedio. El resultado es idéntico al de firmar y después encriptar.
 # Parámetros:
 #	file: dirección del fichero que se quiere encriptar y firmar.
-#	dest_id: id en SecureBox del destinatario del mensaje.
+#	dest_id: id en SecureBox del destinatario del mensaje, o lista de ids.
+#	chunk_size: tamaño de los bloques que se leen y cifran de una vez.
+#	formato: 'cbc' o 'gcm' (FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (COMPRESION si es None).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
 # Return: dirección del fichero encriptado y firmado.
 #
-def cifrar_firmar(file, dest_id):
+def cifrar_firmar(file, dest_id, chunk_size=CHUNK_SIZE, formato=None, compresion=None, workers=None):
 
-	file = firmar(file)
-	file2 = encriptar(file, dest_id)
-	os.remove(file)
-	return file2
+	outputF = './encriptado/' + file.split('/')[-1]
+	inicio = time.perf_counter()
+
+	tam, bloques = cifrar_firmar_bloques(file, dest_id, chunk_size, formato, compresion, workers)
+
+	print('Cifrando fichero')
+
+	with open(outputF, 'wb') as outp:
+		for buf in bloques:
+			outp.write(buf)
+
+	print('OK')
+	mostrar_tamanos(os.path.getsize(file), os.path.getsize(outputF), inicio)
+	return outputF
@@ -0,0 +1,54 @@
+# Excepciones de SecureBox. Todas heredan de SecureBoxError, de modo que quien use el cliente
+# (cliente.py) puede capturarlas todas juntas o distinguir la causa del error.
+
+
+# Clase base de los errores de SecureBox.
+#
+class SecureBoxError(Exception):
+    pass
+
+
+# Clase del error que se lanza cuando la API responde a una petición con un código de error.
+#
+class APIError(SecureBoxError):
+    def __init__(self, r):
+        self.status_code = r.status_code
+        try:
+            datos = r.json()
+        except ValueError:
+            datos = {}
+        if not isinstance(datos, dict):
+            datos = {}
+        self.error_code = datos.get('error_code')
+        self.description = datos.get('description')
+        super(APIError, self).__init__('la API ha respondido ' + str(r.status_code) + ' (' + str(self.error_code) + '): ' + str(self.description))
+
+
+# Clase del error que se lanza cuando no se puede conectar con la API o la conexión se corta.
+#
+class NetworkError(SecureBoxError):
+    pass
+
+
+# Clase del error que se lanza cuando hace falta la clave privada del usuario y no la tiene.
+#
+class PrivateKeyError(SecureBoxError):
+    pass
+
+
+# Clase del error que se lanza cuando la firma de un fichero no es correcta: el fichero ha sido
+# modificado o no lo ha enviado el usuario indicado. Si el fichero está firmado con un árbol de
+# Merkle y la firma es del emisor, modificados contiene los números de los trozos modificados.
+#
+class SignatureError(SecureBoxError):
+    def __init__(self, mensaje, modificados=None):
+        self.modificados = list(modificados or [])
+        super(SignatureError, self).__init__(mensaje)
+
+
+# Clase del error que se lanza cuando un fichero cifrado no es válido (está truncado, no está
+# cifrado para el usuario, tiene un formato desconocido...). Hereda también de ValueError, que es
+# lo que lanzan las funciones de crypt.py y contenedor.py en esos casos.
+#
+class FormatError(SecureBoxError, ValueError):
+    pass
@@ -1,5 +1,23 @@
 import utils
+import archivo
+import crypt as cr
+import errores
 import identityGestion as ig
+import metadatos as md
+import reanudacion
+import json
+import os
+import sys
+import threading
+import time
+
+# Tiempo (en segundos) durante el que se da por buena la copia local de la lista de ficheros de
+# SecureBox (ver metadatos.py) al listar los ficheros, y tiempo, menor, durante el que se da por
+# buena para comprobar que las subidas ya realizadas siguen en el servidor.
+LIST_TTL = 300
+RECONCILE_TTL = 60
+
+_sync_lock = threading.Lock()
 
 
 # Funcion que sube un fichero cifrado y firmado a la API.
@@ -13,9 +31,145 @@ def uploadFile(path):
     r = utils.binaryRequest('/files/upload', path)
     print(utils.requestResultInfo(r))
     print(r.json())
+    if r.status_code == 200:
+        md.guardar_fichero(r.json()['file_id'], path.split('/')[-1], r.json().get('file_size'), time.time())
     return r
 
 
+# Funcion que firma, encripta y sube un fichero a la API en un solo flujo: el fichero cifrado se va
+# generando a medida que se envía el cuerpo de la petición, sin guardarlo en ./encriptado.
+# Parámetros:
+#	file: dirección del fichero que se quiere firmar, encriptar y subir, o flujo abierto en modo
+#	binario (en ese caso hace falta el nombre).
+#	dest_id: id en SecureBox del destinatario del fichero, o lista de ids.
+#	chunked: True para enviar el fichero por partes en lugar de calcular antes su tamaño.
+#	formato: 'cbc' o 'gcm' (el de crypt.FORMATO si es None).
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (el de crypt.COMPRESION si es None). Si se
+#	comprime, el tamaño no se conoce de antemano y el fichero se envía siempre por partes.
+#	nombre: nombre con el que se sube el fichero (por defecto, el del propio fichero).
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+#	resumen: hash SHA256 (en hexadecimal) del fichero ya calculado, para firmarlo sin volver a
+#	leer el fichero (None para calcularlo).
+# Return: resultado de la petición a la API.
+#
+def uploadEncrypted(file, dest_id, chunked=False, formato=None, compresion=None, nombre=None, workers=None, resumen=None):
+    nombre = nombre or file.split('/')[-1]
+    inicio = time.perf_counter()
+    length, chunks = cr.cifrar_firmar_bloques(file, dest_id, formato = formato, compresion = compresion, workers = workers, resumen = resumen)
+    enviados = [0]
+
+    def contar(chunks):
+        for chunk in chunks:
+            enviados[0] += len(chunk)
+            yield chunk
+
+    print('Subiendo fichero cifrado al servidor')
+    r = utils.streamRequest('/files/upload', nombre, contar(chunks), None if chunked else length)
+    print(utils.requestResultInfo(r))
+    print(r.json())
+    if r.status_code == 200:
+        md.guardar_fichero(r.json()['file_id'], nombre, r.json().get('file_size', enviados[0]), time.time())
+    if isinstance(file, str):
+        cr.mostrar_tamanos(os.path.getsize(file), enviados[0], inicio)
+    return r
+
+
+# Funcion que sube un directorio entero como un único archivo (ver archivo.py): el archivo se
+# genera, se firma, se cifra por trozos y se envía a la vez, sin guardarlo en disco.
+# Parámetros:
+#	directorio: dirección del directorio.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#	compresion: 'none', 'zlib', 'lzma' o 'auto' (el de crypt.COMPRESION si es None).
+#	nombre: nombre con el que se sube (por defecto, el del directorio con la extensión .tar).
+#	workers: número de procesos entre los que se reparten los trozos (contenedor.WORKERS si es
+#	None).
+# Return: id en SecureBox del archivo. Si la API no acepta la subida se lanza APIError.
+#
+def uploadDir(directorio, dest_id, compresion=None, nombre=None, workers=None):
+    nombre = nombre or os.path.basename(os.path.abspath(directorio)) + '.tar'
+    with archivo.flujo_archivo(directorio) as inp:
+        r = uploadEncrypted(inp, dest_id, chunked = True, formato = 'gcm', compresion = compresion, nombre = nombre, workers = workers)
+    if r.status_code != 200:
+        raise errores.APIError(r)
+    return r.json()['file_id']
+
+
+# Funcion que actualiza la copia local de la lista de ficheros propios de SecureBox con la de la
+# API, salvo que se haya actualizado hace menos de max_age segundos, y elimina de las subidas
+# guardadas las de los ficheros que ya no están. Las subidas y borrados de este cliente ya la
+# actualizan al momento, por lo que solo hace falta pedirla para ver los cambios de otros clientes.
+# Parámetros:
+#	max_age: antigüedad máxima (en segundos) de la copia local, 0 para actualizarla siempre.
+# Return: True si la copia local está actualizada, False si no se ha podido pedir la lista (por
+# ejemplo sin conexión), en cuyo caso se mantiene la que había.
+#
+def syncFileList(max_age=LIST_TTL):
+    with _sync_lock:
+        ultima = md.ultima_sincronizacion()
+        if ultima is not None and time.time() - ultima < max_age:
+            return True
+
+        try:
+            r = utils.genericRequest('/files/list', None)
+        except OSError as e:
+            print('No se ha podido actualizar la lista de ficheros: ' + str(e), file = sys.stderr)
+            return False
+        if r.status_code != 200:
+            print('No se ha podido actualizar la lista de ficheros: ' + str(utils.requestResultInfo(r)), file = sys.stderr)
+            return False
+
+        ficheros = [(file['fileID'], file['fileName']) for file in r.json()['files_list']]
+        md.actualizar_ficheros(ficheros)
+        md.reconciliar_subidas(fileID for fileID, nombre in ficheros)
+        return True
+
+
+# Funcion que obtiene los ids de los ficheros propios que hay en SecureBox, de la copia local de
+# la lista si se ha actualizado hace menos de RECONCILE_TTL segundos, para que un lote de subidas
+# haga como mucho una petición.
+# Return: conjunto de ids, o None si no se ha podido obtener la lista.
+#
+def remoteFileIDs():
+    if not syncFileList(RECONCILE_TTL):
+        return None
+    return md.ids_ficheros()
+
+
+# Funcion que firma, encripta y sube un fichero a la API salvo que el mismo fichero (con el mismo
+# contenido) ya se haya subido para los mismos destinatarios y siga en SecureBox, según la base
+# de datos local de subidas (ver metadatos.py).
+# Parámetros:
+#	file: dirección del fichero que se quiere firmar, encriptar y subir.
+#	dest_id: id en SecureBox del destinatario del fichero, o lista de ids.
+#	force: True para subirlo aunque ya se haya subido.
+#	kwargs: resto de parámetros de uploadEncrypted (chunked, formato, compresion, nombre, workers).
+# Return: id en SecureBox del fichero (el nuevo o el de la subida anterior). Si la API no acepta
+# la subida se lanza APIError.
+#
+def uploadFileOnce(file, dest_id, force=False, **kwargs):
+    sha256 = md.hash_fichero(file)
+
+    if not force:
+        file_id = md.buscar_subida(sha256, dest_id)
+        if file_id is not None:
+            remotos = remoteFileIDs()
+            if remotos is not None and file_id in remotos:
+                print('El fichero ya se subió para el mismo destinatario con ID ' + file_id + ', no se vuelve a subir (usa --force para subirlo de nuevo).')
+                return file_id
+            md.borrar_subida(file_id)
+
+    # El hash del fichero es el mismo que se firma, así que no se vuelve a leer el fichero para
+    # calcularlo.
+    r = uploadEncrypted(file, dest_id, resumen = sha256, **kwargs)
+    if r.status_code != 200:
+        raise errores.APIError(r)
+
+    file_id = r.json()['file_id']
+    md.guardar_subida(sha256, dest_id, file_id, kwargs.get('nombre') or file.split('/')[-1])
+    return file_id
+
+
 # Funcion que descarga un fichero de la API.
 # Parámetros:
 #	fileID: id del fichero en SecureBox.
@@ -34,22 +188,243 @@ def fileDownload(fileID, source_id):
     return filename
 
 
-# Funcion que genera una lista con los ficheros propios subidos a SecureBox.
-# Return: lista de los ficheros.
+# Funcion que descarga un fichero de la API y lo descifra y verifica a medida que se recibe, sin
+# guardarlo completo en memoria ni escribir el fichero cifrado en disco. En la carpeta downloads
+# solo se guarda el fichero descifrado, y solo si la firma es correcta.
+# Parámetros:
+#	fileID: id del fichero en SecureBox.
+#	source_id: id en SecureBox del emisor del fichero.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: dirección del fichero descargado si su firma es correcta, False en caso contrario. Si la
+# API no permite la descarga se lanza APIError.
 #
-def fileList():
-    print('Generando lista de ficheros')
-    r = utils.genericRequest('/files/list', None)
-    print(utils.requestResultInfo(r))
-    nfiles = r.json()['num_files']
-    result = 'Tienes ' + str(nfiles) + ' archivos guardados'
-    if nfiles == 0:
-        return result + "."
+def fileDownloadVerified(fileID, source_id, workers=None):
+    print('Descargando fichero de SecureBox')
+    with utils.sessionRequest('/files/download', json={'file_id' : fileID}, stream=True) as r:
+        print(utils.requestResultInfo(r))
+        if r.status_code != 200:
+            raise errores.APIError(r)
+
+        filename = './downloads/' + r.headers['Content-Disposition'].split('\"')[-2]
+        print('Descifrando y verificando fichero')
+        inp = utils.IteratorReader(r.iter_content(cr.CHUNK_SIZE))
+        if not cr.descifrar_verificar_stream(inp, filename, source_id, workers = workers):
+            return False
+
+        print(str(r.raw.tell()) + ' bytes descargados correctamente.')
+        return filename
+
+
+# Funcion que descarga un archivo subido con uploadDir y lo extrae a medida que se recibe y se
+# descifra, sin guardar el archivo en disco. Los miembros solo se dejan en el destino si la firma
+# es correcta (ver archivo.extraer_flujo).
+# Parámetros:
+#	fileID: id del archivo en SecureBox.
+#	source_id: id en SecureBox del emisor.
+#	destino: directorio en el que se extrae.
+#	workers: número de procesos entre los que se reparten los trozos (contenedor.WORKERS si es
+#	None).
+# Return: lista con las carpetas y ficheros extraídos si la firma es correcta, False en caso
+# contrario. Si la API no permite la descarga se lanza APIError, y si el archivo está truncado o
+# alguno de sus trozos se ha modificado, ValueError.
+#
+def downloadDir(fileID, source_id, destino='./downloads/', workers=None):
+    key = ig.userGetRSAKey(source_id)
+    print('Descargando archivo de SecureBox')
+    with utils.sessionRequest('/files/download', json={'file_id' : fileID}, stream=True) as r:
+        print(utils.requestResultInfo(r))
+        if r.status_code != 200:
+            raise errores.APIError(r)
+
+        print('Descifrando, verificando y extrayendo archivo')
+        inp = utils.IteratorReader(r.iter_content(cr.CHUNK_SIZE))
+        extraidos = archivo.extraer_flujo(inp, key, destino, workers)
+        if extraidos is None:
+            return False
+
+        print(str(r.raw.tell()) + ' bytes descargados correctamente.')
+        return extraidos
+
+
+# Funcion que descarga un fichero de la API de forma que, si la descarga se interrumpe, se puede
+# continuar desde donde se quedó en lugar de empezar de cero. El fichero cifrado se guarda en un
+# fichero parcial oculto en la carpeta encriptado y se anota en un diario (ver reanudacion.py)
+# cuántos bytes se han escrito en disco; al reintentarlo (en la misma ejecución, hasta
+# utils.RETRIES veces, o en otra) se pide solo el resto con una petición con cabecera Range. Si el
+# servidor no admite rangos o el fichero ha cambiado, se descarga de nuevo completo. Al terminar la
+# descarga, el fichero se descifra y se verifica como con --decrypt_check.
+# Parámetros:
+#	fileID: id del fichero en SecureBox.
+#	source_id: id en SecureBox del emisor del fichero.
+#	workers: número de procesos entre los que se reparten los trozos en el formato 'gcm'
+#	(contenedor.WORKERS si es None).
+# Return: dirección del fichero descargado si su firma es correcta, False en caso contrario. Si la
+# API no permite la descarga se lanza APIError.
+#
+def fileDownloadResumable(fileID, source_id, workers=None):
+    parte = './encriptado/.' + fileID + '.part'
+    ruta = reanudacion.ruta_estado('descarga', fileID)
+
+    for intento in range(utils.RETRIES + 1):
+        estado = reanudacion.leer_estado(ruta)
+        if estado is None or not os.path.exists(parte) or os.path.getsize(parte) < estado['recibido']:
+            estado = {'file_id': fileID, 'recibido': 0}
+
+        if estado['recibido']:
+            print('Reanudando la descarga desde el byte ' + str(estado['recibido']))
+        else:
+            print('Descargando fichero de SecureBox')
+
+        try:
+            _downloadPart(fileID, parte, ruta, estado)
+        except OSError as e:
+            print('Descarga interrumpida en el byte ' + str(estado['recibido']) + ': ' + str(e))
+            time.sleep(utils.BACKOFF * 2 ** intento)
+            continue
+
+        filename = './encriptado/' + estado['filename']
+        os.replace(parte, filename)
+        reanudacion.borrar_estado(ruta)
+        print(str(estado['total']) + ' bytes descargados correctamente.')
+        if not cr.desencriptar_verificar(filename, source_id, workers = workers):
+            return False
+        return './downloads/' + estado['filename']
+
+    print('No se ha podido completar la descarga, vuelve a ejecutar la orden para continuarla.')
+    return False
+
+
+# Funcion que realiza un intento de la descarga de fileDownloadResumable, desde el byte que indica
+# el diario, guardando el diario cada reanudacion.INTERVALO bytes.
+# Parámetros:
+#	fileID: id del fichero en SecureBox.
+#	parte: dirección del fichero parcial.
+#	ruta: dirección del diario.
+#	estado: diccionario con el estado de la descarga, que se actualiza.
+# Return: True si la descarga se ha completado. Si la API devuelve un error se lanza APIError, y si
+# se interrumpe la conexión se lanza la excepción (OSError) con el diario ya guardado.
+#
+def _downloadPart(fileID, parte, ruta, estado):
+    cabeceras = {'Range': 'bytes=' + str(estado['recibido']) + '-'} if estado['recibido'] else {}
+
+    with utils.sessionRequest('/files/download', json={'file_id' : fileID}, stream=True, headers=cabeceras) as r:
+        if r.status_code == 416:
+            r.close()
+            estado['recibido'] = 0
+            return _downloadPart(fileID, parte, ruta, estado)
+        if r.status_code not in (200, 206):
+            print(utils.requestResultInfo(r))
+            raise errores.APIError(r)
 
-    result = result + ":"
-    for file in r.json()['files_list']:
-        result += "\n- " + str(file)
-    return result
+        total = int(r.headers['Content-Range'].split('/')[-1]) if r.status_code == 206 else int(r.headers['content-length'])
+        if r.status_code == 200 or total != estado.get('total'):
+            estado['recibido'] = 0
+            if r.status_code == 206:
+                r.close()
+                return _downloadPart(fileID, parte, ruta, estado)
+
+        estado['total'] = total
+        estado['filename'] = r.headers['Content-Disposition'].split('\"')[-2]
+
+        with open(parte, 'r+b' if estado['recibido'] else 'wb') as outp:
+            outp.truncate(estado['recibido'])
+            outp.seek(estado['recibido'])
+            pendiente = 0
+            try:
+                for chunk in r.iter_content(cr.CHUNK_SIZE):
+                    outp.write(chunk)
+                    pendiente += len(chunk)
+                    if pendiente >= reanudacion.INTERVALO:
+                        reanudacion.sincronizar(outp)
+                        estado['recibido'] += pendiente
+                        reanudacion.guardar_estado(ruta, estado)
+                        pendiente = 0
+            finally:
+                reanudacion.sincronizar(outp)
+                estado['recibido'] += pendiente
+                reanudacion.guardar_estado(ruta, estado)
+
+        if estado['recibido'] != total:
+            raise IOError('La descarga ha terminado antes de tiempo.')
+        return True
+
+
+# Funcion que obtiene los ficheros propios subidos a SecureBox de la copia local de la lista, que
+# se actualiza antes si tiene más de LIST_TTL segundos o si se pide. Si no se puede actualizar
+# (por ejemplo sin conexión) se usa la que había.
+# Parámetros:
+#	refresh: True para actualizar la copia local aunque sea reciente.
+#	prefix: si no es None, solo los ficheros cuyo nombre empieza por él.
+#	min_size: si no es None, solo los ficheros de tamaño conocido mayor o igual (en bytes).
+#	max_size: si no es None, solo los ficheros de tamaño conocido menor o igual (en bytes).
+# Return: generador con un diccionario por fichero (fileID, fileName, size y date), ordenados por
+# nombre.
+#
+def fileList(refresh=False, prefix=None, min_size=None, max_size=None):
+    if not syncFileList(0 if refresh else LIST_TTL):
+        ultima = md.ultima_sincronizacion()
+        if ultima is None:
+            print('Se muestran solo los ficheros subidos desde este cliente.', file = sys.stderr)
+        else:
+            print('Se muestra la lista guardada el ' + formatDate(ultima) + '.', file = sys.stderr)
+    return md.listar_ficheros(prefix, min_size, max_size)
+
+
+# Funcion que da formato a una fecha de la lista de ficheros.
+# Parámetros:
+#	fecha: timestamp, o None si no se conoce.
+# Return: fecha con el formato AAAA-MM-DD HH:MM:SS, o None.
+#
+def formatDate(fecha):
+    if fecha is None:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fecha))
+
+
+# Funcion que muestra los ficheros de fileList a medida que se leen de la copia local, sin
+# construir antes toda la salida.
+# Parámetros:
+#	files: ficheros devueltos por fileList.
+#	output: 'table' para mostrarlos en una tabla o 'json' para mostrarlos como una lista JSON.
+# Return: número de ficheros mostrados.
+#
+def printFileList(files, output='table'):
+    nfiles = 0
+    if output == 'json':
+        print('[')
+        for file in files:
+            file = dict(file, date = formatDate(file['date']))
+            print(('  ' if nfiles == 0 else ', ') + json.dumps(file))
+            nfiles += 1
+        print(']')
+        return nfiles
+
+    fila = '{:<10} {:>12}  {:<19}  {}'
+    for file in files:
+        if nfiles == 0:
+            print(fila.format('ID', 'Tamano', 'Subido', 'Nombre'))
+        tam = '-' if file['size'] is None else file['size']
+        print(fila.format(file['fileID'], tam, formatDate(file['date']) or '-', file['fileName']))
+        nfiles += 1
+    print(str(nfiles) + ' archivos.')
+    return nfiles
+
+
+# Funcion que muestra los miembros de un archivo (ver archivo.py) en una tabla.
+# Parámetros:
+#	members: entradas del índice del archivo.
+# Return: número de ficheros del archivo.
+#
+def printArchive(members):
+    fila = '{:<4} {:>12}  {:<19}  {}'
+    print(fila.format('Tipo', 'Tamano', 'Modificado', 'Nombre'))
+    nfiles = 0
+    for member in members:
+        print(fila.format(member['type'], member['size'] if member['type'] == 'file' else '-', formatDate(member['mtime']), member['name']))
+        nfiles += member['type'] == 'file'
+    print(str(nfiles) + ' ficheros.')
+    return nfiles
 
 
 # Funcion que elimina un fichero subido a SecureeBox.
@@ -61,4 +436,7 @@ def fileDelete(fileID):
     print('Eliminando fichero de ID ' + fileID)
     r = utils.genericRequest('/files/delete', {'file_id' : fileID})
     print(utils.requestResultInfo(r))
+    if r.status_code == 200:
+        md.borrar_fichero(fileID)
+        md.borrar_subida(fileID)
     return r
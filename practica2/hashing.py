@@ -0,0 +1,225 @@
+from Crypto.Hash import SHA256
+from collections import deque
+import concurrent.futures as cf
+import hashlib
+import mmap
+import os
+import stat
+
+# Tamaño de los bloques que se leen de ficheros que no se pueden mapear en memoria (tuberías,
+# sockets...) y de las porciones del mapa en memoria que se pasan de una vez a la función hash.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Número de hilos con los que se calculan los hashes de las hojas de un árbol de Merkle. hashlib
+# libera el GIL mientras calcula el hash de bloques grandes, por lo que los hilos usan varios
+# núcleos sin el coste de arrancar procesos.
+HILOS = os.cpu_count() or 1
+
+
+# Implementaciones de SHA256 disponibles. 'openssl' es la de hashlib cuando Python está enlazado
+# con OpenSSL, que usa las instrucciones SHA del procesador si existen; 'builtin' es la
+# implementación propia de Python y 'pycryptodome' la de Crypto.Hash.
+#
+BACKENDS = {'pycryptodome': SHA256.new}
+
+if getattr(hashlib.sha256, '__name__', '') == 'openssl_sha256':
+    BACKENDS['openssl'] = hashlib.sha256
+
+try:
+    import _sha256
+    BACKENDS['builtin'] = _sha256.sha256
+except ImportError:
+    try:
+        import _sha2
+        BACKENDS['builtin'] = _sha2.sha256
+    except ImportError:
+        pass
+
+# Implementación usada por defecto: la más rápida de las disponibles.
+BACKEND = 'openssl' if 'openssl' in BACKENDS else 'pycryptodome'
+
+
+# Clase que representa un resumen SHA256 calculado con cualquiera de los BACKENDS, con la misma
+# interfaz que Crypto.Hash (en particular el atributo oid), de modo que se puede firmar y
+# verificar directamente con PKCS1_v1_5.
+#
+class HashSHA256(object):
+    oid = SHA256.new().oid
+    digest_size = SHA256.digest_size
+    block_size = SHA256.block_size
+
+    def __init__(self, data=None, backend=None):
+        super(HashSHA256, self).__init__()
+        self.backend = backend or BACKEND
+        self._hash = BACKENDS[self.backend]()
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self._hash.update(data)
+        return self
+
+    def digest(self):
+        return self._hash.digest()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def copy(self):
+        clon = HashSHA256(backend=self.backend)
+        clon._hash = self._hash.copy()
+        return clon
+
+    def new(self, data=None):
+        return HashSHA256(data, self.backend)
+
+
+# Clase que representa un resumen SHA256 ya calculado (por ejemplo, el guardado en la base de datos
+# local, ver metadatos.py), para firmarlo con PKCS1_v1_5 sin volver a leer los datos.
+#
+class ResumenSHA256(object):
+    oid = HashSHA256.oid
+    digest_size = HashSHA256.digest_size
+    block_size = HashSHA256.block_size
+
+    def __init__(self, resumen):
+        super(ResumenSHA256, self).__init__()
+        self.resumen = bytes.fromhex(resumen)
+
+    def digest(self):
+        return self.resumen
+
+    def hexdigest(self):
+        return self.resumen.hex()
+
+
+# Funcion que calcula el resumen SHA256 de un fichero abierto. Si es un fichero regular se mapea en
+# memoria con mmap y se pasa directamente a la función hash, sin copias intermedias; en otro caso
+# (tuberías, entrada estándar...) se lee con bloques grandes sobre un buffer reutilizable.
+# Parámetros:
+#	inp: fichero abierto en modo binario, situado al principio de los datos.
+#	backend: implementación de SHA256 que se quiere usar (la más rápida por defecto).
+#	usar_mmap: False para forzar la lectura por bloques aunque el fichero sea regular.
+# Return: resumen hash (HashSHA256) del contenido del fichero desde la posición actual.
+#
+def hash_stream(inp, backend=None, usar_mmap=True):
+    hash_code = HashSHA256(backend=backend)
+
+    try:
+        fd = inp.fileno()
+        info = os.fstat(fd)
+        inicio = inp.tell()
+    except (AttributeError, OSError, ValueError):
+        fd = None
+
+    if usar_mmap and fd is not None and stat.S_ISREG(info.st_mode) and info.st_size > inicio:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapa:
+            if hasattr(mapa, 'madvise'):
+                mapa.madvise(mmap.MADV_SEQUENTIAL)
+            vista = memoryview(mapa)
+            try:
+                for i in range(inicio, len(vista), BLOCK_SIZE):
+                    hash_code.update(vista[i:i + BLOCK_SIZE])
+            finally:
+                vista.release()
+        inp.seek(info.st_size)
+        return hash_code
+
+    tam = BLOCK_SIZE
+    if fd is not None and stat.S_ISREG(info.st_mode):
+        tam = max(1, min(BLOCK_SIZE, info.st_size - inicio))
+
+    buf = memoryview(bytearray(tam))
+    n = inp.readinto(buf)
+    while n:
+        hash_code.update(buf[:n])
+        n = inp.readinto(buf)
+    return hash_code
+
+
+# Funcion que calcula el resumen SHA256 de un fichero a partir de su dirección.
+# Parámetros:
+#	file: dirección del fichero.
+#	backend: implementación de SHA256 que se quiere usar (la más rápida por defecto).
+#	usar_mmap: False para forzar la lectura por bloques.
+# Return: resumen hash (HashSHA256) del fichero.
+#
+def hash_file(file, backend=None, usar_mmap=True):
+    with open(file, 'rb') as inp:
+        return hash_stream(inp, backend, usar_mmap)
+
+
+# Árbol de Merkle sobre los trozos de tamaño fijo de un fichero. Cada hoja es el hash de un trozo
+# y cada nodo interno el hash de sus dos hijos (un nodo sin pareja sube tal cual al nivel
+# siguiente); las hojas y los nodos internos se distinguen por un prefijo, de modo que no se puede
+# hacer pasar un nodo interno por una hoja. Firmar la raíz equivale a firmar todas las hojas: los
+# hashes de los trozos se calculan en paralelo y, al verificar, basta con comparar cada hoja con
+# la firmada para saber qué trozos se han modificado.
+PREFIJO_HOJA = b'\x00'
+PREFIJO_NODO = b'\x01'
+
+
+# Funcion que calcula el hash de una hoja del árbol de Merkle.
+# Parámetros:
+#	datos: trozo del fichero.
+# Return: hash de la hoja (32 bytes).
+#
+def hash_hoja(datos):
+    return HashSHA256(PREFIJO_HOJA).update(datos).digest()
+
+
+# Funcion que calcula la raíz del árbol de Merkle a partir de sus hojas.
+# Parámetros:
+#	hojas: lista con los hashes de las hojas, en orden.
+# Return: hash de la raíz (32 bytes). Sin hojas, el hash de una hoja vacía.
+#
+def raiz_merkle(hojas):
+    nivel = list(hojas) or [hash_hoja(b'')]
+    while len(nivel) > 1:
+        siguiente = [HashSHA256(PREFIJO_NODO + nivel[i] + nivel[i + 1]).digest() for i in range(0, len(nivel) - 1, 2)]
+        if len(nivel) % 2:
+            siguiente.append(nivel[-1])
+        nivel = siguiente
+    return nivel[0]
+
+
+# Funcion que divide una serie de fragmentos de cualquier tamaño en trozos de tamaño fijo.
+# Parámetros:
+#	bloques: iterable con los fragmentos (pueden ser vistas sobre un buffer reutilizado).
+#	tam: tamaño de los trozos.
+# Return: generador de los trozos (bytes nuevos), todos de tamaño tam salvo el último.
+#
+def trozos_fijos(bloques, tam):
+    pendiente = bytearray()
+    for buf in bloques:
+        pendiente += buf
+        while len(pendiente) >= tam:
+            yield bytes(pendiente[:tam])
+            del pendiente[:tam]
+    if pendiente:
+        yield bytes(pendiente)
+
+
+# Funcion que calcula los hashes de las hojas de un árbol de Merkle repartiéndolos entre HILOS
+# hilos. Solo se mantienen en curso unos pocos trozos por hilo, de modo que la memoria usada no
+# depende del tamaño del fichero.
+# Parámetros:
+#	trozos: iterable con los trozos del fichero.
+#	hilos: número de hilos (HILOS si es None).
+# Return: generador de los hashes de las hojas, en orden.
+#
+def hojas_merkle(trozos, hilos=None):
+    hilos = HILOS if hilos is None else hilos
+    if hilos <= 1:
+        for trozo in trozos:
+            yield hash_hoja(trozo)
+        return
+
+    with cf.ThreadPoolExecutor(max_workers = hilos) as pool:
+        pendientes = deque()
+        for trozo in trozos:
+            pendientes.append(pool.submit(hash_hoja, trozo))
+            if len(pendientes) >= 2 * hilos:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
@@ -1,14 +1,34 @@
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+import errores
+import metadatos as md
+import json
+import os
+import threading
+import time
 import utils
 
+# Caché de claves públicas: en memoria se guardan las claves ya importadas con RSA.importKey y en
+# disco (KEY_CACHE_FILE) las claves en formato PEM, que caducan pasados KEY_CACHE_TTL segundos.
+KEY_CACHE_FILE = './.files/pubkeys.json'
+KEY_CACHE_TTL = 24 * 60 * 60
+
+_key_cache = {}
+_key_cache_lock = threading.Lock()
+_key_cache_stats = {'memoria': 0, 'disco': 0, 'fallos': 0}
+
 class User(object):
-    def __init__(self, name, ID, email, publicKey):
+    def __init__(self, name, ID, email, publicKey, fingerprint=None):
         super(User, self).__init__()
         self.name = name
         self.ID = ID
         self.email = email
         self.publicKey = publicKey
+        self.fingerprint = fingerprint
 
     def str(self):
+        if self.fingerprint:
+            return str(self.name) + ', ' + str(self.email) + ', ID: '+ str(self.ID) + ', huella: ' + self.fingerprint
         return str(self.name) + ', ' + str(self.email) + ', ID: '+ str(self.ID)
 
     def __repr__(self):
@@ -40,12 +60,125 @@ def generateUser(name, email, publicKey):
 # Return: clave pública del usuario.
 #
 def userGetPublickey(userID):
+    return _cachedPublicKey(userID)['pem']
+
+
+# Funcion que obtiene la clave pública de un usuario de SecureBox ya importada, de modo que una
+# misma clave solo se descarga e importa una vez por proceso.
+# Parámetros:
+#	userID: id del usuario en SecureBox.
+# Return: clave pública del usuario (objeto RSA).
+#
+def userGetRSAKey(userID):
+    entrada = _cachedPublicKey(userID)
+    if entrada['key'] is None:
+        entrada['key'] = RSA.importKey(entrada['pem'])
+    return entrada['key']
+
+
+# Funcion que busca la clave pública de un usuario primero en la caché en memoria, después en la
+# caché en disco y, si no está en ninguna o ha caducado, la pide a la API.
+# Parámetros:
+#	userID: id del usuario en SecureBox.
+# Return: entrada de la caché en memoria con la clave en PEM ('pem') e importada ('key').
+#
+def _cachedPublicKey(userID):
+    ahora = time.time()
+
+    with _key_cache_lock:
+        entrada = _key_cache.get(userID)
+        if entrada is not None and ahora - entrada['ts'] < KEY_CACHE_TTL:
+            _key_cache_stats['memoria'] += 1
+            return entrada
+
+        disco = _readKeyCache().get(userID)
+        if disco is not None and ahora - disco['ts'] < KEY_CACHE_TTL:
+            _key_cache_stats['disco'] += 1
+            entrada = {'pem': disco['publicKey'].encode(), 'key': None, 'ts': disco['ts']}
+            _key_cache[userID] = entrada
+            return entrada
+
+        _key_cache_stats['fallos'] += 1
+
+    pem = _requestPublicKey(userID)
+    entrada = {'pem': pem, 'key': None, 'ts': ahora}
+
+    with _key_cache_lock:
+        _key_cache[userID] = entrada
+        cache = _readKeyCache()
+        cache[userID] = {'publicKey': pem.decode(), 'ts': ahora}
+        _writeKeyCache(cache)
+
+    return entrada
+
+
+# Funcion que pide a la API la clave pública de un usuario de SecureBox.
+# Parámetros:
+#	userID: id del usuario en SecureBox.
+# Return: clave pública del usuario.
+#
+def _requestPublicKey(userID):
     print('Recuperando clave pública de ID ' + userID)
     r = utils.genericRequest('/users/getPublicKey', {'userID' : userID})
     print(utils.requestResultInfo(r))
     return r.json()['publicKey'].encode()
 
 
+# Funcion que lee la caché de claves públicas en disco.
+# Return: diccionario con la clave en PEM ('publicKey') y la fecha ('ts') de cada usuario.
+#
+def _readKeyCache():
+    try:
+        with open(KEY_CACHE_FILE) as inp:
+            return json.load(inp)
+    except (OSError, ValueError):
+        return {}
+
+
+# Funcion que guarda la caché de claves públicas en disco, de forma atómica para que otros
+# procesos nunca lean un fichero a medio escribir.
+# Parámetros:
+#	cache: diccionario con la clave y la fecha de cada usuario.
+#
+def _writeKeyCache(cache):
+    temp = KEY_CACHE_FILE + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    try:
+        with open(temp, 'w') as outp:
+            json.dump(cache, outp)
+        os.replace(temp, KEY_CACHE_FILE)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# Funcion que elimina claves públicas de la caché (en memoria y en disco), por ejemplo si un
+# usuario ha cambiado de clave.
+# Parámetros:
+#	userIDs: ids de los usuarios cuyas claves se quieren eliminar, o None para vaciar la caché.
+#
+def invalidatePublicKeys(userIDs=None):
+    with _key_cache_lock:
+        if userIDs is None:
+            _key_cache.clear()
+            _writeKeyCache({})
+            return
+
+        cache = _readKeyCache()
+        for userID in userIDs:
+            _key_cache.pop(userID, None)
+            cache.pop(userID, None)
+        _writeKeyCache(cache)
+
+
+# Funcion que devuelve los contadores de la caché de claves públicas del proceso actual.
+# Return: diccionario con los aciertos en memoria ('memoria'), en disco ('disco') y las claves
+# que se han tenido que pedir a la API ('fallos').
+#
+def publicKeyCacheStats():
+    with _key_cache_lock:
+        return dict(_key_cache_stats)
+
+
 # Funcion que elimina un usuario de SecureBox.
 # Parámetros:
 #	userID: id del usuario en SecureBox.
@@ -58,22 +191,70 @@ def userDelete(userID):
     return r
 
 
-# Funcion que busca los usuarios de SecureBox con un dato determinado y genera una lista con ellos.
+# Funcion que calcula la huella de una clave pública, la misma con la que se identifica a cada
+# destinatario en la cabecera de los ficheros cifrados (ver crypt.huella).
 # Parámetros:
-#	dataSearch: dato que deben contener los usuarios.
-# Return: lista de usuarios.
+#	publicKey: clave pública en PEM.
+# Return: huella en hexadecimal, o None si la clave no es válida.
 #
-def userSearch(dataSearch):
-    print('Buscando usuario ' + dataSearch + ' en el servidor')
-    r = utils.genericRequest('/users/search', {'data_search' : dataSearch})
+def publicKeyFingerprint(publicKey):
+    try:
+        key = RSA.importKey(publicKey)
+    except (ValueError, IndexError, TypeError):
+        return None
+    return SHA256.new(key.publickey().exportKey('DER')).hexdigest()[:16]
+
+
+# Funcion que busca los usuarios de SecureBox con un dato determinado. Los usuarios encontrados en
+# la API se guardan en la copia local del directorio (ver metadatos.py), que se usa en lugar de la
+# API si se pide o si no se puede acceder a ella.
+# Parámetros:
+#	dataSearch: dato que deben contener los usuarios (en su nombre o email).
+#	offline: True para buscar solo en la copia local del directorio.
+# Return: lista de usuarios. Si la API responde con un error se lanza APIError.
+#
+def userSearch(dataSearch, offline=False):
+    if not offline:
+        print('Buscando usuario ' + dataSearch + ' en el servidor')
+        try:
+            r = utils.genericRequest('/users/search', {'data_search' : dataSearch})
+        except OSError as e:
+            print('No se ha podido acceder a SecureBox (' + str(e) + '), se busca en la copia local.')
+        else:
+            print(utils.requestResultInfo(r))
+            if r.status_code != 200:
+                raise errores.APIError(r)
+
+            users = [User(entry['nombre'], entry['userID'], entry['email'], entry['publicKey'],
+                          publicKeyFingerprint(entry['publicKey'])) for entry in r.json()]
+            md.guardar_usuarios([(u.ID, u.name, u.email, u.fingerprint) for u in users], dataSearch)
+            return users
+
+    return [User(nombre, user_id, email, None, huella) for user_id, nombre, email, huella in md.buscar_usuarios(dataSearch)]
+
+
+# Funcion que actualiza la copia local completa del directorio de usuarios, pidiendo a la API todos
+# los usuarios (búsqueda vacía) y eliminando los que ya no están.
+# Return: número de usuarios del directorio, o None si no se ha podido actualizar.
+#
+def userDirectorySync():
+    print('Actualizando el directorio de usuarios')
+    r = utils.genericRequest('/users/search', {'data_search' : ''})
     print(utils.requestResultInfo(r))
     if r.status_code != 200:
-        return ''
+        return None
 
-    result = str(len(r.json())) + ' usuarios encontrados: \n'
-    i = 1
-    for entry in r.json():
-        result += '[' + str(i) + '] ' + User(entry['nombre'], entry['userID'], entry['email'], entry['publicKey']).str() + '\n'
-        i += 1
+    md.guardar_usuarios([(entry['userID'], entry['nombre'], entry['email'], publicKeyFingerprint(entry['publicKey']))
+                         for entry in r.json()], '')
+    return len(r.json())
 
-    return result
+
+# Funcion que muestra los usuarios encontrados por SecureBoxClient.search (ver cliente.py), uno
+# por línea.
+# Parámetros:
+#	users: lista de usuarios (diccionarios con userID, name, email y fingerprint).
+#
+def printUsers(users):
+    print(str(len(users)) + ' usuarios encontrados: ')
+    for i, user in enumerate(users, 1):
+        print('[' + str(i) + '] ' + User(user['name'], user['userID'], user['email'], None, user['fingerprint']).str())
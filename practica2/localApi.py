@@ -0,0 +1,246 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse as arg
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+# Servidor local que imita la API REST de SecureBox (mismas rutas, parámetros y respuestas), para
+# poder probar y medir el cliente sin depender del servidor de la universidad. Los usuarios se
+# guardan en memoria y los ficheros subidos en un directorio. Atiende cada conexión en un hilo y
+# mantiene las conexiones abiertas (HTTP/1.1 keep-alive).
+
+
+# Clase que guarda el estado del servidor: usuarios y ficheros subidos por cada token.
+#
+class Almacen(object):
+    def __init__(self, directorio):
+        super(Almacen, self).__init__()
+        self.directorio = directorio
+        self.usuarios = {}
+        self.ficheros = {}
+        self.lock = threading.Lock()
+
+    def ruta(self, fileID):
+        return os.path.join(self.directorio, fileID)
+
+
+# Clase que atiende las peticiones HTTP a la API.
+#
+class Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    almacen = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def token(self):
+        return self.headers.get('Authorization', '').split(' ')[-1]
+
+    def leer_cuerpo(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            partes = []
+            while True:
+                tam = int(self.rfile.readline().split(b';')[0], 16)
+                if tam == 0:
+                    self.rfile.readline()
+                    return b''.join(partes)
+                partes.append(self.rfile.read(tam))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def responder(self, codigo, cuerpo, tipo='application/json', cabeceras=None):
+        if tipo == 'application/json':
+            cuerpo = json.dumps(cuerpo).encode()
+        self.send_response(codigo)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def error(self, codigo, descripcion):
+        self.responder(codigo, {'error_code': 'ERR' + str(codigo), 'description': descripcion})
+
+    def do_POST(self):
+        cuerpo = self.leer_cuerpo()
+        ruta = self.path.split('/api', 1)[-1]
+
+        if ruta == '/files/upload':
+            return self.subir(cuerpo)
+
+        try:
+            datos = json.loads(cuerpo) if cuerpo else {}
+        except ValueError:
+            return self.error(400, 'JSON incorrecto')
+
+        acciones = {
+            '/users/register': self.registrar,
+            '/users/getPublicKey': self.clave_publica,
+            '/users/search': self.buscar,
+            '/users/delete': self.borrar_usuario,
+            '/files/download': self.descargar,
+            '/files/list': self.listar,
+            '/files/delete': self.borrar_fichero,
+        }
+        if ruta not in acciones:
+            return self.error(404, 'Ruta desconocida')
+        return acciones[ruta](datos or {})
+
+    def registrar(self, datos):
+        almacen = self.almacen
+        with almacen.lock:
+            userID = almacen.usuarios.get(self.token(), {}).get('userID') or uuid.uuid4().hex[:7]
+            almacen.usuarios[self.token()] = {
+                'userID': userID,
+                'nombre': datos.get('nombre'),
+                'email': datos.get('email'),
+                'publicKey': datos.get('publicKey'),
+            }
+        self.responder(200, {'nombre': datos.get('nombre'), 'userID': userID})
+
+    def clave_publica(self, datos):
+        for usuario in list(self.almacen.usuarios.values()):
+            if usuario['userID'] == datos.get('userID'):
+                return self.responder(200, {'publicKey': usuario['publicKey']})
+        self.error(401, 'Usuario no encontrado')
+
+    def buscar(self, datos):
+        cadena = (datos.get('data_search') or '').lower()
+        encontrados = [u for u in list(self.almacen.usuarios.values())
+                       if cadena in (u['nombre'] or '').lower() or cadena in (u['email'] or '').lower()]
+        self.responder(200, encontrados)
+
+    def borrar_usuario(self, datos):
+        with self.almacen.lock:
+            for token, usuario in list(self.almacen.usuarios.items()):
+                if usuario['userID'] == datos.get('userID'):
+                    del self.almacen.usuarios[token]
+                    return self.responder(200, {'userID': datos.get('userID')})
+        self.error(401, 'Usuario no encontrado')
+
+    def subir(self, cuerpo):
+        limite = self.headers.get('Content-Type', '').split('boundary=')[-1].strip('"').encode()
+        for parte in cuerpo.split(b'--' + limite):
+            cabeceras, _, datos = parte.partition(b'\r\n\r\n')
+            if b'name="ufile"' not in cabeceras:
+                continue
+            nombre = cabeceras.split(b'filename="')[-1].split(b'"')[0].decode()
+            datos = datos[:-2] if datos.endswith(b'\r\n') else datos
+            fileID = uuid.uuid4().hex[:8]
+            with open(self.almacen.ruta(fileID), 'wb') as outp:
+                outp.write(datos)
+            with self.almacen.lock:
+                self.almacen.ficheros.setdefault(self.token(), {})[fileID] = nombre
+            return self.responder(200, {'file_id': fileID, 'file_size': len(datos)})
+        self.error(400, 'Falta el fichero ufile')
+
+    def descargar(self, datos):
+        fileID = datos.get('file_id')
+        for ficheros in list(self.almacen.ficheros.values()):
+            if fileID in ficheros:
+                with open(self.almacen.ruta(fileID), 'rb') as inp:
+                    tam = os.fstat(inp.fileno()).st_size
+                    rango = self.leer_rango(tam)
+                    if rango is False:
+                        return self.responder(416, b'', 'application/octet-stream', {'Content-Range': 'bytes */' + str(tam)})
+
+                    inicio, fin = rango or (0, tam)
+                    self.send_response(206 if rango else 200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(fin - inicio))
+                    self.send_header('Content-Disposition', 'attachment; filename="' + ficheros[fileID] + '"')
+                    self.send_header('Accept-Ranges', 'bytes')
+                    if rango:
+                        self.send_header('Content-Range', 'bytes ' + str(inicio) + '-' + str(fin - 1) + '/' + str(tam))
+                    self.end_headers()
+                    inp.seek(inicio)
+                    restante = fin - inicio
+                    while restante > 0:
+                        datos = inp.read(min(restante, 1024 * 1024))
+                        if not datos:
+                            break
+                        self.wfile.write(datos)
+                        restante -= len(datos)
+                return
+        self.error(401, 'Fichero no encontrado')
+
+    # Interpreta la cabecera Range de la petición (un único rango de bytes): devuelve None si no
+    # hay, la tupla (inicio, fin) sin incluir el fin, o False si el rango no se puede satisfacer.
+    def leer_rango(self, tam):
+        cabecera = self.headers.get('Range', '')
+        if not cabecera.startswith('bytes=') or ',' in cabecera:
+            return None
+        inicio, _, fin = cabecera[len('bytes='):].partition('-')
+        try:
+            if inicio:
+                inicio, fin = int(inicio), (int(fin) + 1 if fin else tam)
+            else:
+                inicio, fin = max(0, tam - int(fin)), tam
+        except ValueError:
+            return None
+        if inicio >= tam or fin <= inicio:
+            return False
+        return inicio, min(fin, tam)
+
+    def listar(self, datos):
+        ficheros = self.almacen.ficheros.get(self.token(), {})
+        lista = [{'fileID': fileID, 'fileName': nombre} for fileID, nombre in list(ficheros.items())]
+        self.responder(200, {'num_files': len(lista), 'files_list': lista})
+
+    def borrar_fichero(self, datos):
+        fileID = datos.get('file_id')
+        with self.almacen.lock:
+            ficheros = self.almacen.ficheros.get(self.token(), {})
+            if fileID not in ficheros:
+                return self.error(401, 'Fichero no encontrado')
+            del ficheros[fileID]
+        os.remove(self.almacen.ruta(fileID))
+        self.responder(200, {'file_id': fileID})
+
+
+# Funcion que crea el servidor local de la API y lo arranca en un hilo.
+# Parámetros:
+#	puerto: puerto en el que escucha el servidor (0 para uno libre cualquiera).
+#	directorio: directorio donde se guardan los ficheros subidos (uno temporal si es None).
+# Return: el servidor arrancado. Su URL base es 'http://127.0.0.1:<puerto>/api'.
+#
+def arrancar(puerto=0, directorio=None):
+    if directorio is None:
+        directorio = tempfile.mkdtemp(prefix='securebox_api_')
+    os.makedirs(directorio, exist_ok=True)
+
+    manejador = type('ManejadorLocal', (Manejador,), {'almacen': Almacen(directorio)})
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), manejador)
+    servidor.daemon_threads = True
+    servidor.url = 'http://127.0.0.1:' + str(servidor.server_address[1]) + '/api'
+    threading.Thread(target = servidor.serve_forever, daemon = True).start()
+    return servidor
+
+
+# Funcion que para el servidor local y borra los ficheros subidos.
+# Parámetros:
+#	servidor: servidor devuelto por arrancar.
+#
+def parar(servidor):
+    servidor.shutdown()
+    servidor.server_close()
+    shutil.rmtree(servidor.RequestHandlerClass.almacen.directorio, ignore_errors = True)
+
+
+if __name__ == '__main__':
+    parser = arg.ArgumentParser(description = 'Servidor local que imita la API de SecureBox:')
+    parser.add_argument("--port", nargs = 1, type = int, default = [8080], help = 'Puerto en el que escucha el servidor.')
+    parser.add_argument("--dir", nargs = 1, default = ['./.api'], help = 'Directorio donde se guardan los ficheros subidos.')
+    args = parser.parse_args()
+
+    servidor = arrancar(args.port[0], args.dir[0])
+    print('API local escuchando en ' + servidor.url + ' (exporta SECUREBOX_URL con esta dirección)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.shutdown()
@@ -0,0 +1,390 @@
+from contextlib import closing
+import hashing
+import os
+import sqlite3
+import threading
+import time
+
+# Base de datos local (SQLite) con los metadatos de SecureBox que se quieren conservar entre
+# ejecuciones:
+#	hashes: hash SHA256 de los ficheros locales, junto con su tamaño y fecha de modificación,
+#	        para no volver a calcularlo mientras el fichero no cambie.
+#	subidas: ficheros ya subidos, por hash del fichero en claro y destinatarios, con su id en
+#	         SecureBox, para no volver a subir un fichero que ya tienen los mismos destinatarios.
+#	ficheros: copia local de la lista de ficheros propios de SecureBox (id, nombre y, si se han
+#	          subido desde este cliente, tamaño y fecha de subida), para poder listarlos sin
+#	          pedir la lista completa a la API cada vez, e incluso sin conexión.
+#	usuarios: copia local del directorio de usuarios de SecureBox (id, nombre, email y huella de
+#	          la clave pública), para poder buscarlos sin conexión.
+#	usuarios_gramas: índice invertido de los usuarios, con cada fragmento de 1 a LONG_GRAMA
+#	                 caracteres de su nombre y email (en minúsculas), para buscar cadenas
+#	                 contenidas en ellos sin recorrer todo el directorio.
+#	sincronizacion: fecha de la última vez que cada tabla se actualizó desde la API.
+#	cola: ficheros de las carpetas vigiladas (ver vigilancia.py), por ruta y destinatarios, con el
+#	      tamaño y la fecha de modificación con los que se encolaron, su estado ('pendiente',
+#	      'subido' o 'error'), los intentos fallidos y su id en SecureBox una vez subidos, para
+#	      continuar las subidas pendientes tras reiniciar sin volver a subir lo ya subido.
+# Cada operación abre su propia conexión, de modo que la base de datos se puede usar a la vez
+# desde varios hilos y procesos (--jobs, agente).
+DB_FILE = './.files/securebox.db'
+LONG_GRAMA = 3
+
+ESQUEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    ruta TEXT PRIMARY KEY,
+    tam INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS subidas (
+    sha256 TEXT NOT NULL,
+    destinos TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    nombre TEXT,
+    PRIMARY KEY (sha256, destinos)
+);
+CREATE INDEX IF NOT EXISTS subidas_file_id ON subidas (file_id);
+CREATE TABLE IF NOT EXISTS ficheros (
+    file_id TEXT PRIMARY KEY,
+    nombre TEXT,
+    tam INTEGER,
+    fecha REAL
+);
+CREATE TABLE IF NOT EXISTS usuarios (
+    user_id TEXT PRIMARY KEY,
+    nombre TEXT,
+    email TEXT,
+    huella TEXT,
+    fecha REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usuarios_gramas (
+    grama TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (grama, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usuarios_gramas_user_id ON usuarios_gramas (user_id);
+CREATE TABLE IF NOT EXISTS sincronizacion (
+    tabla TEXT PRIMARY KEY,
+    fecha REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cola (
+    ruta TEXT NOT NULL,
+    destinos TEXT NOT NULL,
+    carpeta TEXT NOT NULL,
+    tam INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    estado TEXT NOT NULL,
+    intentos INTEGER NOT NULL,
+    file_id TEXT,
+    PRIMARY KEY (ruta, destinos)
+);
+CREATE INDEX IF NOT EXISTS cola_carpeta ON cola (carpeta, destinos);
+'''
+
+_esquema_creado = set()
+_esquema_lock = threading.Lock()
+
+
+# Funcion que abre una conexión con la base de datos local, creando las tablas si no existen.
+# Return: conexión de sqlite3. Se debe cerrar al terminar (por ejemplo con closing).
+#
+def conectar():
+    db = sqlite3.connect(DB_FILE, timeout = 30)
+    with _esquema_lock:
+        if DB_FILE not in _esquema_creado:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(ESQUEMA)
+            _esquema_creado.add(DB_FILE)
+    return db
+
+
+# Funcion que calcula el hash SHA256 de un fichero local, reutilizando el guardado si el fichero
+# no ha cambiado de tamaño ni de fecha de modificación desde que se calculó.
+# Parámetros:
+#	file: dirección del fichero.
+# Return: hash en hexadecimal.
+#
+def hash_fichero(file):
+    ruta = os.path.realpath(file)
+    st = os.stat(ruta)
+
+    with closing(conectar()) as db:
+        fila = db.execute('SELECT sha256 FROM hashes WHERE ruta = ? AND tam = ? AND mtime = ?',
+                          (ruta, st.st_size, st.st_mtime_ns)).fetchone()
+        if fila:
+            return fila[0]
+
+        sha256 = hashing.hash_file(ruta).hexdigest()
+        with db:
+            db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (ruta, st.st_size, st.st_mtime_ns, sha256))
+        return sha256
+
+
+# Funcion que genera la clave con la que se guardan los destinatarios de una subida, que no
+# depende del orden en el que se indiquen.
+# Parámetros:
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+# Return: ids ordenados y separados por comas.
+#
+def clave_destinos(dest_id):
+    dest_ids = [dest_id] if isinstance(dest_id, str) else dest_id
+    return ','.join(sorted(set(dest_ids)))
+
+
+# Funcion que busca si un fichero ya se ha subido para los mismos destinatarios.
+# Parámetros:
+#	sha256: hash del fichero en claro.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+# Return: id en SecureBox del fichero subido, o None.
+#
+def buscar_subida(sha256, dest_id):
+    with closing(conectar()) as db:
+        fila = db.execute('SELECT file_id FROM subidas WHERE sha256 = ? AND destinos = ?',
+                          (sha256, clave_destinos(dest_id))).fetchone()
+    return fila[0] if fila else None
+
+
+# Funcion que guarda una subida realizada.
+# Parámetros:
+#	sha256: hash del fichero en claro.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#	file_id: id en SecureBox del fichero subido.
+#	nombre: nombre del fichero.
+#
+def guardar_subida(sha256, dest_id, file_id, nombre):
+    with closing(conectar()) as db, db:
+        db.execute('INSERT OR REPLACE INTO subidas VALUES (?, ?, ?, ?)', (sha256, clave_destinos(dest_id), file_id, nombre))
+
+
+# Funcion que elimina las subidas de un fichero que se ha borrado de SecureBox.
+# Parámetros:
+#	file_id: id en SecureBox del fichero.
+#
+def borrar_subida(file_id):
+    with closing(conectar()) as db, db:
+        db.execute('DELETE FROM subidas WHERE file_id = ?', (file_id,))
+
+
+# Funcion que elimina las subidas cuyos ficheros ya no están en SecureBox (porque se han borrado
+# desde otro cliente o los ha eliminado el servidor).
+# Parámetros:
+#	file_ids: ids de todos los ficheros que hay en SecureBox.
+# Return: número de subidas eliminadas.
+#
+def reconciliar_subidas(file_ids):
+    file_ids = set(file_ids)
+    with closing(conectar()) as db, db:
+        obsoletos = [(f,) for (f,) in db.execute('SELECT DISTINCT file_id FROM subidas') if f not in file_ids]
+        db.executemany('DELETE FROM subidas WHERE file_id = ?', obsoletos)
+    return len(obsoletos)
+
+
+# Funcion que guarda (o actualiza) un fichero propio de SecureBox en la copia local de la lista.
+# Parámetros:
+#	file_id: id en SecureBox del fichero.
+#	nombre: nombre del fichero.
+#	tam: tamaño del fichero en SecureBox, o None si no se conoce.
+#	fecha: fecha de subida (timestamp), o None si no se conoce.
+#
+def guardar_fichero(file_id, nombre, tam=None, fecha=None):
+    with closing(conectar()) as db, db:
+        db.execute('INSERT OR REPLACE INTO ficheros VALUES (?, ?, ?, ?)', (file_id, nombre, tam, fecha))
+
+
+# Funcion que elimina un fichero de la copia local de la lista.
+# Parámetros:
+#	file_id: id en SecureBox del fichero.
+#
+def borrar_fichero(file_id):
+    with closing(conectar()) as db, db:
+        db.execute('DELETE FROM ficheros WHERE file_id = ?', (file_id,))
+
+
+# Funcion que actualiza la copia local de la lista de ficheros con la lista completa de la API:
+# añade los nuevos, cambia los nombres, elimina los que ya no están y conserva el tamaño y la fecha
+# de los que se conocían. Guarda además la fecha de la sincronización.
+# Parámetros:
+#	ficheros: lista de tuplas (file_id, nombre) de todos los ficheros de SecureBox.
+#
+def actualizar_ficheros(ficheros):
+    ids = set(file_id for file_id, nombre in ficheros)
+    with closing(conectar()) as db, db:
+        obsoletos = [(f,) for (f,) in db.execute('SELECT file_id FROM ficheros') if f not in ids]
+        db.executemany('DELETE FROM ficheros WHERE file_id = ?', obsoletos)
+        db.executemany('INSERT OR IGNORE INTO ficheros (file_id, nombre) VALUES (?, ?)', ficheros)
+        db.executemany('UPDATE ficheros SET nombre = ? WHERE file_id = ?', [(n, f) for f, n in ficheros])
+        db.execute('INSERT OR REPLACE INTO sincronizacion VALUES (?, ?)', ('ficheros', time.time()))
+
+
+# Funcion que añade (o vuelve a poner como pendientes) varios ficheros a la cola de subidas de una
+# carpeta vigilada, en una sola transacción.
+# Parámetros:
+#	ficheros: lista de tuplas (ruta, tamaño, fecha de modificación en ns) de los ficheros.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#
+def encolar(ficheros, dest_id):
+    destinos = clave_destinos(dest_id)
+    with closing(conectar()) as db, db:
+        db.executemany('INSERT OR REPLACE INTO cola VALUES (?, ?, ?, ?, ?, ?, 0, NULL)',
+                       [(ruta, destinos, os.path.dirname(ruta), tam, mtime, 'pendiente') for ruta, tam, mtime in ficheros])
+
+
+# Funcion que obtiene los ficheros de una carpeta vigilada que están en la cola de subidas.
+# Parámetros:
+#	carpeta: ruta absoluta de la carpeta.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+# Return: diccionario con la tupla (tamaño, fecha de modificación, estado, intentos) de cada ruta.
+#
+def ficheros_cola(carpeta, dest_id):
+    with closing(conectar()) as db:
+        filas = db.execute('SELECT ruta, tam, mtime, estado, intentos FROM cola WHERE carpeta = ? AND destinos = ?',
+                           (carpeta, clave_destinos(dest_id)))
+        return {ruta: (tam, mtime, estado, intentos) for ruta, tam, mtime, estado, intentos in filas}
+
+
+# Funcion que guarda el resultado de una subida de la cola de una carpeta vigilada.
+# Parámetros:
+#	ruta: ruta absoluta del fichero.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#	estado: 'subido', 'pendiente' (para volver a intentarlo) o 'error'.
+#	intentos: número de intentos fallidos.
+#	file_id: id en SecureBox del fichero, si se ha subido.
+#
+def actualizar_cola(ruta, dest_id, estado, intentos=0, file_id=None):
+    with closing(conectar()) as db, db:
+        db.execute('UPDATE cola SET estado = ?, intentos = ?, file_id = ? WHERE ruta = ? AND destinos = ?',
+                   (estado, intentos, file_id, ruta, clave_destinos(dest_id)))
+
+
+# Funcion que elimina de la cola de subidas ficheros que ya no existen.
+# Parámetros:
+#	rutas: rutas absolutas de los ficheros.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#
+def borrar_cola(rutas, dest_id):
+    destinos = clave_destinos(dest_id)
+    with closing(conectar()) as db, db:
+        db.executemany('DELETE FROM cola WHERE ruta = ? AND destinos = ?', [(ruta, destinos) for ruta in rutas])
+
+
+# Funcion que devuelve la fecha de la última sincronización de una tabla con la API.
+# Parámetros:
+#	tabla: 'ficheros' o 'usuarios'.
+# Return: timestamp, o None si nunca se ha sincronizado.
+#
+def ultima_sincronizacion(tabla='ficheros'):
+    with closing(conectar()) as db:
+        fila = db.execute('SELECT fecha FROM sincronizacion WHERE tabla = ?', (tabla,)).fetchone()
+    return fila[0] if fila else None
+
+
+# Funcion que devuelve los ids de los ficheros de la copia local de la lista.
+# Return: conjunto de ids.
+#
+def ids_ficheros():
+    with closing(conectar()) as db:
+        return set(f for (f,) in db.execute('SELECT file_id FROM ficheros'))
+
+
+# Funcion que recorre la copia local de la lista de ficheros, filtrada y ordenada por nombre, sin
+# cargarla entera en memoria.
+# Parámetros:
+#	prefijo: si no es None, solo los ficheros cuyo nombre empieza por él.
+#	tam_min: si no es None, solo los ficheros de tamaño conocido y mayor o igual.
+#	tam_max: si no es None, solo los ficheros de tamaño conocido y menor o igual.
+# Return: generador de diccionarios con fileID, fileName, size y date.
+#
+def listar_ficheros(prefijo=None, tam_min=None, tam_max=None):
+    condiciones = []
+    valores = []
+    if prefijo is not None:
+        condiciones.append("nombre LIKE ? ESCAPE '\\'")
+        valores.append(prefijo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if tam_min is not None:
+        condiciones.append('tam >= ?')
+        valores.append(tam_min)
+    if tam_max is not None:
+        condiciones.append('tam <= ?')
+        valores.append(tam_max)
+
+    consulta = 'SELECT file_id, nombre, tam, fecha FROM ficheros'
+    if condiciones:
+        consulta += ' WHERE ' + ' AND '.join(condiciones)
+    consulta += ' ORDER BY nombre, file_id'
+
+    with closing(conectar()) as db:
+        for file_id, nombre, tam, fecha in db.execute(consulta, valores):
+            yield {'fileID': file_id, 'fileName': nombre, 'size': tam, 'date': fecha}
+
+
+# Funcion que obtiene los fragmentos de 1 a LONG_GRAMA caracteres de una cadena, con los que se
+# indexan los usuarios.
+# Parámetros:
+#	texto: cadena (en minúsculas).
+# Return: conjunto de fragmentos.
+#
+def gramas(texto):
+    return set(texto[i:i + n] for n in range(1, LONG_GRAMA + 1) for i in range(len(texto) - n + 1))
+
+
+# Funcion que guarda en la copia local del directorio los usuarios devueltos por una búsqueda en
+# la API. Como la búsqueda devuelve todos los usuarios que contienen la cadena, se eliminan también
+# los que la contienen según la copia local pero ya no están en la API; con la cadena vacía se
+# sustituye el directorio completo y se guarda la fecha de la sincronización.
+# Parámetros:
+#	usuarios: lista de tuplas (user_id, nombre, email, huella).
+#	busqueda: cadena buscada, o None si los usuarios no vienen de una búsqueda.
+#
+def guardar_usuarios(usuarios, busqueda=None):
+    ahora = time.time()
+    with closing(conectar()) as db, db:
+        if busqueda is not None:
+            ids = set(usuario[0] for usuario in usuarios)
+            obsoletos = [(user_id,) for user_id, nombre, email, huella in _buscar_usuarios(db, busqueda) if user_id not in ids]
+            db.executemany('DELETE FROM usuarios WHERE user_id = ?', obsoletos)
+            db.executemany('DELETE FROM usuarios_gramas WHERE user_id = ?', obsoletos)
+
+        for user_id, nombre, email, huella in usuarios:
+            db.execute('INSERT OR REPLACE INTO usuarios VALUES (?, ?, ?, ?, ?)', (user_id, nombre, email, huella, ahora))
+            db.execute('DELETE FROM usuarios_gramas WHERE user_id = ?', (user_id,))
+            texto = gramas((nombre or '').lower()) | gramas((email or '').lower())
+            db.executemany('INSERT INTO usuarios_gramas VALUES (?, ?)', [(grama, user_id) for grama in texto])
+
+        if busqueda == '':
+            db.execute('INSERT OR REPLACE INTO sincronizacion VALUES (?, ?)', ('usuarios', ahora))
+
+
+# Funcion que busca en la copia local del directorio los usuarios cuyo nombre o email contiene una
+# cadena (sin distinguir mayúsculas), como la búsqueda de la API.
+# Parámetros:
+#	cadena: cadena buscada.
+# Return: lista de tuplas (user_id, nombre, email, huella), ordenada por nombre.
+#
+def buscar_usuarios(cadena):
+    with closing(conectar()) as db:
+        return _buscar_usuarios(db, cadena)
+
+
+# Funcion que busca usuarios en la copia local del directorio con una conexión ya abierta.
+# Parámetros:
+#	db: conexión con la base de datos.
+#	cadena: cadena buscada.
+# Return: lista de tuplas (user_id, nombre, email, huella), ordenada por nombre.
+#
+def _buscar_usuarios(db, cadena):
+    cadena = cadena.lower()
+    if cadena == '':
+        filas = db.execute('SELECT user_id, nombre, email, huella FROM usuarios')
+    elif len(cadena) <= LONG_GRAMA:
+        filas = db.execute('SELECT u.user_id, nombre, email, huella FROM usuarios_gramas g JOIN usuarios u '
+                           'ON u.user_id = g.user_id WHERE grama = ?', (cadena,))
+    else:
+        # Candidatos: los usuarios que tienen el fragmento de la cadena menos frecuente, que
+        # después se comprueban con la cadena completa.
+        fragmentos = set(cadena[i:i + LONG_GRAMA] for i in range(len(cadena) - LONG_GRAMA + 1))
+        raro = min(fragmentos, key = lambda grama: db.execute('SELECT COUNT(*) FROM usuarios_gramas WHERE grama = ?', (grama,)).fetchone()[0])
+        filas = db.execute('SELECT u.user_id, nombre, email, huella FROM usuarios_gramas g JOIN usuarios u '
+                           'ON u.user_id = g.user_id WHERE grama = ?', (raro,))
+        filas = [fila for fila in filas if cadena in (fila[1] or '').lower() or cadena in (fila[2] or '').lower()]
+
+    return sorted(filas, key = lambda fila: ((fila[1] or '').lower(), fila[0]))
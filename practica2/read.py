@@ -1,24 +1,334 @@
+import agent
+import sys
+
+# Si el agente de SecureBox (agent.py) está en marcha en este directorio, se le pasa la orden para
+# que la ejecute con la clave y las conexiones que ya tiene cargadas, sin importar nada más.
+if __name__ == '__main__':
+    codigo = agent.forward(sys.argv[1:])
+    if codigo is not None:
+        sys.exit(codigo)
+
 import filesGestion as fg
 import crypt as cr
+import cliente
+import errores
 import identityGestion as ig
+import batch
 import argparse as arg
 import os
 
 
+# Funciones que realizan cada acción sobre un único fichero con el cliente de SecureBox (ver
+# cliente.py), mostrando el progreso y el resultado. Son las tareas que se ejecutan en los comandos
+# que trabajan con varios ficheros (--*_files), por lo que deben estar definidas a nivel de módulo
+# para poder ejecutarse en otros procesos.
+# Return: False si la acción no se ha podido completar. Los demás errores se lanzan.
+#
+def subir(sb, file, dest_id, chunked=False, force=False):
+    print('Subiendo fichero ' + file)
+    return sb.upload(file, dest_id, force = force, chunked = chunked)['file_id']
+
+
+def descargar(sb, fileID, source_id, reanudar=False):
+    print('Fichero ' + fileID)
+    try:
+        sb.download(fileID, source_id, resume = reanudar)
+    except errores.SignatureError:
+        print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id, no se ha podido descargar correctamente.")
+        return False
+
+    print('OK')
+    print('Fichero descargado y verificado correctamente.')
+    return True
+
+
+def borrar(sb, fileID):
+    print('Fichero ' + fileID)
+    sb.delete(fileID)
+
+
+def encriptar(sb, file, dest_id, reanudar=False):
+    print('Fichero ' + file)
+    return sb.encrypt(file, dest_id, resume = reanudar)['path']
+
+
+def desencriptar(sb, file, rango=None):
+    print('Fichero ' + file)
+    if rango is not None:
+        return sb.decrypt(file, byte_range = rango)['path']
+
+    # Como el fichero cifrado ya no hace falta, se borra (el cliente nunca borra sus entradas).
+    path = sb.decrypt(file)['path']
+    os.remove(file)
+    return path
+
+
+def firmar(sb, file, merkle=False):
+    print('Fichero ' + file)
+    return sb.sign(file, merkle = merkle)['path']
+
+
+def comprobar_firma(sb, file, source_id):
+    print('Fichero ' + file)
+    return verificado(lambda: sb.verify(file, source_id), file)
+
+
+def cifrar_firmar(sb, file, dest_id):
+    print('Fichero ' + file)
+    return sb.encrypt(file, dest_id, sign = True)['path']
+
+
+def desencriptar_verificar(sb, file, source_id):
+    print('Fichero ' + file)
+    return verificado(lambda: sb.decrypt(file, source_id = source_id), file)
+
+
+def vigilar(sb, directorio, dest_id, jobs=1, sondeo=False, chunked=False, force=False):
+    resultado = sb.watch(directorio, dest_id, jobs = jobs, poll = sondeo, chunked = chunked, force = force)
+    print(str(resultado['uploaded']) + ' ficheros subidos, ' + str(resultado['failed']) + ' con errores.')
+    return resultado['failed'] == 0
+
+
+def subir_directorio(sb, directorio, dest_id):
+    print('Subiendo directorio ' + directorio)
+    resultado = sb.upload_dir(directorio, dest_id)
+    print('Archivo ' + resultado['name'] + ' subido con ID ' + resultado['file_id'])
+    return resultado['file_id']
+
+
+def descargar_directorio(sb, fileID, source_id):
+    print('Archivo ' + fileID)
+    try:
+        extraidos = sb.download_dir(fileID, source_id)['paths']
+    except errores.SignatureError:
+        print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id, no se ha extraido nada.")
+        return False
+
+    print('OK')
+    print('Archivo descargado, verificado y extraido en ' + ', '.join(extraidos) + '.')
+    return True
+
+
+def cifrar_directorio(sb, directorio, dest_id):
+    print('Directorio ' + directorio)
+    return sb.encrypt_dir(directorio, dest_id)['path']
+
+
+def listar_archivo(sb, file):
+    fg.printArchive(sb.list_archive(file))
+
+
+def extraer_miembro(sb, file, miembro):
+    print('Extrayendo ' + miembro + ' de ' + file)
+    path = sb.extract_member(file, miembro)['path']
+    print('OK')
+    return path
+
+
+def buscar(sb, cadena, offline=False):
+    ig.printUsers(sb.search(cadena, offline))
+
+
+def listar(sb, refresh=False, prefix=None, min_size=None, max_size=None, output='table'):
+    fg.printFileList(sb.list(refresh, prefix, min_size, max_size), output)
+
+
+def registrar(sb, nombre, email):
+    print('Solicitando nuevo usuario a SecureBox.')
+    sb.register(nombre, email)
+    print('Usuario creado correctamente.')
+
+
+# Funcion que ejecuta una verificación de firma del cliente sobre un fichero de las carpetas de
+# trabajo y muestra el resultado. El fichero se borra al terminar la verificación, sea o no
+# correcta la firma.
+# Parámetros:
+#	verificar: función que realiza la verificación.
+#	file: dirección del fichero verificado.
+# Return: True si la firma es correcta.
+#
+def verificado(verificar, file):
+    try:
+        verificar()
+    except errores.SignatureError as e:
+        os.remove(file)
+        if e.modificados:
+            print('Error: ' + str(e))
+        else:
+            print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id.")
+        return False
+
+    os.remove(file)
+    print('OK')
+    print('Fichero verificado correctamente.')
+    return True
+
+
+# Funcion que ejecuta una acción sobre un único fichero y muestra el error si falla, sin detener
+# el resto de acciones del comando.
+# Parámetros:
+#	funcion: tarea que se quiere ejecutar.
+#	args: argumentos de la tarea.
+# Return: True si la acción ha terminado correctamente.
+#
+def ejecutar_accion(funcion, *args):
+    correcto, error = batch.ejecutar(funcion, args)
+    if error:
+        print('Error: ' + error)
+    return correcto
+
+
+# Funcion que obtiene las claves públicas que va a usar un lote antes de repartir sus tareas, que
+# así las encuentran en la caché en lugar de pedirlas cada una. Si alguna no se puede obtener (id
+# desconocido, sin conexión...) se muestra el error, como en el resto de acciones.
+# Parámetros:
+#	ids: ids en SecureBox de los usuarios.
+# Return: True si se han obtenido todas las claves.
+#
+def obtener_claves(ids):
+    return all([ejecutar_accion(ig.userGetRSAKey, i) for i in ids])
+
+
+# Funcion que ejecuta un trabajo de un manifiesto (--manifest): una de las acciones de read.py
+# sobre un único fichero. Los parámetros que no se indican en el trabajo se toman de las opciones
+# de la línea de comandos.
+# Parámetros:
+#	trabajo: diccionario con la acción ('action': upload, download, delete_file, encrypt, decrypt,
+#	sign, check_sign, enc_sign o decrypt_check) y sus parámetros ('file', 'file_id', 'dest_id',
+#	'source_id', 'range', 'format', 'compress', 'force', 'chunked', 'resume', 'merkle', 'workers').
+#	sb: cliente de SecureBox, compartido por todos los trabajos. Si el trabajo indica 'format',
+#	'compress' o 'workers', se usa una copia del cliente con esos valores.
+#	opciones: diccionario con los valores por defecto de los demás parámetros.
+# Return: el resultado de la acción (el id del fichero subido, la dirección del fichero
+# generado...), False si la acción ha fallado.
+#
+def trabajo_manifiesto(trabajo, sb, opciones):
+    parametros = dict(opciones)
+    parametros.update(trabajo)
+    accion = parametros.get('action')
+
+    def parametro(nombre):
+        if not parametros.get(nombre):
+            raise ValueError('Falta el parametro ' + nombre + ' de la accion ' + str(accion))
+        return parametros[nombre]
+
+    if any(trabajo.get(nombre) is not None for nombre in ('format', 'compress', 'workers')):
+        sb = sb.with_options(trabajo.get('format'), trabajo.get('compress'), trabajo.get('workers'))
+
+    if accion == 'upload':
+        return subir(sb, parametro('file'), parametro('dest_id'), parametros.get('chunked', False), parametros.get('force', False))
+    if accion == 'download':
+        return descargar(sb, parametro('file_id'), parametro('source_id'), parametros.get('resume', False))
+    if accion == 'delete_file':
+        return borrar(sb, parametro('file_id'))
+    if accion == 'encrypt':
+        return encriptar(sb, parametro('file'), parametro('dest_id'), parametros.get('resume', False))
+    if accion == 'decrypt':
+        return desencriptar(sb, parametro('file'), leerRango(parametros['range']) if parametros.get('range') else None)
+    if accion == 'sign':
+        return firmar(sb, parametro('file'), parametros.get('merkle', False))
+    if accion == 'check_sign':
+        return comprobar_firma(sb, parametro('file'), parametro('source_id'))
+    if accion == 'enc_sign':
+        return cifrar_firmar(sb, parametro('file'), parametro('dest_id'))
+    if accion == 'decrypt_check':
+        return desencriptar_verificar(sb, parametro('file'), parametro('source_id'))
+    raise ValueError('Accion desconocida: ' + str(accion))
+
+
+# Acciones que se pueden hacer en modo flujo, leyendo de la entrada estándar (fichero '-') o
+# escribiendo el resultado en --out.
+ACCIONES_FLUJO = ('encrypt', 'enc_sign', 'decrypt', 'decrypt_check', 'sign', 'check_sign')
+
+
+# Funcion que ejecuta una acción en modo flujo: lee el fichero de entrada o la entrada estándar y
+# escribe el resultado en --out o en la salida estándar, a medida que se procesa y sin ficheros
+# intermedios, de modo que read.py se puede usar en una tubería (cat f | read.py --encrypt - ...).
+# Como la salida estándar lleva los datos, el progreso y los errores se muestran por la salida de
+# errores. Ni la entrada ni la salida se borran, y con decrypt_check y check_sign los datos se
+# escriben antes de terminar de verificar la firma, por lo que si falla se deben descartar.
+# Parámetros:
+#	args: argumentos del terminal.
+#	sb: cliente de SecureBox.
+#	acciones: acciones de ACCIONES_FLUJO indicadas en los argumentos (solo puede haber una).
+# Return: código de salida del programa, 1 si la acción ha fallado.
+#
+def ejecutar_flujo(args, sb, acciones):
+    if len(acciones) != 1:
+        print('Error: en modo flujo solo se puede indicar una accion (' + ', '.join('--' + a for a in acciones) + ').', file = sys.stderr)
+        return 1
+
+    accion = acciones[0]
+    if accion in ('encrypt', 'enc_sign') and not args.dest_id:
+        print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.", file = sys.stderr)
+        return 1
+    if accion in ('decrypt_check', 'check_sign') and not args.source_id:
+        print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.", file = sys.stderr)
+        return 1
+
+    origen = getattr(args, accion)[0]
+    destino = args.out[0] if args.out else '-'
+    entrada = sys.stdin.buffer if origen == '-' else origen
+    salida = sys.stdout.buffer if destino == '-' else destino
+
+    operaciones = {
+        'encrypt': lambda: sb.encrypt(entrada, args.dest_id, dest = salida),
+        'enc_sign': lambda: sb.encrypt(entrada, args.dest_id, dest = salida, sign = True),
+        'decrypt': lambda: sb.decrypt(entrada, dest = salida, byte_range = leerRango(args.range[0]) if args.range else None),
+        'decrypt_check': lambda: sb.decrypt(entrada, dest = salida, source_id = args.source_id[0]),
+        'sign': lambda: sb.sign(entrada, dest = salida, merkle = args.merkle),
+        'check_sign': lambda: sb.verify(entrada, args.source_id[0], dest = salida),
+    }
+
+    with batch.salida_a_errores():
+        correcto = ejecutar_accion(operaciones[accion])
+    if destino == '-':
+        salida.flush()
+    return 0 if correcto else 1
+
+
+# Funcion que interpreta un rango de bytes con el formato INICIO:FIN.
+# Parámetros:
+#	texto: rango, en el que se puede omitir el inicio (0) o el fin (final del fichero).
+# Return: tupla con el inicio y el fin (None si se ha omitido).
+#
+def leerRango(texto):
+    if ':' not in texto:
+        raise ValueError('El rango debe tener el formato INICIO:FIN.')
+    inicio, fin = texto.split(':', 1)
+    inicio = int(inicio) if inicio else 0
+    fin = int(fin) if fin else None
+    if inicio < 0 or (fin is not None and fin < inicio):
+        raise ValueError('Rango incorrecto: ' + texto)
+    return inicio, fin
+
+
 # Funcion que lee los argumenos del terminal, los parsea y llama a las funciones necesarias
 # para llevar a cabo la funcionalidad del programa.
+# Parámetros:
+#	argv: lista de argumentos (los del terminal por defecto).
+# Return: código de salida del programa, 1 si alguna de las acciones ha fallado.
 #
-def leer():
+def leer(argv=None):
 
-    parser = arg.ArgumentParser(description = 'Possible actions:')
+    parser = arg.ArgumentParser(prog = 'read.py', description = 'Possible actions:')
     parser.add_argument("--create_id", nargs = '*',  help = 'Crear una nueva identidad y un par de claves en el servidor.')
     parser.add_argument("--search_id", nargs = 1, metavar = ('cadena'), help = 'Buscar el id de un usuario cuya informacion contenga una cadena determinada.')
+    parser.add_argument("--offline", action = 'store_true', help = 'Con --search_id, buscar solo en la copia local del directorio de usuarios, sin conexion.')
+    parser.add_argument("--sync_users", action = 'store_true', help = 'Actualizar la copia local completa del directorio de usuarios.')
     parser.add_argument("--delete_id", nargs = 1, metavar = ('user_id'), help = 'Borrar el usuario con el id especificado.')
     parser.add_argument("--upload", nargs = 1, metavar = ('fichero'), help = 'Subir un fichero.')
     parser.add_argument("--upload_files", nargs = '*', help = 'Subir varios ficheros para un mismo destinatario.')
+    parser.add_argument("--upload_dir", nargs = 1, metavar = ('directorio'), help = 'Subir un directorio entero como un unico archivo firmado y cifrado (con una sola firma y una sola peticion), se debe especificar el id del receptor con --dest_id.')
+    parser.add_argument("--watch", nargs = 1, metavar = ('directorio'), help = 'Vigilar un directorio y subir firmados y cifrados los ficheros que aparezcan o se modifiquen en el, con --jobs subidas a la vez, hasta pulsar Ctrl+C. Se debe especificar el id del receptor con --dest_id.')
+    parser.add_argument("--poll", action = 'store_true', help = 'Con --watch, recorrer el directorio cada segundo en lugar de usar inotify.')
     parser.add_argument("--list_files", action = 'store_true', help = 'Obtener una lista con todos los ficheros disponibles.')
     parser.add_argument("--download", nargs = 1, metavar = ('id_fichero'), help = 'Descargar el fichero con el id especificado, se debe especificar el id del emisor con --source_id.')
     parser.add_argument("--download_files", nargs = '*', help = 'Descargar varios ficheros con los ids especificados provenientes del mismo emisor cuyo id se especifica con --source_id.')
+    parser.add_argument("--download_dir", nargs = 1, metavar = ('id_fichero'), help = 'Descargar un archivo subido con --upload_dir y extraerlo en downloads a medida que se descifra, se debe especificar el id del emisor con --source_id.')
+    parser.add_argument("--encrypt_dir", nargs = 1, metavar = ('directorio'), help = 'Firmar y cifrar un directorio entero como un unico archivo local en encriptado, se debe especificar el id del receptor con --dest_id.')
+    parser.add_argument("--list_archive", nargs = 1, metavar = ('fichero'), help = 'Mostrar los ficheros de un archivo cifrado (de --upload_dir) descifrando solo su indice.')
+    parser.add_argument("--extract", nargs = 2, metavar = ('fichero', 'miembro'), help = 'Extraer en downloads un fichero de un archivo cifrado descifrando solo los trozos que lo contienen (sin comprobar la firma del archivo).')
     parser.add_argument("--delete_file", nargs = 1, metavar = ('id_fichero'), help = 'Eliminar el fichero con el id especificado.')
     parser.add_argument("--delete_files", nargs = '*', help = 'Eliminar varios ficheros con los ids especificados.')
     parser.add_argument("--encrypt", nargs = 1, metavar = ('fichero'), help = 'Encriptar el fichero especificado, se debe especificar el id del destinatario con --dest_id.')
@@ -34,192 +344,262 @@ def leer():
     parser.add_argument("--decrypt_check", nargs = 1, metavar = ('fichero'), help = 'desencripta y verifica la firma de un archivo, se debe especificar el id delemisor con --source_id.')
     parser.add_argument("--decrypt_check_files", nargs = '*', help = 'desencripta y verifica la firma de varios archivos de un mismo emisor, se debe especificar el id delemisor con --source_id.')
     parser.add_argument("--source_id", nargs = 1, metavar = ('user_id'), help = 'Id del emisor del fichero.')
-    parser.add_argument("--dest_id", nargs = 1, metavar = ('user_id'), help = 'Id del receptor del fichero.')
-
-    args = parser.parse_args()
-
-    directorio = "./.files/"
-    try:
-      os.stat(directorio)
-    except:
-      os.mkdir(directorio)
-
-    directorio = "./encriptado/"
-    try:
-      os.stat(directorio)
-    except:
-      os.mkdir(directorio)
-
-    directorio = "./downloads/"
-    try:
-      os.stat(directorio)
-    except:
-      os.mkdir(directorio)
-
+    parser.add_argument("--dest_id", nargs = '+', metavar = ('user_id'), help = 'Id del receptor del fichero, o ids de varios receptores (el fichero se cifra una sola vez para todos).')
+    parser.add_argument("--invalidate_keys", nargs = '*', metavar = ('user_id'), help = 'Eliminar de la cache las claves publicas de los usuarios especificados (o todas si no se especifica ninguno).')
+    parser.add_argument("--key_cache_stats", action = 'store_true', help = 'Mostrar al terminar los aciertos y fallos de la cache de claves publicas.')
+    parser.add_argument("--force", action = 'store_true', help = 'Subir los ficheros aunque ya se hayan subido con el mismo contenido para los mismos destinatarios.')
+    parser.add_argument("--resume", action = 'store_true', help = 'Con --download y --encrypt (y sus variantes), guardar el progreso para poder continuar desde donde se quedaron si se interrumpen.')
+    parser.add_argument("--chunked", action = 'store_true', help = 'Enviar los ficheros subidos por partes (Transfer-Encoding: chunked) en lugar de calcular antes su tamano.')
+    parser.add_argument("--refresh", action = 'store_true', help = 'Con --list_files, pedir la lista de ficheros a SecureBox aunque la copia local sea reciente.')
+    parser.add_argument("--output", nargs = 1, choices = ['table', 'json'], default = ['table'], help = 'Con --list_files, mostrar los ficheros en una tabla o como una lista JSON.')
+    parser.add_argument("--prefix", nargs = 1, metavar = ('nombre'), help = 'Con --list_files, mostrar solo los ficheros cuyo nombre empieza por el especificado.')
+    parser.add_argument("--min_size", nargs = 1, type = int, metavar = ('bytes'), help = 'Con --list_files, mostrar solo los ficheros de al menos ese tamano (de los que se conoce).')
+    parser.add_argument("--max_size", nargs = 1, type = int, metavar = ('bytes'), help = 'Con --list_files, mostrar solo los ficheros de como mucho ese tamano (de los que se conoce).')
+    parser.add_argument("--range", nargs = 1, metavar = ('INICIO:FIN'), help = 'Con --decrypt, descifrar solo los bytes del INICIO al FIN (sin incluir) de un fichero cifrado con --format gcm. Se puede omitir cualquiera de los dos.')
+    parser.add_argument("--manifest", nargs = 1, metavar = ('trabajos.jsonl'), help = 'Ejecutar los trabajos de un fichero JSONL, uno por linea ({"action": "upload", "file": ..., "dest_id": ...}), con --jobs trabajos a la vez.')
+    parser.add_argument("--results", nargs = 1, metavar = ('resultados.jsonl'), help = 'Con --manifest, fichero en el que se escribe el resultado de cada trabajo (por defecto la salida estandar).')
+    parser.add_argument("--jobs", nargs = 1, type = int, default = [1], metavar = ('N'), help = 'Numero de ficheros que se procesan a la vez en los comandos --*_files.')
+    parser.add_argument("--format", nargs = 1, choices = ['cbc', 'gcm'], default = [cr.FORMATO], help = 'Formato de cifrado: cbc (el original de SecureBox) o gcm (por trozos, en paralelo). Al descifrar se detecta automaticamente.')
+    parser.add_argument("--compress", nargs = 1, choices = ['none', 'auto', 'zlib', 'lzma'], default = [cr.COMPRESION], help = 'Comprimir los ficheros antes de cifrarlos (implica --format gcm). Con auto se comprime con zlib si una muestra del fichero se reduce lo suficiente.')
+    parser.add_argument("--workers", nargs = 1, type = int, metavar = ('N'), help = 'Numero de procesos entre los que se reparten los trozos de cada fichero con el formato gcm (por defecto, uno por nucleo, o uno solo con --jobs).')
+    parser.add_argument("--merkle", action = 'store_true', help = 'Con --sign y --sign_files, firmar la raiz de un arbol de Merkle de los trozos de 1 MiB del fichero (calculado en paralelo) en lugar de su hash, de modo que al verificar se indica que trozos se han modificado.')
+    parser.add_argument("--out", nargs = 1, metavar = ('fichero'), help = 'Con --encrypt, --enc_sign, --decrypt, --decrypt_check, --sign o --check_sign, fichero en el que se escribe el resultado ("-" para la salida estandar, la opcion por defecto si el fichero de entrada es "-", la entrada estandar).')
+
+    args = parser.parse_args(argv)
+    jobs = args.jobs[0]
+    formato = args.format[0]
+    compresion = args.compress[0]
+    fallos = 0
+
+    # Con varios ficheros a la vez cada uno se cifra en un solo proceso, salvo que se indique
+    # --workers (None: uno por núcleo, ver contenedor.WORKERS).
+    workers = args.workers[0] if args.workers else (1 if jobs > 1 else None)
+
+    sb = cliente.SecureBoxClient(formato = formato, compresion = compresion, verbose = True, workers = workers)
+
+    flujo = [accion for accion in ACCIONES_FLUJO if getattr(args, accion) and (args.out or getattr(args, accion)[0] == '-')]
+    if flujo:
+        return ejecutar_flujo(args, sb, flujo)
+
+    if args.invalidate_keys is not None:
+        ig.invalidatePublicKeys(args.invalidate_keys or None)
 
     if args.create_id:
         if args.create_id[0] and args.create_id[1]:
-            print('Solicitando nuevo usuario a SecureBox.')
-            cr.userRegister(args.create_id[0], args.create_id[1])
-            print('Usuario creado correctamente.')
+            if not ejecutar_accion(registrar, sb, args.create_id[0], args.create_id[1]):
+                fallos += 1
         else:
             print("Faltan argumentos, usa -h para ayuda.")
 
+    if args.sync_users:
+        usuarios = ig.userDirectorySync()
+        if usuarios is None:
+            fallos += 1
+        else:
+            print(str(usuarios) + ' usuarios en el directorio local.')
+
     if args.search_id:
-        print(ig.userSearch(args.search_id[0]))
+        if not ejecutar_accion(buscar, sb, args.search_id[0], args.offline):
+            fallos += 1
 
     if args.delete_id:
         ig.userDelete(args.delete_id[0])
 
     if args.upload:
         if args.dest_id:
-            path = cr.cifrar_firmar(args.upload[0], args.dest_id[0])
             print('Solicitando subida de fichero a SecureBox')
-            fg.uploadFile(path)
-            print('Subida realizada correctamente.')
+            if ejecutar_accion(subir, sb, args.upload[0], args.dest_id, args.chunked, args.force):
+                print('Subida realizada correctamente.')
+            else:
+                fallos += 1
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.upload_files:
         if args.dest_id:
             print('Solicitando subida de ficheros a SecureBox')
-            for i in args.upload_files:
-                print('Subiendo fichero ' + i)
-                path = cr.cifrar_firmar(i, args.dest_id[0])
-                fg.uploadFile(path)
-            print('Subida realizada correctamente.')
+            if obtener_claves(args.dest_id):
+                fallidos = batch.ejecutar_lote(subir, [(sb, i, args.dest_id, args.chunked, args.force) for i in args.upload_files], jobs)
+            else:
+                fallidos = len(args.upload_files)
+            if fallidos:
+                print('No se han podido subir ' + str(fallidos) + ' de ' + str(len(args.upload_files)) + ' ficheros.')
+            else:
+                print('Subida realizada correctamente.')
+            fallos += fallidos
+        else:
+            print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
+
+    if args.upload_dir:
+        if args.dest_id:
+            if not ejecutar_accion(subir_directorio, sb, args.upload_dir[0], args.dest_id):
+                fallos += 1
+        else:
+            print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
+
+    if args.watch:
+        if args.dest_id:
+            if not ejecutar_accion(vigilar, sb, args.watch[0], args.dest_id, jobs, args.poll, args.chunked, args.force):
+                fallos += 1
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.list_files:
-        print(fg.fileList())
+        if not ejecutar_accion(listar, sb, args.refresh, args.prefix and args.prefix[0], args.min_size and args.min_size[0],
+                               args.max_size and args.max_size[0], args.output[0]):
+            fallos += 1
 
     if args.download:
         if args.source_id:
-            file = fg.fileDownload(args.download[0], args.source_id[0])
-            file = cr.desencriptar(file)
-            if cr.check_signature(file,  args.source_id[0]):
-                print('OK')
-                print('Fichero descargado y verificado correctamente.')
-            else:
-                print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id, no se ha podido descargar correctamente.")
-
+            if not ejecutar_accion(descargar, sb, args.download[0], args.source_id[0], args.resume):
+                fallos += 1
         else:
              print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
     if args.download_files:
         if args.source_id:
-            for i in args.download_files:
-                print('Fichero ' + i)
-                file = fg.fileDownload(i, args.source_id[0])
-                file = cr.desencriptar(file)
-                if cr.check_signature(file,  args.source_id[0]):
-                    print('OK')
-                    print('Fichero descargado y verificado correctamente.')
-                else:
-                    print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id, no se ha podido descargar correctamente.")
+            if obtener_claves([args.source_id[0]]):
+                fallos += batch.ejecutar_lote(descargar, [(sb, i, args.source_id[0], args.resume) for i in args.download_files], jobs)
+            else:
+                fallos += len(args.download_files)
+        else:
+            print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
+
+    if args.download_dir:
+        if args.source_id:
+            if not ejecutar_accion(descargar_directorio, sb, args.download_dir[0], args.source_id[0]):
+                fallos += 1
         else:
             print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
+    if args.encrypt_dir:
+        if args.dest_id:
+            if not ejecutar_accion(cifrar_directorio, sb, args.encrypt_dir[0], args.dest_id):
+                fallos += 1
+        else:
+            print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
+
+    if args.list_archive:
+        if not ejecutar_accion(listar_archivo, sb, args.list_archive[0]):
+            fallos += 1
+
+    if args.extract:
+        if not ejecutar_accion(extraer_miembro, sb, args.extract[0], args.extract[1]):
+            fallos += 1
+
     if args.delete_file:
-        fg.fileDelete(args.delete_file[0])
+        if not ejecutar_accion(borrar, sb, args.delete_file[0]):
+            fallos += 1
 
     if args.delete_files:
-        for i in args.delete_files:
-            print('Fichero ' + i)
-            fg.fileDelete(i)
+        fallos += batch.ejecutar_lote(borrar, [(sb, i) for i in args.delete_files], jobs)
 
     if args.encrypt:
         if args.dest_id:
-            cr.encriptar(args.encrypt[0], args.dest_id[0])
+            if not ejecutar_accion(encriptar, sb, args.encrypt[0], args.dest_id, args.resume):
+                fallos += 1
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.encrypt_files:
         if args.dest_id:
-            for i in args.encrypt_files:
-                print('Fichero ' + i)
-                cr.encriptar(i, args.dest_id[0])
+            if obtener_claves(args.dest_id):
+                fallos += batch.ejecutar_lote(encriptar, [(sb, i, args.dest_id, args.resume) for i in args.encrypt_files], jobs, True)
+            else:
+                fallos += len(args.encrypt_files)
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.decrypt:
-        cr.desencriptar(args.decrypt[0])
+        try:
+            rango = leerRango(args.range[0]) if args.range else None
+        except ValueError as e:
+            print('Error: ' + str(e))
+            fallos += 1
+        else:
+            if not ejecutar_accion(desencriptar, sb, args.decrypt[0], rango):
+                fallos += 1
 
     if args.decrypt_files:
-        for i in args.decrypt_files:
-            print('Fichero ' + i)
-            cr.desencriptar(i)
+        fallos += batch.ejecutar_lote(desencriptar, [(sb, i) for i in args.decrypt_files], jobs, True)
 
     if args.sign:
-        cr.firmar(args.sign[0])
+        if not ejecutar_accion(firmar, sb, args.sign[0], args.merkle):
+            fallos += 1
 
     if args.sign_files:
-        for i in args.sign_files:
-            print('Fichero ' + i)
-            cr.firmar(i)
+        fallos += batch.ejecutar_lote(firmar, [(sb, i, args.merkle) for i in args.sign_files], jobs, True)
 
     if args.check_sign:
         if args.source_id:
-            if cr.check_signature(args.check_sign[0],  args.source_id[0]):
-                print('OK')
-                print('Fichero descargado y verificado correctamente.')
-            else:
-                print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id.")
+            if not ejecutar_accion(comprobar_firma, sb, args.check_sign[0], args.source_id[0]):
+                fallos += 1
         else:
             print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
     if args.check_sign_files:
         if args.source_id:
-            for i in args.check_sign_files:
-                print('Fichero ' + i)
-                if cr.check_signature(i,  args.source_id[0]):
-                    print('OK')
-                    print('Fichero verificado correctamente.')
-                else:
-                    print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id.")
+            if obtener_claves([args.source_id[0]]):
+                fallos += batch.ejecutar_lote(comprobar_firma, [(sb, i, args.source_id[0]) for i in args.check_sign_files], jobs, True)
+            else:
+                fallos += len(args.check_sign_files)
         else:
             print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
     if args.enc_sign:
         if args.dest_id:
-            cr.cifrar_firmar(args.enc_sign[0], args.dest_id[0])
+            if not ejecutar_accion(cifrar_firmar, sb, args.enc_sign[0], args.dest_id):
+                fallos += 1
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.enc_sign_files:
         if args.dest_id:
-            for i in args.enc_sign_files:
-                print('Fichero ' + i)
-                cr.cifrar_firmar(i, args.dest_id[0])
+            if obtener_claves(args.dest_id):
+                fallos += batch.ejecutar_lote(cifrar_firmar, [(sb, i, args.dest_id) for i in args.enc_sign_files], jobs, True)
+            else:
+                fallos += len(args.enc_sign_files)
         else:
             print("Es necesario especificar el id del receptor con --dest_id.\n Usa -h para ayuda.")
 
     if args.decrypt_check:
         if args.source_id:
-            file = cr.desencriptar(args.decrypt_check[0])
-            if cr.check_signature(file,  args.source_id[0]):
-                print('OK')
-                print('Fichero verificado correctamente.')
-            else:
-                print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id.")
+            if not ejecutar_accion(desencriptar_verificar, sb, args.decrypt_check[0], args.source_id[0]):
+                fallos += 1
         else:
             print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
     if args.decrypt_check_files:
         if args.source_id:
-            for i in args.decrypt_check_files:
-                print('Fichero ' + i)
-                file = cr.desencriptar(i)
-                if cr.check_signature(file, args.source_id[0]):
-                    print('OK')
-                    print('Fichero verificado correctamente.')
-                else:
-                    print("Error: El archivo ha sido modificado o no ha sido crado por el usuario especificado por --source_id.")
+            if obtener_claves([args.source_id[0]]):
+                fallos += batch.ejecutar_lote(desencriptar_verificar, [(sb, i, args.source_id[0]) for i in args.decrypt_check_files], jobs, True)
+            else:
+                fallos += len(args.decrypt_check_files)
         else:
             print("Es necesario especificar el id del emisor con --source_id.\n Usa -h para ayuda.")
 
+    if args.manifest:
+        opciones = {'force': args.force, 'chunked': args.chunked, 'resume': args.resume, 'merkle': args.merkle}
+        if args.dest_id:
+            opciones['dest_id'] = args.dest_id
+        if args.source_id:
+            opciones['source_id'] = args.source_id[0]
+
+        with open(args.manifest[0]) as lineas:
+            if args.results:
+                with open(args.results[0], 'w') as salida:
+                    total, errores_manifiesto = batch.ejecutar_manifiesto(trabajo_manifiesto, lineas, salida, jobs, (sb, opciones))
+            else:
+                total, errores_manifiesto = batch.ejecutar_manifiesto(trabajo_manifiesto, lineas, sys.stdout, jobs, (sb, opciones))
+        print(str(total) + ' trabajos procesados, ' + str(errores_manifiesto) + ' con errores.', file = sys.stderr)
+        fallos += errores_manifiesto
+
+    if args.key_cache_stats:
+        print('Cache de claves publicas: ' + str(ig.publicKeyCacheStats()))
+
+    return 1 if fallos else 0
 
 
 
-leer()
+if __name__ == '__main__':
+    sys.exit(leer())
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+# Estado de las operaciones que se pueden reanudar si se interrumpen (descargas y cifrado con
+# --resume): un fichero JSON por operación en DIRECTORIO, que se reescribe de forma atómica en cada
+# punto de control, después de haber escrito en disco (fsync) todos los datos que indica. Como el
+# estado del cifrado incluye la clave de sesión, el directorio está dentro de .files y sus
+# ficheros solo los puede leer el usuario.
+DIRECTORIO = './.files/reanudar/'
+
+# Cantidad de datos (en bytes) que se procesan entre cada punto de control.
+INTERVALO = 64 * 1024 * 1024
+
+
+# Funcion que genera la dirección del fichero de estado de una operación.
+# Parámetros:
+#	tipo: tipo de operación ('descarga' o 'cifrado').
+#	clave: cadena que identifica la operación (el id del fichero, la dirección del resultado...).
+# Return: dirección del fichero de estado.
+#
+def ruta_estado(tipo, clave):
+    return DIRECTORIO + tipo + '-' + hashlib.sha256(clave.encode()).hexdigest()[:16] + '.json'
+
+
+# Funcion que lee el estado guardado de una operación.
+# Parámetros:
+#	ruta: dirección del fichero de estado.
+# Return: diccionario con el estado, o None si no hay ninguno (o no se puede leer).
+#
+def leer_estado(ruta):
+    try:
+        with open(ruta) as inp:
+            return json.load(inp)
+    except (OSError, ValueError):
+        return None
+
+
+# Funcion que guarda el estado de una operación, de forma atómica para que una interrupción a
+# mitad nunca deje un estado incompleto.
+# Parámetros:
+#	ruta: dirección del fichero de estado.
+#	estado: diccionario con el estado.
+#
+def guardar_estado(ruta, estado):
+    os.makedirs(DIRECTORIO, mode = 0o700, exist_ok = True)
+    temp = ruta + '.' + str(os.getpid())
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as outp:
+        json.dump(estado, outp)
+        outp.flush()
+        os.fsync(outp.fileno())
+    os.replace(temp, ruta)
+
+
+# Funcion que elimina el estado de una operación que ya ha terminado.
+# Parámetros:
+#	ruta: dirección del fichero de estado.
+#
+def borrar_estado(ruta):
+    if os.path.exists(ruta):
+        os.remove(ruta)
+
+
+# Funcion que escribe en disco todo lo escrito en un fichero, antes de guardar un punto de control
+# que dependa de ello.
+# Parámetros:
+#	outp: fichero abierto.
+#
+def sincronizar(outp):
+    outp.flush()
+    os.fsync(outp.fileno())
@@ -0,0 +1,63 @@
+from Crypto.PublicKey import RSA
+import os
+import sys
+import pytest
+
+# Los módulos del cliente se importan por su nombre, como hace read.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crypt as cr
+import identityGestion as ig
+import localApi
+import metadatos as md
+import utils
+
+
+# Clave RSA del usuario de las pruebas, que es a la vez emisor y destinatario de los ficheros.
+@pytest.fixture(scope = 'session')
+def clave():
+    return RSA.generate(2048)
+
+
+# Clave RSA de otro usuario ('otro'), para las pruebas con varios destinatarios.
+@pytest.fixture(scope = 'session')
+def otra_clave():
+    return RSA.generate(2048)
+
+
+# Directorio de trabajo vacío con la estructura que espera el cliente (.files, encriptado y
+# downloads) y la clave privada del usuario. La clave pública del id 'otro' es otra_clave y la de
+# cualquier otro id la del usuario, sin pedirlas a la API.
+@pytest.fixture
+def entorno(tmp_path, monkeypatch, clave, otra_clave):
+    monkeypatch.chdir(tmp_path)
+    for carpeta in ('.files', 'encriptado', 'downloads'):
+        os.mkdir(carpeta)
+    with open('.files/key.priv', 'wb') as outp:
+        outp.write(clave.exportKey())
+
+    monkeypatch.setenv('SECUREBOX_NO_AGENT', '1')
+    monkeypatch.setattr(cr, '_priv_key_cache', {'mtime': None, 'key': None})
+    monkeypatch.setattr(md, '_esquema_creado', set())
+    monkeypatch.setattr(ig, '_key_cache', {})
+    monkeypatch.setattr(ig, '_requestPublicKey', lambda userID: (otra_clave if userID == 'otro' else clave).publickey().exportKey())
+    return tmp_path
+
+
+# Función que cambia la clave privada del usuario, para descifrar como otro destinatario.
+@pytest.fixture
+def usar_clave(entorno):
+    def usar(key):
+        with open('.files/key.priv', 'wb') as outp:
+            outp.write(key.exportKey())
+        cr._priv_key_cache.update(mtime = None, key = None)
+    return usar
+
+
+# Servidor local de la API (ver localApi.py) al que se dirigen las peticiones del cliente.
+@pytest.fixture
+def servidor(entorno, monkeypatch):
+    servidor = localApi.arrancar()
+    monkeypatch.setattr(utils, 'URL', servidor.url)
+    yield servidor
+    localApi.parar(servidor)
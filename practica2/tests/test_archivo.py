@@ -0,0 +1,140 @@
+from cliente import SecureBoxClient
+from errores import FormatError, SignatureError
+import archivo
+import contenedor
+import crypt as cr
+import filesGestion as fg
+import io
+import metadatos as md
+import os
+import tarfile
+import pytest
+
+
+def crear_directorio(raiz):
+    os.makedirs(os.path.join(raiz, 'sub'))
+    with open(os.path.join(raiz, 'a.bin'), 'wb') as outp:
+        outp.write(os.urandom(3 * 1024 * 1024))
+    with open(os.path.join(raiz, 'sub', 'b.txt'), 'wb') as outp:
+        outp.write(b'hola\n' * 1000)
+    return raiz
+
+
+def test_subir_y_descargar_directorio(servidor):
+    crear_directorio('datos')
+    cliente = SecureBoxClient()
+    file_id = cliente.upload_dir('datos', 'yo')['file_id']
+    rutas = cliente.download_dir(file_id, 'yo', dest = 'copia')['paths']
+
+    assert rutas == [os.path.join('copia', 'datos')]
+    for relativa in ('a.bin', os.path.join('sub', 'b.txt')):
+        with open(os.path.join('datos', relativa), 'rb') as original, open(os.path.join('copia', 'datos', relativa), 'rb') as copia:
+            assert copia.read() == original.read()
+
+
+def test_fallo_al_generar_no_sube_nada(servidor, monkeypatch):
+    crear_directorio('datos')
+    addfile = tarfile.TarFile.addfile
+
+    def fallar(self, info, fileobj=None):
+        if info.name.endswith('b.txt'):
+            raise OSError('el fichero ha cambiado mientras se leía')
+        return addfile(self, info, fileobj)
+
+    monkeypatch.setattr(tarfile.TarFile, 'addfile', fallar)
+    with pytest.raises(OSError, match = 'ha cambiado'):
+        fg.uploadDir('datos', 'yo')
+
+    assert servidor.RequestHandlerClass.almacen.ficheros == {}
+    assert list(md.listar_ficheros()) == []
+
+
+def modificar(file, posicion):
+    with open(file, 'r+b') as outp:
+        outp.seek(posicion)
+        byte = outp.read(1)
+        outp.seek(posicion)
+        outp.write(bytes([byte[0] ^ 0x01]))
+
+
+# Si el archivo no lo ha firmado el emisor indicado no se extrae nada.
+def test_archivo_de_otro_emisor(servidor, usar_clave, clave, otra_clave):
+    crear_directorio('datos')
+    usar_clave(otra_clave)
+    file_id = SecureBoxClient().upload_dir('datos', 'yo')['file_id']
+    usar_clave(clave)
+    with pytest.raises(SignatureError):
+        SecureBoxClient().download_dir(file_id, 'yo', dest = 'copia')
+    assert os.listdir('copia') == []
+
+
+def test_archivo_modificado(servidor):
+    crear_directorio('datos')
+    file_id = SecureBoxClient().upload_dir('datos', 'yo')['file_id']
+    ruta = servidor.RequestHandlerClass.almacen.ruta(file_id)
+    modificar(ruta, os.path.getsize(ruta) // 2)
+    with pytest.raises(FormatError):
+        SecureBoxClient().download_dir(file_id, 'yo', dest = 'copia')
+    assert os.listdir('copia') == []
+
+
+# Un archivo local se puede listar y se pueden extraer sus ficheros uno a uno.
+def test_archivo_local(entorno):
+    crear_directorio('datos')
+    cliente = SecureBoxClient(compresion = 'zlib')
+    path = cliente.encrypt_dir('datos', 'yo')['path']
+    assert path == './encriptado/datos.tar'
+
+    indice = cliente.list_archive(path)
+    assert [(e['name'], e['type']) for e in indice] == [('datos', 'dir'), ('datos/a.bin', 'file'), ('datos/sub', 'dir'), ('datos/sub/b.txt', 'file')]
+    for entrada in indice:
+        if entrada['type'] == 'file':
+            assert entrada['size'] == os.path.getsize(entrada['name'])
+            outp = io.BytesIO()
+            assert cliente.extract_member(path, entrada['name'], outp)['member'] == entrada
+            with open(entrada['name'], 'rb') as inp:
+                assert outp.getvalue() == inp.read()
+
+    assert cliente.extract_member(path, 'datos/sub/b.txt')['path'] == './downloads/b.txt'
+    with pytest.raises(FileNotFoundError):
+        cliente.extract_member(path, 'datos/c.txt', dest = 'c.txt')
+    assert not os.path.exists('c.txt')
+
+    # El índice del archivo va en el último registro del fichero cifrado: si se modifica, no se
+    # puede listar.
+    with open(path, 'rb') as inp:
+        lector = archivo.LectorArchivo(inp)
+        ultimo = contenedor.leer_indice(inp, lector.key, lector.prefijo, lector.cabecera)[1][-1]
+    modificar(path, ultimo + 10)
+    with pytest.raises(FormatError):
+        cliente.list_archive(path)
+
+
+@pytest.mark.parametrize('nombre', ['../fuera.txt', 'datos/../../fuera.txt', '/tmp/fuera.txt', 'datos\\..\\..\\fuera.txt'])
+def test_miembros_no_validos(nombre):
+    with pytest.raises(ValueError):
+        archivo.comprobar_miembro(tarfile.TarInfo(nombre))
+
+
+def test_miembros_validos():
+    archivo.comprobar_miembro(tarfile.TarInfo('datos/a.bin'))
+    enlace = tarfile.TarInfo('datos/enlace')
+    enlace.type = tarfile.SYMTYPE
+    with pytest.raises(ValueError):
+        archivo.comprobar_miembro(enlace)
+
+
+# Un archivo firmado correctamente pero con un miembro fuera del destino no se extrae.
+def test_archivo_con_ruta_fuera_del_destino(entorno, clave):
+    tar = io.BytesIO()
+    with tarfile.open(fileobj = tar, mode = 'w') as outp:
+        info = tarfile.TarInfo('../fuera.txt')
+        info.size = 5
+        outp.addfile(info, io.BytesIO(b'fuera'))
+    tam, bloques = cr.cifrar_firmar_bloques(io.BytesIO(tar.getvalue()), 'yo', formato = 'gcm')
+    cifrado = b''.join(bytes(buf) for buf in bloques)
+
+    os.makedirs('copia')
+    with pytest.raises(ValueError, match = 'no válido'):
+        archivo.extraer_flujo(io.BytesIO(cifrado), clave.publickey(), 'copia')
+    assert os.listdir('copia') == [] and not os.path.exists('fuera.txt')
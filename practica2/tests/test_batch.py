@@ -0,0 +1,52 @@
+import batch
+import io
+import json
+import sys
+import pytest
+
+
+def tarea(numero):
+    print('tarea ' + str(numero))
+    if numero == 1:
+        raise ValueError('fallo')
+    if numero == 2:
+        sys.exit(3)
+    if numero == 3:
+        return False
+    return numero
+
+
+# Cada forma de fallar cuenta como un fallo, y lo que imprime cada tarea sale completo y en el
+# orden de los ficheros aunque se ejecuten a la vez.
+@pytest.mark.parametrize('jobs, procesos', [(1, False), (3, False), (3, True)])
+def test_ejecutar_lote(capsys, jobs, procesos):
+    assert batch.ejecutar_lote(tarea, [(i,) for i in range(6)], jobs, procesos) == 3
+
+    lineas = capsys.readouterr().out.splitlines()
+    assert [linea for linea in lineas if linea.startswith('tarea')] == ['tarea ' + str(i) for i in range(6)]
+    assert 'Error: ValueError: fallo' in lineas
+    assert 'Error: la tarea ha terminado con código 3' in lineas
+    assert lineas[-1] == '6 ficheros procesados, 3 con errores.'
+
+
+def trabajo(datos, extra):
+    print('salida de ' + str(datos.get('id')))
+    if datos.get('action') == 'fallar':
+        raise ValueError('fallo')
+    return datos['action'] + extra
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_ejecutar_manifiesto(jobs):
+    lineas = [json.dumps({'id': i, 'action': 'fallar' if i % 3 == 0 else 'ok'}) + '\n' for i in range(10)]
+    lineas.insert(4, '\n')
+    lineas.insert(6, 'no es json\n')
+    salida = io.StringIO()
+
+    assert batch.ejecutar_manifiesto(trabajo, iter(lineas), salida, jobs, ('!',)) == (11, 5)
+
+    resultados = {r['line']: r for r in map(json.loads, salida.getvalue().splitlines())}
+    assert sorted(resultados) == [n for n in range(1, 13) if n != 5]
+    assert resultados[2] == {'line': 2, 'id': 1, 'action': 'ok', 'ok': True, 'result': 'ok!', 'seconds': resultados[2]['seconds']}
+    assert resultados[1]['error'] == 'ValueError: fallo' and resultados[1]['output'] == 'salida de 0\n'
+    assert not resultados[7]['ok'] and 'JSONDecodeError' in resultados[7]['error']
@@ -0,0 +1,67 @@
+import contenedor
+import crypt as cr
+import io
+import lzma
+import os
+import struct
+import zlib
+import pytest
+
+TROZO = 64 * 1024
+
+
+def comprimible(tam):
+    linea = b'2024-01-01 12:00:00 INFO peticion atendida en 12 ms\n'
+    return (linea * (tam // len(linea) + 1))[:tam]
+
+
+def cifrar(datos, compresion):
+    tam, bloques = cr.cifrar_firmar_bloques(io.BytesIO(datos), 'yo', TROZO, compresion = compresion)
+    return b''.join(bytes(buf) for buf in bloques)
+
+
+def descifrar(cifrado):
+    outp = io.BytesIO()
+    return cr.descifrar_verificar_stream(io.BytesIO(cifrado), outp, 'yo', workers = 1), outp.getvalue()
+
+
+@pytest.mark.parametrize('compresion, flag', [('zlib', contenedor.FLAG_ZLIB), ('lzma', contenedor.FLAG_LZMA), ('auto', contenedor.FLAG_ZLIB)])
+def test_ida_y_vuelta(entorno, compresion, flag):
+    datos = comprimible(5 * TROZO + 11)
+    cifrado = cifrar(datos, compresion)
+    version, flags = cr.leer_cabecera(io.BytesIO(cifrado))[:2]
+    assert version == contenedor.VERSION and flags & flag
+    assert len(cifrado) < len(datos) // 4
+    assert descifrar(cifrado) == (True, datos)
+
+    # Los rangos se siguen pudiendo descifrar trozo a trozo.
+    outp = io.BytesIO()
+    cr.desencriptar_rango_stream(io.BytesIO(cifrado), outp, TROZO - 3, 3 * TROZO + 3, workers = 1)
+    assert outp.getvalue() == datos[TROZO - 3:3 * TROZO + 3]
+
+
+def test_auto_no_comprime_lo_incompresible(entorno):
+    datos = os.urandom(2 * TROZO)
+    cifrado = cifrar(datos, 'auto')
+    flags = cr.leer_cabecera(io.BytesIO(cifrado))[1]
+    assert contenedor.compresion_flags(flags) is None
+    assert descifrar(cifrado) == (True, datos)
+
+
+@pytest.mark.parametrize('compresion, comprimir', [('zlib', zlib.compress), ('lzma', lzma.compress)])
+def test_descomprimir_limitado(compresion, comprimir):
+    assert contenedor.descomprimir(compresion, comprimir(b'a' * TROZO), TROZO) == b'a' * TROZO
+    for datos in (comprimir(b'\0' * (100 * TROZO)), comprimir(b'a' * 10) + b'sobra', comprimir(b'a' * 10)[:-3], b'no comprimido'):
+        with pytest.raises(ValueError):
+            contenedor.descomprimir(compresion, datos, TROZO)
+
+
+# Un registro correctamente cifrado (por cualquiera que tenga nuestra clave pública) cuyos datos
+# se descomprimen a más del tamaño de trozo de la cabecera se rechaza.
+def test_registro_que_se_descomprime_de_mas():
+    key, prefijo, resumen = os.urandom(32), os.urandom(8), os.urandom(32)
+    bomba = zlib.compress(b'\0' * (1000 * TROZO))
+    registro = contenedor.cifrar_trozo(key, prefijo, resumen, 0, contenedor.ULTIMO, bomba)
+    cifrado = registro[struct.calcsize(contenedor.FORMATO_REGISTRO):]
+    with pytest.raises(ValueError, match = 'comprimido no válido'):
+        contenedor.descifrar_trozo(key, prefijo, resumen, 0, contenedor.ULTIMO, cifrado, 'zlib', TROZO)
@@ -0,0 +1,146 @@
+import contenedor
+import crypt as cr
+import io
+import os
+import struct
+import pytest
+
+TROZO = 4096
+TAM_REGISTRO = struct.calcsize(contenedor.FORMATO_REGISTRO)
+
+
+def cifrar(datos, dest_id='yo', **kwargs):
+    kwargs.setdefault('chunk_size', TROZO)
+    tam, bloques = cr.cifrar_firmar_bloques(io.BytesIO(datos), dest_id, formato = 'gcm', **kwargs)
+    cifrado = b''.join(bytes(buf) for buf in bloques)
+    assert tam is None or tam == len(cifrado)
+    return cifrado
+
+
+def descifrar(cifrado, source_id='yo', workers=1):
+    outp = io.BytesIO()
+    return cr.descifrar_verificar_stream(io.BytesIO(cifrado), outp, source_id, workers = workers), outp.getvalue()
+
+
+# Estructura de un fichero cifrado por trozos: tamaño de la cabecera y lista de registros
+# (posición, tipo y longitud), del primero al índice, y posición del pie.
+def registros(cifrado):
+    inp = io.BytesIO(cifrado)
+    cr.leer_cabecera(inp)
+    cabecera = inp.tell()
+    lista = []
+    posicion = cabecera
+    while posicion < len(cifrado) - struct.calcsize(contenedor.FORMATO_PIE):
+        tipo, tam = struct.unpack(contenedor.FORMATO_REGISTRO, cifrado[posicion:posicion + TAM_REGISTRO])
+        lista.append((posicion, tipo, tam))
+        posicion += TAM_REGISTRO + tam + contenedor.TAM_TAG
+    return cabecera, lista, posicion
+
+
+def modificar(cifrado, posicion, valor=None):
+    cifrado = bytearray(cifrado)
+    cifrado[posicion] = cifrado[posicion] ^ 0x01 if valor is None else valor
+    return bytes(cifrado)
+
+
+@pytest.mark.parametrize('tam', [0, 1, TROZO - 1, TROZO, TROZO + 1, 10 * TROZO + 5])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_ida_y_vuelta(entorno, tam, workers):
+    datos = os.urandom(tam)
+    cifrado = cifrar(datos, workers = workers)
+    assert descifrar(cifrado, workers = workers) == (True, datos)
+
+    cabecera, lista, pie = registros(cifrado)
+    tipos = [tipo for posicion, tipo, tam_registro in lista]
+    n = contenedor.num_trozos(tam, TROZO)
+    assert tipos == [contenedor.DATOS] * (n - 1) + [contenedor.ULTIMO, contenedor.FIRMA, contenedor.INDICE]
+    assert struct.unpack(contenedor.FORMATO_PIE, cifrado[pie:]) == (lista[-1][0], contenedor.MAGIC_INDICE)
+
+    # Sin firma: encriptar_stream y desencriptar_stream.
+    cifrado, descifrado = io.BytesIO(), io.BytesIO()
+    cr.encriptar_stream(io.BytesIO(datos), cifrado, 'yo', TROZO, formato = 'gcm', workers = workers)
+    cr.desencriptar_stream(io.BytesIO(cifrado.getvalue()), descifrado, workers = workers)
+    assert descifrado.getvalue() == datos
+
+
+def test_varios_destinatarios(entorno, usar_clave, otra_clave):
+    datos = os.urandom(3 * TROZO)
+    cifrado = cifrar(datos, ['yo', 'otro'])
+    assert descifrar(cifrado) == (True, datos)
+    usar_clave(otra_clave)
+    assert descifrar(cifrado) == (True, datos)
+
+
+# Cualquier cambio en la cabecera o en los registros de datos y de firma se detecta.
+def test_registro_modificado(entorno):
+    cifrado = cifrar(os.urandom(5 * TROZO))
+    cabecera, lista, pie = registros(cifrado)
+    posiciones = [4, 5, cabecera - 1]
+    for posicion, tipo, tam in lista[:-1]:
+        posiciones += [posicion, posicion + TAM_REGISTRO, posicion + TAM_REGISTRO + tam // 2, posicion + TAM_REGISTRO + tam + 15]
+    for posicion in posiciones:
+        assert descifrar(modificar(cifrado, posicion))[0] is False, posicion
+
+
+def test_registros_reordenados_o_truncados(entorno):
+    cifrado = cifrar(os.urandom(5 * TROZO))
+    cabecera, lista, pie = registros(cifrado)
+    trozos = [cifrado[posicion:posicion + TAM_REGISTRO + tam + contenedor.TAM_TAG] for posicion, tipo, tam in lista]
+    principio, resto = cifrado[:cabecera], cifrado[lista[-1][0]:]
+
+    assert descifrar(principio + b''.join(trozos[:-1]) + resto)[0] is True
+    assert descifrar(principio + b''.join([trozos[1], trozos[0]] + trozos[2:-1]) + resto)[0] is False
+    assert descifrar(principio + b''.join(trozos[1:-1]) + resto)[0] is False
+    assert descifrar(principio + b''.join(trozos[:2] + trozos[3:-1]) + resto)[0] is False
+    assert descifrar(principio + b''.join(trozos[:-2]))[0] is False
+    assert descifrar(principio + b''.join(trozos[:4]))[0] is False
+    for fin in (cabecera, cabecera + 3, lista[2][0] + 100, lista[-2][0] - 1):
+        assert descifrar(cifrado[:fin])[0] is False
+
+
+# Las longitudes de los registros se leen antes de poder autenticarlos: una longitud enorme se
+# rechaza sin intentar leerla.
+def test_longitudes_no_validas(entorno):
+    cifrado = cifrar(os.urandom(3 * TROZO))
+    cabecera, lista, pie = registros(cifrado)
+    extra = cr.leer_cabecera(io.BytesIO(cifrado))[2]
+    tam_trozo, tam_firma, prefijo = struct.unpack(contenedor.FORMATO_EXTRA, extra)
+
+    for posicion, tipo, tam in lista[:-1]:
+        largo = bytearray(cifrado)
+        largo[posicion + 1:posicion + TAM_REGISTRO] = struct.pack('>I', 0xFFFFFFF0)
+        inp = io.BytesIO(bytes(largo))
+        inp.seek(cabecera)
+        with pytest.raises(ValueError, match = 'demasiado largo'):
+            list(contenedor.leer_registros(inp, tam_trozo))
+        assert descifrar(bytes(largo))[0] is False
+
+    # El tamaño de trozo de la cabecera también está limitado.
+    with pytest.raises(ValueError, match = 'tamaño de trozo'):
+        contenedor.tam_max_registro(contenedor.DATOS, contenedor.TAM_MAX_TROZO + 1)
+
+
+def test_indice(entorno):
+    datos = os.urandom(4 * TROZO + 7)
+    cifrado = cifrar(datos)
+    cabecera, lista, pie = registros(cifrado)
+    version, flags, extra, key, bytes_cabecera = cr.leer_cabecera(io.BytesIO(cifrado))
+    prefijo = struct.unpack(contenedor.FORMATO_EXTRA, extra)[2]
+
+    def leer_indice(cifrado):
+        return contenedor.leer_indice(io.BytesIO(cifrado), key, prefijo, bytes_cabecera)
+
+    assert leer_indice(cifrado) == (len(datos), [posicion for posicion, tipo, tam in lista[:5]])
+
+    indice = lista[-1][0]
+    modificados = [
+        modificar(cifrado, indice + TAM_REGISTRO + 3),
+        modificar(cifrado, len(cifrado) - 1),
+        cifrado[:pie] + struct.pack(contenedor.FORMATO_PIE, 2 ** 62, contenedor.MAGIC_INDICE),
+        cifrado[:pie] + struct.pack(contenedor.FORMATO_PIE, lista[0][0], contenedor.MAGIC_INDICE),
+        cifrado[:indice + 1] + struct.pack('>I', 0xFFFFFFF0) + cifrado[indice + TAM_REGISTRO:],
+        cifrado[:pie],
+    ]
+    for modificado in modificados:
+        with pytest.raises(ValueError):
+            leer_indice(modificado)
@@ -0,0 +1,74 @@
+import crypt as cr
+import io
+import os
+import struct
+import pytest
+
+
+def cifrar(datos, dest_id, **kwargs):
+    tam, bloques = cr.cifrar_firmar_bloques(io.BytesIO(datos), dest_id, **kwargs)
+    cifrado = b''.join(bytes(buf) for buf in bloques)
+    assert tam is None or tam == len(cifrado)
+    return cifrado
+
+
+def descifrar(cifrado, source_id='yo'):
+    outp = io.BytesIO()
+    return cr.descifrar_verificar_stream(io.BytesIO(cifrado), outp, source_id), outp.getvalue()
+
+
+def modificar(cifrado, posicion):
+    cifrado = bytearray(cifrado)
+    cifrado[posicion] ^= 0x01
+    return bytes(cifrado)
+
+
+@pytest.mark.parametrize('tam', [0, 1, 15, 16, 17, cr.CHUNK_SIZE + 3])
+def test_formato_original(entorno, tam):
+    datos = os.urandom(tam)
+    cifrado = cifrar(datos, 'yo', formato = 'cbc')
+    assert cifrado[:len(cr.MAGIC)] != cr.MAGIC
+    assert descifrar(cifrado) == (True, datos)
+
+    # Sin firma: encriptar_stream y desencriptar_stream.
+    cifrado, descifrado = io.BytesIO(), io.BytesIO()
+    cr.encriptar_stream(io.BytesIO(datos), cifrado, 'yo', formato = 'cbc')
+    cr.desencriptar_stream(io.BytesIO(cifrado.getvalue()), descifrado)
+    assert descifrado.getvalue() == datos
+
+
+def test_formato_original_modificado(entorno, clave):
+    cifrado = cifrar(os.urandom(100000), 'yo', formato = 'cbc')
+    tam_cabecera = 16 + clave.size_in_bytes()
+    for posicion in (0, 20, tam_cabecera, tam_cabecera + 1000, len(cifrado) // 2, len(cifrado) - 1):
+        assert descifrar(modificar(cifrado, posicion))[0] is False
+    assert descifrar(cifrado[:-16])[0] is False
+    assert descifrar(cifrado[:tam_cabecera - 1])[0] is False
+
+
+# Con varios destinatarios la clave de sesión se cifra para cada uno en el sobre de la versión 2,
+# y cada destinatario la encuentra por la huella de su clave.
+def test_sobre_varios_destinatarios(entorno, usar_clave, clave, otra_clave):
+    datos = os.urandom(50000)
+    cifrado = cifrar(datos, ['yo', 'otro'], formato = 'cbc')
+    magic, version, flags, ranuras = struct.unpack(cr.FORMATO_CABECERA, cifrado[:struct.calcsize(cr.FORMATO_CABECERA)])
+    assert (magic, version, ranuras) == (cr.MAGIC, cr.VERSION_SOBRE, 2)
+
+    assert descifrar(cifrado) == (True, datos)
+    usar_clave(otra_clave)
+    assert descifrar(cifrado) == (True, datos)
+
+    # Quien no está entre los destinatarios no puede descifrarlo.
+    usar_clave(clave)
+    solo_otro = cifrar(datos, ['otro', 'otro'], formato = 'cbc')
+    with pytest.raises(ValueError, match = 'no está cifrado para este usuario'):
+        cr.leer_cabecera(io.BytesIO(solo_otro))
+    assert descifrar(solo_otro)[0] is False
+
+
+def test_sobre_modificado(entorno, clave):
+    cifrado = cifrar(os.urandom(50000), ['yo', 'otro'], formato = 'cbc')
+    inicio = struct.calcsize(cr.FORMATO_CABECERA) + 16
+    huella = cifrado.index(cr.huella(clave), inicio)
+    for posicion in (0, 4, 6, inicio - 1, huella, huella + 10, len(cifrado) // 2, len(cifrado) - 1):
+        assert descifrar(modificar(cifrado, posicion))[0] is False
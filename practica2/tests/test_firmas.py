@@ -0,0 +1,122 @@
+import crypt as cr
+import io
+import os
+import read
+import sys
+import pytest
+
+
+# Flujo que no admite seek, como una tubería.
+class Tubo(io.BytesIO):
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation('seek')
+
+    def tell(self):
+        raise io.UnsupportedOperation('tell')
+
+
+def verificar(firmado, key, modificados=None):
+    outp = io.BytesIO()
+    correcta = cr.verificar_flujo(cr.leer_bloques(io.BytesIO(firmado)), outp, key, modificados = modificados)
+    return correcta, outp.getvalue()
+
+
+def modificar(datos, posicion):
+    datos = bytearray(datos)
+    datos[posicion] ^= 0x01
+    return bytes(datos)
+
+
+@pytest.mark.parametrize('tam', [0, 1, 300, cr.CHUNK_SIZE + 3])
+def test_firma_al_final(entorno, clave, tam):
+    datos = os.urandom(tam)
+    outp = Tubo()
+    cr.firmar_stream(io.BytesIO(datos), outp)
+    firmado = outp.getvalue()
+    assert firmado[:len(cr.MAGIC_FIRMA_FINAL)] == cr.MAGIC_FIRMA_FINAL
+    assert len(firmado) == len(cr.MAGIC_FIRMA_FINAL) + tam + clave.size_in_bytes()
+    assert verificar(firmado, clave.publickey()) == (True, datos)
+
+    # Con al_final se usa el mismo formato aunque la salida admita seek.
+    outp = io.BytesIO()
+    cr.firmar_stream(io.BytesIO(datos), outp, al_final = True)
+    assert verificar(outp.getvalue(), clave.publickey()) == (True, datos)
+
+
+def test_firma_al_final_modificada(entorno, clave, otra_clave):
+    outp = Tubo()
+    cr.firmar_stream(io.BytesIO(os.urandom(5000)), outp)
+    firmado = outp.getvalue()
+    for posicion in (len(cr.MAGIC_FIRMA_FINAL), 2000, len(firmado) - clave.size_in_bytes(), len(firmado) - 1):
+        assert verificar(modificar(firmado, posicion), clave.publickey())[0] is False
+    assert verificar(firmado[:-1], clave.publickey())[0] is False
+    assert verificar(firmado, otra_clave.publickey())[0] is False
+
+
+# El formato original (firma delante) sigue verificándose igual.
+def test_firma_delante(entorno, clave):
+    datos = os.urandom(5000)
+    outp = io.BytesIO()
+    cr.firmar_stream(io.BytesIO(datos), outp)
+    firmado = outp.getvalue()
+    assert firmado[:len(cr.MAGIC_FIRMA_FINAL)] != cr.MAGIC_FIRMA_FINAL
+    assert verificar(firmado, clave.publickey()) == (True, datos)
+    assert verificar(modificar(firmado, len(firmado) - 1), clave.publickey())[0] is False
+
+
+# Si la entrada no admite seek, el cifrado CBC firmado lleva la firma al final dentro del cifrado.
+def test_cifrado_firmado_desde_tubo(entorno):
+    datos = os.urandom(cr.CHUNK_SIZE + 5)
+    tam, bloques = cr.cifrar_firmar_bloques(Tubo(datos), 'yo', formato = 'cbc')
+    assert tam is None
+    cifrado = b''.join(bytes(buf) for buf in bloques)
+
+    outp = io.BytesIO()
+    assert cr.descifrar_verificar_stream(io.BytesIO(cifrado), outp, 'yo') is True
+    assert outp.getvalue() == datos
+    assert cr.descifrar_verificar_stream(io.BytesIO(modificar(cifrado, len(cifrado) // 2)), io.BytesIO(), 'yo') is False
+
+    # Descifrado sin verificar: el resultado es el fichero firmado con la firma al final.
+    outp = io.BytesIO()
+    cr.desencriptar_stream(io.BytesIO(cifrado), outp)
+    assert outp.getvalue()[:len(cr.MAGIC_FIRMA_FINAL)] == cr.MAGIC_FIRMA_FINAL
+
+
+# En el cifrado por trozos la firma llega al final, por lo que al descifrar hacia una salida sin
+# seek se escribe con la firma al final.
+def test_descifrado_gcm_hacia_tubo(entorno, clave):
+    datos = os.urandom(50000)
+    tam, bloques = cr.cifrar_firmar_bloques(io.BytesIO(datos), 'yo', formato = 'gcm')
+    cifrado = b''.join(bytes(buf) for buf in bloques)
+
+    outp = Tubo()
+    cr.desencriptar_stream(io.BytesIO(cifrado), outp)
+    firmado = outp.getvalue()
+    assert firmado[:len(cr.MAGIC_FIRMA_FINAL)] == cr.MAGIC_FIRMA_FINAL
+    assert verificar(firmado, clave.publickey()) == (True, datos)
+
+    outp = io.BytesIO()
+    cr.desencriptar_stream(io.BytesIO(cifrado), outp)
+    assert verificar(outp.getvalue(), clave.publickey()) == (True, datos)
+
+
+# En modo flujo se firma desde la entrada estándar y se verifica el resultado con --check_sign.
+def test_modo_flujo(entorno, monkeypatch):
+    datos = os.urandom(100000)
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(Tubo(datos)))
+    assert read.leer(['--sign', '-', '--out', 'firmado.bin']) == 0
+    with open('firmado.bin', 'rb') as inp:
+        firmado = inp.read()
+    assert firmado[:len(cr.MAGIC_FIRMA_FINAL)] != cr.MAGIC_FIRMA_FINAL
+
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(Tubo(firmado)))
+    assert read.leer(['--check_sign', '-', '--source_id', 'yo', '--out', 'verificado.bin']) == 0
+    with open('verificado.bin', 'rb') as inp:
+        assert inp.read() == datos
+
+    monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(Tubo(modificar(firmado, 500))))
+    assert read.leer(['--check_sign', '-', '--source_id', 'yo', '--out', 'verificado2.bin']) == 1
+    assert not os.path.exists('verificado2.bin')
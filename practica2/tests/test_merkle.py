@@ -0,0 +1,104 @@
+from cliente import SecureBoxClient
+from errores import SignatureError
+import crypt as cr
+import hashing
+import io
+import os
+import struct
+import pytest
+
+HOJA = 1000
+
+
+def firmar(datos, tam_hoja=HOJA):
+    outp = io.BytesIO()
+    cr.firmar_merkle_stream(io.BytesIO(datos), outp, tam_hoja)
+    return outp.getvalue()
+
+
+def verificar(firmado, key):
+    outp, modificados = io.BytesIO(), []
+    try:
+        correcta = cr.verificar_flujo(cr.leer_bloques(io.BytesIO(firmado), 700), outp, key, modificados = modificados)
+    except ValueError:
+        correcta = False
+    return correcta, outp.getvalue(), modificados
+
+
+def modificar(datos, posicion):
+    datos = bytearray(datos)
+    datos[posicion] ^= 0x01
+    return bytes(datos)
+
+
+# Posición en el fichero firmado del primer byte de datos.
+def inicio_datos(firmado, key):
+    tam_hoja, tam = struct.unpack(cr.FORMATO_MERKLE, firmado[len(cr.MAGIC_FIRMA_MERKLE):len(cr.MAGIC_FIRMA_MERKLE) + struct.calcsize(cr.FORMATO_MERKLE)])[1:]
+    return (len(cr.MAGIC_FIRMA_MERKLE) + struct.calcsize(cr.FORMATO_MERKLE) + key.size_in_bytes() +
+            hashing.HashSHA256.digest_size * cr.num_hojas(tam, tam_hoja))
+
+
+@pytest.mark.parametrize('tam', [0, 1, HOJA - 1, HOJA, 3 * HOJA + 500])
+def test_firma_merkle(entorno, clave, tam):
+    datos = os.urandom(tam)
+    firmado = firmar(datos)
+    assert firmado[:len(cr.MAGIC_FIRMA_MERKLE)] == cr.MAGIC_FIRMA_MERKLE
+    assert inicio_datos(firmado, clave) == len(firmado) - tam
+    assert verificar(firmado, clave.publickey()) == (True, datos, [])
+
+
+# Los hashes de los trozos se calculan igual en paralelo que en un solo hilo.
+def test_hojas_en_paralelo(entorno):
+    trozos = [os.urandom(HOJA) for _ in range(9)]
+    assert list(hashing.hojas_merkle(iter(trozos), 4)) == list(hashing.hojas_merkle(iter(trozos), 1))
+
+
+# Al modificar un trozo la verificación indica exactamente cuál.
+def test_trozos_modificados(entorno, clave):
+    firmado = firmar(os.urandom(5 * HOJA + 10))
+    inicio = inicio_datos(firmado, clave)
+    for trozo in range(6):
+        correcta, datos, modificados = verificar(modificar(firmado, inicio + trozo * HOJA + 7), clave.publickey())
+        assert (correcta, modificados) == (False, [trozo])
+
+    dos = modificar(modificar(firmado, inicio + 1), inicio + 3 * HOJA)
+    assert verificar(dos, clave.publickey())[::2] == (False, [0, 3])
+
+
+def test_fichero_truncado_o_alargado(entorno, clave):
+    firmado = firmar(os.urandom(5 * HOJA + 10))
+    assert verificar(firmado[:-5], clave.publickey())[::2] == (False, [5])
+    assert verificar(firmado[:-10], clave.publickey())[::2] == (False, [5])
+    assert verificar(firmado[:-(HOJA + 10)], clave.publickey())[::2] == (False, [4, 5])
+    assert verificar(firmado + b'x', clave.publickey())[::2] == (False, [5])
+    assert verificar(firmado[:len(cr.MAGIC_FIRMA_MERKLE) + 5], clave.publickey())[0] is False
+
+
+# La firma cubre la cabecera (tamaño de hoja y del fichero) y los hashes de los trozos.
+def test_cabecera_modificada(entorno, clave, otra_clave):
+    firmado = firmar(os.urandom(5 * HOJA + 10))
+    tam_cabecera = len(cr.MAGIC_FIRMA_MERKLE) + struct.calcsize(cr.FORMATO_MERKLE)
+    for posicion in range(len(cr.MAGIC_FIRMA_MERKLE), tam_cabecera):
+        assert verificar(modificar(firmado, posicion), clave.publickey())[0] is False
+    for posicion in (tam_cabecera, tam_cabecera + clave.size_in_bytes(), inicio_datos(firmado, clave) - 1):
+        assert verificar(modificar(firmado, posicion), clave.publickey())[0] is False
+    assert verificar(firmado, otra_clave.publickey())[0] is False
+
+
+# El cliente lanza SignatureError con los trozos modificados y no guarda nada.
+def test_verificar_con_el_cliente(entorno, clave):
+    with open('datos.bin', 'wb') as outp:
+        outp.write(os.urandom(3 * cr.TAM_HOJA_MERKLE + 10))
+    sb = SecureBoxClient()
+    firmado = sb.sign('datos.bin', merkle = True)['path']
+    with open(firmado, 'rb') as inp:
+        contenido = inp.read()
+    assert contenido[:len(cr.MAGIC_FIRMA_MERKLE)] == cr.MAGIC_FIRMA_MERKLE
+
+    inicio = inicio_datos(contenido, clave)
+    with open(firmado, 'wb') as outp:
+        outp.write(modificar(contenido, inicio + 2 * cr.TAM_HOJA_MERKLE + 3))
+    with pytest.raises(SignatureError) as error:
+        sb.verify(firmado, 'yo', dest = 'verificado.bin')
+    assert error.value.modificados == [2]
+    assert not os.path.exists('verificado.bin')
@@ -0,0 +1,84 @@
+import contenedor
+import crypt as cr
+import io
+import os
+import read
+import struct
+import pytest
+
+TROZO = 4096
+TAM = 5 * TROZO + 7
+
+
+def cifrar(datos, **kwargs):
+    cifrado = io.BytesIO()
+    cr.encriptar_stream(io.BytesIO(datos), cifrado, 'yo', TROZO, **kwargs)
+    return cifrado.getvalue()
+
+
+def rango(cifrado, inicio, fin=None, workers=1):
+    outp = io.BytesIO()
+    cr.desencriptar_rango_stream(io.BytesIO(cifrado), outp, inicio, fin, workers)
+    return outp.getvalue()
+
+
+@pytest.fixture
+def fichero(entorno):
+    datos = os.urandom(TAM)
+    return datos, cifrar(datos, formato = 'gcm')
+
+
+@pytest.mark.parametrize('inicio, fin', [
+    (0, 0), (0, 1), (0, TROZO), (TROZO - 1, TROZO), (TROZO - 1, TROZO + 1), (TROZO, 2 * TROZO),
+    (TROZO, 2 * TROZO + 1), (2 * TROZO - 1, 4 * TROZO + 1), (5 * TROZO, TAM), (TAM - 1, TAM),
+    (0, None), (TAM - 1, None), (TAM, None), (TAM + 10, None), (3, TAM + 100), (7, 5),
+])
+def test_limites(fichero, inicio, fin):
+    datos, cifrado = fichero
+    assert rango(cifrado, inicio, fin) == datos[inicio:fin]
+
+
+def test_en_paralelo(fichero):
+    datos, cifrado = fichero
+    assert rango(cifrado, 5, TAM - 5, workers = 2) == datos[5:TAM - 5]
+
+
+def test_fichero_vacio_y_multiplo_del_trozo(entorno):
+    assert rango(cifrar(b'', formato = 'gcm'), 0) == b''
+    datos = os.urandom(3 * TROZO)
+    cifrado = cifrar(datos, formato = 'gcm')
+    assert rango(cifrado, 2 * TROZO, 3 * TROZO) == datos[2 * TROZO:]
+    assert rango(cifrado, 3 * TROZO - 1) == datos[-1:]
+
+
+# Solo se leen los registros que cubren el rango: un registro modificado solo se detecta si el
+# rango lo incluye.
+def test_registro_modificado(fichero):
+    datos, cifrado = fichero
+    cabecera = io.BytesIO(cifrado)
+    cr.leer_cabecera(cabecera)
+    segundo = cabecera.tell() + struct.calcsize(contenedor.FORMATO_REGISTRO) + TROZO + contenedor.TAM_TAG + 100
+    cifrado = bytearray(cifrado)
+    cifrado[segundo] ^= 0x01
+    cifrado = bytes(cifrado)
+
+    assert rango(cifrado, 0, TROZO) == datos[:TROZO]
+    assert rango(cifrado, 2 * TROZO) == datos[2 * TROZO:]
+    with pytest.raises(ValueError):
+        rango(cifrado, TROZO - 1, TROZO + 1)
+
+
+def test_formatos_sin_indice(entorno):
+    with pytest.raises(ValueError, match = 'Solo se pueden descifrar rangos'):
+        rango(cifrar(os.urandom(100), formato = 'cbc'), 0)
+
+
+@pytest.mark.parametrize('texto, valor', [('0:10', (0, 10)), (':10', (0, 10)), ('5:', (5, None)), (':', (0, None))])
+def test_leer_rango(texto, valor):
+    assert read.leerRango(texto) == valor
+
+
+@pytest.mark.parametrize('texto', ['10', '5:3', '-1:4', 'a:b'])
+def test_leer_rango_no_valido(texto):
+    with pytest.raises(ValueError):
+        read.leerRango(texto)
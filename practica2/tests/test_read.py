@@ -0,0 +1,86 @@
+import cliente
+import contenedor
+import crypt as cr
+import identityGestion as ig
+import json
+import os
+import read
+import requests
+import threading
+
+
+# En modo flujo el progreso va a la salida de errores, pero solo el del hilo que ejecuta la orden:
+# las demás órdenes (por ejemplo, las del agente) siguen escribiendo en su salida estándar.
+def test_flujo_no_cambia_la_salida_de_otros_hilos(entorno, capsys, monkeypatch):
+    with open('datos.bin', 'wb') as outp:
+        outp.write(os.urandom(100000))
+    sign = cliente.SecureBoxClient.sign
+
+    def sign_con_otro_hilo(self, *args, **kwargs):
+        hilo = threading.Thread(target = print, args = ('otro hilo',))
+        hilo.start()
+        hilo.join()
+        return sign(self, *args, **kwargs)
+
+    monkeypatch.setattr(cliente.SecureBoxClient, 'sign', sign_con_otro_hilo)
+    assert read.leer(['--sign', 'datos.bin', '--out', 'firmado.bin']) == 0
+
+    salida = capsys.readouterr()
+    assert salida.out == 'otro hilo\n'
+    assert 'Firmando' in salida.err
+    assert os.path.getsize('firmado.bin') > 100000
+
+
+# Si no se puede obtener la clave de un lote, el lote cuenta como fallido y el resto de acciones
+# de la orden se ejecutan igualmente.
+def test_lote_sin_clave_publica(entorno, capsys, monkeypatch):
+    def sin_conexion(userID):
+        raise requests.ConnectionError('sin conexión')
+
+    with open('datos.bin', 'wb') as outp:
+        outp.write(b'datos')
+    monkeypatch.setattr(ig, '_requestPublicKey', sin_conexion)
+    assert read.leer(['--encrypt_files', 'datos.bin', '--dest_id', 'nadie', '--sign_files', 'datos.bin']) == 1
+
+    salida = capsys.readouterr().out
+    assert 'Error: ConnectionError: sin conexión' in salida
+    assert not os.path.exists('encriptado/datos.bin')
+    assert '1 ficheros procesados, 0 con errores.' in salida
+
+
+# Todos los trabajos de un manifiesto comparten el cliente de la orden; los que cambian el formato
+# usan una copia, sin afectar a los demás.
+def test_manifiesto_comparte_el_cliente(entorno, monkeypatch):
+    creados = []
+    monkeypatch.setattr(cliente, 'crear_directorios', lambda: creados.append(1))
+    for nombre in ('a.bin', 'b.bin', 'c.bin'):
+        with open(nombre, 'wb') as outp:
+            outp.write(os.urandom(1000))
+    with open('trabajos.jsonl', 'w') as outp:
+        outp.write(json.dumps({'action': 'sign', 'file': 'a.bin'}) + '\n')
+        outp.write(json.dumps({'action': 'encrypt', 'file': 'b.bin', 'dest_id': 'yo'}) + '\n')
+        outp.write(json.dumps({'action': 'encrypt', 'file': 'c.bin', 'dest_id': 'yo', 'format': 'gcm'}) + '\n')
+
+    assert read.leer(['--manifest', 'trabajos.jsonl', '--results', 'resultados.jsonl', '--jobs', '2']) == 0
+    assert len(creados) == 1
+    with open('resultados.jsonl') as inp:
+        assert all(json.loads(linea)['ok'] for linea in inp)
+    for nombre, version in (('b.bin', 1), ('c.bin', contenedor.VERSION)):
+        with open('encriptado/' + nombre, 'rb') as inp:
+            assert cr.leer_cabecera(inp)[0] == version
+
+
+# Con --jobs los ficheros se cifran en varios procesos, y cada uno se descifra y verifica igual.
+def test_lotes_en_paralelo(entorno, capsys):
+    ficheros = {}
+    for nombre in ('a.bin', 'b.bin', 'c.bin'):
+        ficheros[nombre] = os.urandom(200000)
+        with open(nombre, 'wb') as outp:
+            outp.write(ficheros[nombre])
+
+    assert read.leer(['--enc_sign_files'] + list(ficheros) + ['--dest_id', 'yo', '--jobs', '3']) == 0
+    assert read.leer(['--decrypt_check_files'] + ['encriptado/' + nombre for nombre in ficheros] + ['--source_id', 'yo', '--jobs', '3']) == 0
+    assert capsys.readouterr().out.count('3 ficheros procesados, 0 con errores.') == 2
+    for nombre, datos in ficheros.items():
+        with open('downloads/' + nombre, 'rb') as inp:
+            assert inp.read() == datos
@@ -0,0 +1,110 @@
+from cliente import SecureBoxClient
+import crypt as cr
+import io
+import os
+import reanudacion
+import requests
+import utils
+import pytest
+
+TROZO = 4096
+
+
+# Cifra un fichero con puntos de control, interrumpiéndolo justo antes de guardar el punto de
+# control número 'antes', de modo que el fichero cifrado ya tiene datos posteriores al último.
+def cifrar_interrumpido(monkeypatch, file, formato, antes):
+    guardar_estado = reanudacion.guardar_estado
+    guardados = []
+
+    def interrumpir(ruta, estado):
+        if len(guardados) + 1 == antes:
+            raise KeyboardInterrupt()
+        guardados.append(dict(estado))
+        guardar_estado(ruta, estado)
+
+    monkeypatch.setattr(reanudacion, 'guardar_estado', interrumpir)
+    with pytest.raises(KeyboardInterrupt):
+        cr.encriptar(file, 'yo', TROZO, formato, reanudar = True)
+    monkeypatch.setattr(reanudacion, 'guardar_estado', guardar_estado)
+    return guardados
+
+
+def descifrar(file):
+    outp = io.BytesIO()
+    with open(file, 'rb') as inp:
+        cr.desencriptar_stream(inp, outp)
+    return outp.getvalue()
+
+
+@pytest.mark.parametrize('formato', ['cbc', 'gcm'])
+def test_cifrado_reanudado(entorno, monkeypatch, capsys, formato):
+    monkeypatch.setattr(reanudacion, 'INTERVALO', 2 * TROZO)
+    datos = os.urandom(20 * TROZO + 100)
+    with open('datos.bin', 'wb') as outp:
+        outp.write(datos)
+
+    guardados = cifrar_interrumpido(monkeypatch, 'datos.bin', formato, 4)
+    assert len(guardados) == 3 and os.path.getsize('encriptado/datos.bin') > guardados[-1]['salida']
+
+    assert cr.encriptar('datos.bin', 'yo', TROZO, formato, reanudar = True) == './encriptado/datos.bin'
+    assert 'Reanudando el cifrado desde el byte ' + str(guardados[-1]['entrada']) in capsys.readouterr().out
+    assert descifrar('encriptado/datos.bin') == datos
+    assert not os.listdir(reanudacion.DIRECTORIO)
+
+
+# Si el fichero cambia después de la interrupción, el cifrado empieza de cero.
+def test_cifrado_de_un_fichero_modificado(entorno, monkeypatch, capsys):
+    monkeypatch.setattr(reanudacion, 'INTERVALO', 2 * TROZO)
+    with open('datos.bin', 'wb') as outp:
+        outp.write(os.urandom(20 * TROZO))
+    cifrar_interrumpido(monkeypatch, 'datos.bin', 'gcm', 3)
+
+    datos = os.urandom(20 * TROZO)
+    with open('datos.bin', 'wb') as outp:
+        outp.write(datos)
+    cr.encriptar('datos.bin', 'yo', TROZO, 'gcm', reanudar = True)
+    assert 'Reanudando' not in capsys.readouterr().out
+    assert descifrar('encriptado/datos.bin') == datos
+
+
+# Una descarga que se corta continúa con una petición de rango desde lo ya recibido.
+def test_descarga_reanudada(servidor, monkeypatch):
+    monkeypatch.setattr(reanudacion, 'INTERVALO', 64 * 1024)
+    monkeypatch.setattr(utils, 'BACKOFF', 0)
+    datos = os.urandom(1024 * 1024 + 3)
+    cliente = SecureBoxClient(formato = 'gcm')
+    file_id = cliente.upload(io.BytesIO(datos), 'yo', name = 'datos.bin')['file_id']
+
+    sessionRequest = utils.sessionRequest
+    peticiones = []
+    entregados = []
+
+    def cortar(function, mainUrl=None, **kwargs):
+        r = sessionRequest(function, mainUrl, **kwargs)
+        if function != '/files/download':
+            return r
+        peticiones.append(kwargs.get('headers') or {})
+        primera = len(peticiones) == 1
+        iter_content = r.iter_content
+
+        def cortado(tam):
+            recibidos = 0
+            for chunk in iter_content(16 * 1024):
+                if primera and recibidos >= 300 * 1024:
+                    raise requests.ConnectionError('conexión cortada')
+                recibidos += len(chunk)
+                if primera:
+                    entregados.append(len(chunk))
+                yield chunk
+
+        r.iter_content = cortado
+        return r
+
+    monkeypatch.setattr(utils, 'sessionRequest', cortar)
+    path = cliente.download(file_id, 'yo', dest = 'copia.bin', resume = True)['path']
+
+    # Lo recibido antes del corte se conserva y solo se pide el resto.
+    assert len(peticiones) == 2 and peticiones[1]['Range'] == 'bytes=' + str(sum(entregados)) + '-'
+    with open(path, 'rb') as inp:
+        assert inp.read() == datos
+    assert not os.listdir(reanudacion.DIRECTORIO)
@@ -0,0 +1,34 @@
+from cliente import SecureBoxClient
+import crypt as cr
+import hashing
+import os
+import pytest
+
+
+# Al subir un fichero nuevo, el hash que se calcula para buscar subidas anteriores es el que se
+# firma: el fichero solo se lee entero una vez para calcularlo, y otra para cifrarlo.
+@pytest.mark.parametrize('formato', ['cbc', 'gcm'])
+def test_subida_firma_el_hash_ya_calculado(servidor, monkeypatch, formato):
+    datos = os.urandom(3 * 1024 * 1024 + 5)
+    with open('datos.bin', 'wb') as outp:
+        outp.write(datos)
+
+    hash_stream = hashing.hash_stream
+    lecturas = []
+
+    def contar(*args, **kwargs):
+        lecturas.append(args)
+        return hash_stream(*args, **kwargs)
+
+    monkeypatch.setattr(cr, 'SPILL_MAX', 0)
+    monkeypatch.setattr(hashing, 'hash_stream', contar)
+    cliente = SecureBoxClient(formato = formato)
+    file_id = cliente.upload('datos.bin', 'yo')['file_id']
+    assert len(lecturas) == 1
+
+    # La firma es correcta, y el mismo fichero no se vuelve a subir.
+    path = cliente.download(file_id, 'yo', dest = 'copia.bin')['path']
+    with open(path, 'rb') as inp:
+        assert inp.read() == datos
+    assert cliente.upload('datos.bin', 'yo')['file_id'] == file_id
+    assert len(lecturas) == 1
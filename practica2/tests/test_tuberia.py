@@ -0,0 +1,32 @@
+import io
+import os
+import time
+import tuberia
+import pytest
+
+
+def test_procesar_en_orden():
+    datos = os.urandom(10 * 4096 + 123)
+    salida = io.BytesIO()
+    tuberia.procesar(io.BytesIO(datos), salida, lambda buf, ultimo: bytes(buf)[::-1], 4096)
+    bloques = [datos[i:i + 4096] for i in range(0, len(datos), 4096)]
+    assert salida.getvalue() == b''.join(bloque[::-1] for bloque in bloques)
+
+
+# Si la etapa de cálculo falla mientras la de lectura espera datos de una tubería que no llegan,
+# el error se lanza sin quedarse esperando a la lectura.
+def test_fallo_con_la_lectura_bloqueada():
+    lectura, escritura = os.pipe()
+    os.write(escritura, b'x' * 2 * 4096)
+
+    def fallar(buf, ultimo):
+        raise ValueError('fallo al transformar')
+
+    try:
+        with open(lectura, 'rb', buffering = 0) as inp:
+            inicio = time.monotonic()
+            with pytest.raises(ValueError, match = 'fallo al transformar'):
+                tuberia.procesar(inp, io.BytesIO(), fallar, 4096)
+            assert time.monotonic() - inicio < tuberia.ESPERA_LECTOR + 2
+    finally:
+        os.close(escritura)
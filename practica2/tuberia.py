@@ -0,0 +1,153 @@
+import queue
+import threading
+
+# Tubería de tres etapas para procesar un fichero por bloques: un hilo lee del fichero de entrada,
+# el hilo que llama a procesar transforma cada bloque (cifra, descifra, calcula el hash...) y otro
+# hilo escribe el resultado en el fichero de salida. Las tres etapas comparten BUFFERS buffers de
+# tamaño fijo que pasan de una a otra por colas y se reutilizan, de modo que la lectura del bloque
+# siguiente y la escritura del anterior se solapan con el cálculo del actual sin que la memoria
+# usada dependa del tamaño del fichero. Las lecturas y escrituras de ficheros, el cifrado de
+# pycryptodome y los hash de hashlib liberan el GIL, por lo que las etapas avanzan a la vez.
+BUFFERS = 4
+
+# Tiempo (en segundos) cada cuánto las etapas que esperan un buffer comprueban si se ha abortado.
+ESPERA = 0.1
+
+# Tiempo máximo (en segundos) que se espera a la etapa de lectura al abortar. Puede estar bloqueada
+# leyendo de una tubería o un socket (la entrada estándar, archivo.flujo_archivo...) que no van a
+# dar más datos, y como es un hilo daemon se puede abandonar.
+ESPERA_LECTOR = 1.0
+
+
+# Clase que guarda el estado compartido por las etapas de la tubería: las colas de buffers, el
+# aviso de que se debe abortar y el primer error de las etapas auxiliares.
+#
+class Tuberia(object):
+    def __init__(self, chunk_size, buffers):
+        super(Tuberia, self).__init__()
+        self.chunk_size = chunk_size
+        self.libres = queue.Queue()
+        self.leidos = queue.Queue()
+        self.escritos = queue.Queue()
+        self.abortar = threading.Event()
+        self.errores = []
+        for i in range(max(3, buffers)):
+            self.libres.put(bytearray(chunk_size))
+
+    def obtener(self, cola):
+        while not self.abortar.is_set():
+            try:
+                return cola.get(timeout = ESPERA)
+            except queue.Empty:
+                pass
+        return None
+
+    def fallar(self, error):
+        self.errores.append(error)
+        self.abortar.set()
+
+
+# Funcion que lee de un fichero hasta llenar el buffer dado o llegar al final del fichero.
+# Parámetros:
+#	inp: fichero abierto en modo binario.
+#	buf: buffer en el que se leen los datos.
+# Return: número de bytes leídos.
+#
+def leer_completo(inp, buf):
+    vista = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        n = inp.readinto(vista[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+# Funcion de la etapa de lectura: llena los buffers libres con el fichero y los pasa a la etapa de
+# cálculo indicando cuál es el último. Un buffer lleno se retiene hasta leer el siguiente, para
+# saber si es el último aunque el tamaño del fichero sea múltiplo del de los buffers.
+# Parámetros:
+#	tuberia: estado de la tubería.
+#	inp: fichero de entrada.
+#
+def leer(tuberia, inp):
+    try:
+        pendiente = None
+        while True:
+            buf = tuberia.obtener(tuberia.libres)
+            if buf is None:
+                return
+            n = leer_completo(inp, buf)
+
+            if pendiente is not None:
+                tuberia.leidos.put((pendiente, tuberia.chunk_size, n == 0))
+            if n == 0:
+                if pendiente is None:
+                    tuberia.leidos.put((buf, 0, True))
+                return
+            if n < tuberia.chunk_size:
+                tuberia.leidos.put((buf, n, True))
+                return
+            pendiente = buf
+    except BaseException as e:
+        tuberia.fallar(e)
+
+
+# Funcion de la etapa de escritura: escribe en orden los datos que genera la etapa de cálculo y
+# devuelve cada buffer a los libres. Termina al recibir None.
+# Parámetros:
+#	tuberia: estado de la tubería.
+#	outp: fichero de salida.
+#
+def escribir(tuberia, outp):
+    while True:
+        elemento = tuberia.escritos.get()
+        if elemento is None:
+            return
+        datos, buf = elemento
+        try:
+            if datos is not None and not tuberia.abortar.is_set():
+                outp.write(datos)
+        except BaseException as e:
+            tuberia.fallar(e)
+        tuberia.libres.put(buf)
+
+
+# Funcion que procesa un fichero por bloques con la tubería de tres etapas.
+# Parámetros:
+#	inp: fichero de entrada abierto en modo binario.
+#	outp: fichero de salida abierto en modo binario, situado donde se deben escribir los datos.
+#	transformar: función que recibe cada bloque (memoryview sobre un buffer de la tubería, con
+#	chunk_size bytes salvo el último) y True si es el último, y devuelve lo que se debe escribir:
+#	el propio bloque (modificado en el buffer si hace falta), otros datos, o None para no escribir
+#	nada. El último bloque puede estar vacío si el fichero lo está.
+#	chunk_size: tamaño de los bloques.
+#	buffers: número de buffers de la tubería (al menos 3).
+#
+def procesar(inp, outp, transformar, chunk_size, buffers=BUFFERS):
+    tuberia = Tuberia(chunk_size, buffers)
+    lector = threading.Thread(target = leer, args = (tuberia, inp), daemon = True)
+    escritor = threading.Thread(target = escribir, args = (tuberia, outp), daemon = True)
+    lector.start()
+    escritor.start()
+
+    try:
+        while True:
+            elemento = tuberia.obtener(tuberia.leidos)
+            if elemento is None:
+                break
+            buf, n, ultimo = elemento
+            tuberia.escritos.put((transformar(memoryview(buf)[:n], ultimo), buf))
+            if ultimo:
+                break
+    except BaseException:
+        tuberia.abortar.set()
+        raise
+    finally:
+        tuberia.escritos.put(None)
+        escritor.join()
+        lector.join(ESPERA_LECTOR if tuberia.abortar.is_set() else None)
+
+    if tuberia.errores:
+        raise tuberia.errores[0]
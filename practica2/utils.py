@@ -1,7 +1,32 @@
 import requests
+from requests.adapters import HTTPAdapter
+import io
 import json
+import os
+import threading
+import time
+import uuid
 
-URL = 'http://vega.ii.uam.es:8080/api'
+URL = os.environ.get('SECUREBOX_URL', 'http://vega.ii.uam.es:8080/api')
+
+# Configuración del transporte HTTP: número de conexiones que se mantienen abiertas con el
+# servidor, tiempo máximo (en segundos) para conectar y para recibir cada respuesta, y número de
+# reintentos de las peticiones idempotentes si falla la conexión o el servidor no está disponible.
+POOL_SIZE = 10
+TIMEOUT = (10, 120)
+RETRIES = 3
+BACKOFF = 0.5
+
+# Funciones de la API que solo consultan datos, por lo que se pueden repetir sin efectos
+# secundarios si la petición falla.
+IDEMPOTENT = {'/users/getPublicKey', '/users/search', '/files/list', '/files/download'}
+
+# Códigos de respuesta tras los que se reintenta una petición idempotente.
+RETRY_STATUS = {502, 503, 504}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
 
 
 # Funcion que obtiene el token para la API.
@@ -10,6 +35,76 @@ URL = 'http://vega.ii.uam.es:8080/api'
 def getToken():
     return '0c1F4Ab3ED5C796f'
 
+
+# Funcion que cambia la configuración del transporte HTTP. La sesión se vuelve a crear con la
+# nueva configuración en la siguiente petición.
+# Parámetros:
+#	pool_size: número de conexiones que se mantienen abiertas.
+#	timeout: tiempo máximo para conectar y para recibir la respuesta, en segundos.
+#	retries: número de reintentos de las peticiones idempotentes.
+#
+def configureSession(pool_size=None, timeout=None, retries=None):
+    global POOL_SIZE, TIMEOUT, RETRIES, _session
+
+    with _session_lock:
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if timeout is not None:
+            TIMEOUT = timeout
+        if retries is not None:
+            RETRIES = retries
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+# Funcion que devuelve la sesión HTTP compartida por todas las peticiones a la API, que reutiliza
+# las conexiones (keep-alive) en lugar de abrir una nueva en cada petición. Si el proceso se ha
+# duplicado (fork) se crea una sesión nueva, para no compartir sockets con el proceso padre.
+# Return: sesión de requests.
+#
+def getSession():
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = POOL_SIZE, pool_maxsize = POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Authorization'] = 'Bearer ' + getToken()
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+# Funcion que realiza una petición POST a la API con la sesión compartida, reintentando las
+# peticiones idempotentes cuando falla la conexión o el servidor no está disponible.
+# Parámetros:
+#	function: acción que se quiere que realice la API.
+#	mainURL: URL de la API (URL por defecto).
+#	kwargs: parámetros de requests para la petición (json, files, stream...).
+# Return: el resultado de la petición a la API.
+#
+def sessionRequest(function, mainUrl=None, **kwargs):
+    url = (mainUrl or URL) + function
+    kwargs.setdefault('timeout', TIMEOUT)
+    intentos = 1 + (RETRIES if function in IDEMPOTENT else 0)
+
+    for intento in range(intentos):
+        ultimo = intento == intentos - 1
+        try:
+            r = getSession().post(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if ultimo:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUS or ultimo:
+                return r
+            r.close()
+        time.sleep(BACKOFF * 2 ** intento)
+
+
 # Funcion que realiza una petición a la API (no de descarga).
 # Parámetros:
 #	function: acción ue se quiere que realice la API.
@@ -17,9 +112,8 @@ def getToken():
 #   mainURL: URL de la API.
 # Return: el resultado de la petición a la API
 #
-def genericRequest(function, data, mainUrl=URL):
-    url = mainUrl+function
-    return requests.post(url, json=data, headers={'Authorization': 'Bearer ' + getToken()})
+def genericRequest(function, data, mainUrl=None):
+    return sessionRequest(function, mainUrl, json=data)
 
 
 # Funcion que realiza una petición a la API (de descarga).
@@ -29,11 +123,93 @@ def genericRequest(function, data, mainUrl=URL):
 #   mainURL: URL de la API.
 # Return: el resultado de la petición a la API
 #
-def binaryRequest(function, file_path, mainUrl=URL):
-    url = mainUrl+function
-    file = {'ufile': open(file_path,'rb')}
+def binaryRequest(function, file_path, mainUrl=None):
+    with open(file_path, 'rb') as file:
+        return sessionRequest(function, mainUrl, files={'ufile': file})
 
-    return requests.post(url, files=file, headers={'Authorization': 'Bearer ' + getToken()})
+
+# Clase que permite leer como un fichero (read/readinto) los fragmentos que produce un iterador,
+# por ejemplo iter_content de una respuesta descargada con stream=True, de modo que las funciones
+# de cifrado pueden procesar la descarga a medida que llega.
+#
+class IteratorReader(io.RawIOBase):
+    def __init__(self, iterator):
+        super(IteratorReader, self).__init__()
+        self.iterator = iter(iterator)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while len(self.pending) == 0:
+            try:
+                self.pending = memoryview(next(self.iterator))
+            except StopIteration:
+                return 0
+
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+# Clase que genera el cuerpo de una petición multipart/form-data con un único fichero a medida que
+# se envía, a partir de un iterador con los fragmentos del fichero. Si se conoce el tamaño del
+# fichero, el cuerpo tiene longitud (Content-Length); si no, requests lo envía por partes
+# (Transfer-Encoding: chunked).
+#
+class MultipartStream(object):
+    def __init__(self, field, filename, chunks, length=None):
+        super(MultipartStream, self).__init__()
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.head = ('--' + boundary + '\r\n'
+                     'Content-Disposition: form-data; name="' + field + '"; filename="' + filename + '"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n').encode()
+        self.tail = ('\r\n--' + boundary + '--\r\n').encode()
+        self.chunks = chunks
+        self.length = None if length is None else len(self.head) + length + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        for chunk in self.chunks:
+            yield chunk
+        yield self.tail
+
+    def body(self):
+        if self.length is None:
+            return iter(self)
+        return _SizedBody(self)
+
+
+# Clase auxiliar que da longitud al cuerpo de MultipartStream, para que requests envíe la cabecera
+# Content-Length en lugar de usar Transfer-Encoding: chunked.
+#
+class _SizedBody(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __len__(self):
+        return self.stream.length
+
+
+# Funcion que sube un fichero a la API a medida que se generan sus fragmentos, sin necesidad de
+# que esté guardado en disco ni completo en memoria.
+# Parámetros:
+#	function: acción que se quiere que realice la API.
+#	filename: nombre con el que se sube el fichero.
+#	chunks: iterador con los fragmentos del fichero.
+#	length: tamaño exacto del fichero, o None para enviarlo por partes (chunked).
+#	mainURL: URL de la API.
+# Return: el resultado de la petición a la API.
+#
+def streamRequest(function, filename, chunks, length=None, mainUrl=None):
+    stream = MultipartStream('ufile', filename, chunks, length)
+    return sessionRequest(function, mainUrl, data=stream.body(), headers={'Content-Type': stream.content_type})
 
 
 # Funcion que comprueba el resultado de una petición a la API.
@@ -0,0 +1,346 @@
+from concurrent.futures import ThreadPoolExecutor
+import batch
+import metadatos as md
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+
+# Vigilancia de carpetas: un proceso que se queda esperando a que aparezcan ficheros en una carpeta
+# y los firma, cifra y sube en cuanto terminan de escribirse, en lugar de ejecutar --upload_files
+# periódicamente (desde cron) volviendo a arrancar Python y a recorrer la carpeta cada vez. En Linux
+# los cambios se reciben del núcleo con inotify, sin recorrer la carpeta; si inotify no está
+# disponible (o se pide con --poll) se recorre la carpeta cada INTERVALO segundos comparando el
+# tamaño y la fecha de modificación de cada fichero.
+#
+# Un fichero se sube cuando lleva ESPERA segundos sin cambios, de modo que las muchas escrituras de
+# una copia se agrupan en una sola subida, y los ficheros listos a la vez se encolan juntos en una
+# transacción de la base de datos local (tabla cola de metadatos.py). Las subidas se reparten entre
+# un número fijo de hilos y la cola guarda su estado, por lo que al volver a arrancar se continúan
+# las pendientes y solo se suben los ficheros nuevos o modificados mientras no se vigilaba.
+
+# Segundos sin cambios que debe llevar un fichero para subirlo.
+ESPERA = 2.0
+
+# Segundos entre dos recorridos de la carpeta cuando no se usa inotify.
+INTERVALO = 1.0
+
+# Segundos que se espera como mucho a los eventos antes de comprobar las subidas terminadas.
+ESPERA_BUCLE = 0.5
+
+# Intentos de subida de un fichero antes de dejarlo con error, y espera máxima entre dos intentos
+# (se duplica en cada intento, empezando en 2 segundos).
+MAX_INTENTOS = 5
+MAX_ESPERA_REINTENTO = 60
+
+# Ficheros que no se suben: ocultos y temporales de editores y descargas a medio terminar.
+TEMPORALES = ('~', '.tmp', '.part', '.swp', '.crdownload')
+
+# Constantes de inotify (ver inotify(7)).
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+FORMATO_EVENTO = 'iIII'
+TAM_EVENTOS = 64 * 1024
+
+
+# Funcion que indica si un fichero de la carpeta vigilada no se debe subir.
+# Parámetros:
+#	nombre: nombre del fichero.
+# Return: True si es oculto o temporal.
+#
+def ignorado(nombre):
+    return nombre.startswith('.') or nombre.endswith(TEMPORALES)
+
+
+# Funcion que recorre la carpeta vigilada.
+# Parámetros:
+#	carpeta: ruta de la carpeta.
+# Return: diccionario con la tupla (tamaño, fecha de modificación en ns) de cada fichero regular que
+# no se ignora, por nombre.
+#
+def escanear(carpeta):
+    ficheros = {}
+    with os.scandir(carpeta) as entradas:
+        for entrada in entradas:
+            if ignorado(entrada.name) or not entrada.is_file(follow_symlinks = False):
+                continue
+            try:
+                st = entrada.stat(follow_symlinks = False)
+            except FileNotFoundError:
+                continue
+            ficheros[entrada.name] = (st.st_size, st.st_mtime_ns)
+    return ficheros
+
+
+# Clase que recibe los cambios de la carpeta vigilada del núcleo con inotify. Si no está disponible
+# el constructor lanza OSError.
+# Parámetros del constructor:
+#	carpeta: ruta de la carpeta.
+#
+class Inotify(object):
+    nombre = 'inotify'
+
+    def __init__(self, carpeta):
+        super(Inotify, self).__init__()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            iniciar, vigilar = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError('inotify no está disponible: ' + str(e))
+
+        self.fd = iniciar(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        mascara = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+        if vigilar(self.fd, os.fsencode(carpeta), mascara) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch: ' + os.strerror(errno))
+
+    # Espera como mucho espera segundos a que haya eventos.
+    # Return: lista con los nombres de los ficheros que han cambiado, o None si se han perdido
+    # eventos (la cola del núcleo se ha llenado) y hay que volver a recorrer la carpeta.
+    def eventos(self, espera):
+        if not select.select([self.fd], [], [], espera)[0]:
+            return []
+        try:
+            datos = os.read(self.fd, TAM_EVENTOS)
+        except BlockingIOError:
+            return []
+
+        nombres = []
+        tam_cabecera = struct.calcsize(FORMATO_EVENTO)
+        i = 0
+        while i < len(datos):
+            wd, mascara, cookie, tam = struct.unpack_from(FORMATO_EVENTO, datos, i)
+            nombre = datos[i + tam_cabecera:i + tam_cabecera + tam].rstrip(b'\0')
+            i += tam_cabecera + tam
+            if mascara & IN_Q_OVERFLOW:
+                return None
+            if mascara & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise FileNotFoundError('La carpeta vigilada se ha borrado o movido.')
+            if nombre and not mascara & IN_ISDIR:
+                nombres.append(os.fsdecode(nombre))
+        return nombres
+
+    def cerrar(self):
+        os.close(self.fd)
+
+
+# Clase que obtiene los cambios de la carpeta vigilada recorriéndola cada INTERVALO segundos.
+# Parámetros del constructor:
+#	carpeta: ruta de la carpeta.
+#
+class Sondeo(object):
+    nombre = 'sondeo cada ' + str(INTERVALO) + ' s'
+
+    def __init__(self, carpeta):
+        super(Sondeo, self).__init__()
+        self.carpeta = carpeta
+        self.ficheros = escanear(carpeta)
+        self.ultimo = time.monotonic()
+
+    def eventos(self, espera):
+        pendiente = self.ultimo + INTERVALO - time.monotonic()
+        if pendiente > 0:
+            time.sleep(min(espera, pendiente))
+            return []
+
+        if not os.path.isdir(self.carpeta):
+            raise FileNotFoundError('La carpeta vigilada se ha borrado o movido.')
+        ficheros = escanear(self.carpeta)
+        self.ultimo = time.monotonic()
+        cambiados = [nombre for nombre, datos in ficheros.items() if self.ficheros.get(nombre) != datos]
+        self.ficheros = ficheros
+        return cambiados
+
+    def cerrar(self):
+        pass
+
+
+# Clase que guarda el estado de la vigilancia de una carpeta: los ficheros que han cambiado y
+# esperan a llevar ESPERA segundos sin cambios, las subidas en curso y las que se deben reintentar,
+# y lo que ya se ha subido (o ha fallado todos los intentos) en cada versión de cada fichero.
+# Parámetros del constructor:
+#	carpeta: ruta absoluta de la carpeta.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#	subir: función que sube un fichero (recibe su ruta) y devuelve su id en SecureBox.
+#	jobs: número de subidas a la vez.
+#	espera: segundos sin cambios que debe llevar un fichero para subirlo.
+#
+class Vigilancia(object):
+    def __init__(self, carpeta, dest_id, subir, jobs, espera):
+        super(Vigilancia, self).__init__()
+        self.carpeta = carpeta
+        self.dest_id = dest_id
+        self.subir = subir
+        self.espera = espera
+        self.cambios = {}
+        self.reintentos = {}
+        self.en_curso = set()
+        self.hechos = {}
+        self.terminados = queue.Queue()
+        self.hilos = ThreadPoolExecutor(max_workers = max(1, jobs))
+        self.subidos = 0
+        self.fallidos = 0
+
+    # Compara la cola guardada con la carpeta para continuar lo que quedó pendiente y subir lo que
+    # ha cambiado mientras no se vigilaba. Es el único recorrido completo de la carpeta con inotify.
+    # Return: número de ficheros por subir.
+    def recuperar(self):
+        cola = md.ficheros_cola(self.carpeta, self.dest_id)
+        actuales = escanear(self.carpeta)
+        md.borrar_cola([ruta for ruta in cola if os.path.basename(ruta) not in actuales], self.dest_id)
+
+        self.cambiados(actuales)
+        for ruta, (tam, mtime, estado, intentos) in cola.items():
+            if estado != 'pendiente':
+                self.hechos[ruta] = (tam, mtime)
+        return sum(1 for nombre, datos in actuales.items() if self.hechos.get(os.path.join(self.carpeta, nombre)) != datos)
+
+    # Anota que han cambiado ficheros, para subirlos cuando lleven ESPERA segundos sin cambios.
+    def cambiados(self, nombres):
+        ahora = time.monotonic()
+        for nombre in nombres:
+            if not ignorado(nombre):
+                self.cambios[os.path.join(self.carpeta, nombre)] = ahora
+
+    # Encola y lanza las subidas de los ficheros que ya llevan ESPERA segundos sin cambios (salvo los
+    # que ya se están subiendo, que se esperan) y los reintentos que ya toca hacer.
+    def avanzar(self):
+        self.recoger()
+        ahora = time.monotonic()
+        listos = [ruta for ruta, instante in self.cambios.items() if ahora - instante >= self.espera and ruta not in self.en_curso]
+
+        ficheros, borrados = [], []
+        for ruta in listos:
+            del self.cambios[ruta]
+            self.reintentos.pop(ruta, None)
+            try:
+                st = os.stat(ruta, follow_symlinks = False)
+            except FileNotFoundError:
+                borrados.append(ruta)
+                continue
+            if stat.S_ISREG(st.st_mode) and self.hechos.get(ruta) != (st.st_size, st.st_mtime_ns):
+                ficheros.append((ruta, st.st_size, st.st_mtime_ns))
+
+        if borrados:
+            md.borrar_cola(borrados, self.dest_id)
+        if ficheros:
+            md.encolar(ficheros, self.dest_id)
+        for fichero in ficheros:
+            self.lanzar(fichero, 0)
+
+        for ruta, (instante, fichero, intentos) in list(self.reintentos.items()):
+            if instante <= ahora and ruta not in self.en_curso:
+                del self.reintentos[ruta]
+                self.lanzar(fichero, intentos)
+
+    def lanzar(self, fichero, intentos):
+        self.en_curso.add(fichero[0])
+        self.hilos.submit(self.trabajo, fichero, intentos)
+
+    # Sube un fichero en uno de los hilos, guardando lo que imprime para mostrarlo entero al terminar.
+    def trabajo(self, fichero, intentos):
+        resultado = []
+
+        def subir():
+            resultado.append(self.subir(fichero[0]))
+            return resultado[-1]
+
+        correcto, salida, error = batch.ejecutar_capturando(subir, ())
+        self.terminados.put((fichero, intentos, correcto, salida, error, resultado[-1] if resultado else None))
+
+    # Guarda en la cola el resultado de las subidas terminadas y programa los reintentos.
+    def recoger(self):
+        while True:
+            try:
+                fichero, intentos, correcto, salida, error, file_id = self.terminados.get_nowait()
+            except queue.Empty:
+                return
+
+            ruta, tam, mtime = fichero
+            self.en_curso.discard(ruta)
+            sys.stdout.write(salida)
+            if correcto:
+                md.actualizar_cola(ruta, self.dest_id, 'subido', file_id = file_id)
+                self.hechos[ruta] = (tam, mtime)
+                self.subidos += 1
+                print('Fichero ' + ruta + ' subido con ID ' + str(file_id))
+            elif not os.path.exists(ruta):
+                md.borrar_cola([ruta], self.dest_id)
+            elif intentos + 1 < MAX_INTENTOS:
+                espera = min(MAX_ESPERA_REINTENTO, 2 ** (intentos + 1))
+                md.actualizar_cola(ruta, self.dest_id, 'pendiente', intentos + 1)
+                self.reintentos[ruta] = (time.monotonic() + espera, fichero, intentos + 1)
+                print('Error al subir ' + ruta + ': ' + str(error) + '. Se vuelve a intentar en ' + str(espera) + ' s.')
+            else:
+                md.actualizar_cola(ruta, self.dest_id, 'error', intentos + 1)
+                self.hechos[ruta] = (tam, mtime)
+                self.fallidos += 1
+                print('Error al subir ' + ruta + ': ' + str(error) + '. No se vuelve a intentar hasta que el fichero cambie.')
+
+    # Espera a las subidas en curso (las que aún no han empezado quedan pendientes en la cola para
+    # la próxima vez) y guarda su resultado.
+    def terminar(self):
+        self.hilos.shutdown(wait = True, cancel_futures = True)
+        self.recoger()
+
+
+# Funcion que vigila una carpeta y sube los ficheros que aparecen o se modifican en ella hasta que
+# se interrumpe (Ctrl+C) o se activa parar. No se vigilan las subcarpetas.
+# Parámetros:
+#	carpeta: ruta de la carpeta.
+#	dest_id: id en SecureBox del destinatario, o lista de ids.
+#	subir: función que sube un fichero (recibe su ruta) y devuelve su id en SecureBox.
+#	jobs: número de subidas a la vez.
+#	sondeo: True para recorrer la carpeta periódicamente aunque inotify esté disponible.
+#	parar: threading.Event con el que se puede detener la vigilancia desde otro hilo.
+#	espera: segundos sin cambios que debe llevar un fichero para subirlo.
+# Return: tupla con el número de ficheros subidos y el de ficheros que han fallado.
+#
+def vigilar(carpeta, dest_id, subir, jobs=1, sondeo=False, parar=None, espera=ESPERA):
+    carpeta = os.path.realpath(carpeta)
+    if not os.path.isdir(carpeta):
+        raise NotADirectoryError('No existe la carpeta ' + carpeta)
+    parar = parar or threading.Event()
+
+    fuente = None
+    if not sondeo:
+        try:
+            fuente = Inotify(carpeta)
+        except OSError as e:
+            print(str(e) + ', se recorre la carpeta periódicamente.', file = sys.stderr)
+    fuente = fuente or Sondeo(carpeta)
+
+    vigilancia = Vigilancia(carpeta, dest_id, subir, jobs, espera)
+    try:
+        pendientes = vigilancia.recuperar()
+        print('Vigilando ' + carpeta + ' (' + fuente.nombre + ', ' + str(jobs) + ' subidas a la vez), ' + str(pendientes) + ' ficheros por subir. Ctrl+C para terminar.')
+        sys.stdout.flush()
+        while not parar.is_set():
+            nombres = fuente.eventos(ESPERA_BUCLE)
+            if nombres is None:
+                nombres = list(escanear(carpeta))
+            vigilancia.cambiados(nombres)
+            vigilancia.avanzar()
+    except KeyboardInterrupt:
+        print('Terminando las subidas en curso')
+    finally:
+        fuente.cerrar()
+        vigilancia.terminar()
+
+    return vigilancia.subidos, vigilancia.fallidos